@@ -0,0 +1,314 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+import argparse
+import json
+import logging
+import math
+import statistics
+import tempfile
+import timeit
+
+from pydantic import BaseModel
+
+from chadGPT.brain import BaseLLM, format_data_model
+from chadGPT.data_models import (
+    ContextItem, LLMRequest, Portfolio, Position, Preferences, RelativePortfolio,
+    RelativePosition, Rule, StockBar
+)
+from chadGPT.db import ActionTable, SQLiteDatabase
+from chadGPT.giga import Giga
+from chadGPT.metrics import tracer
+from chadGPT.trader import make_trades_from_portfolio
+from tests.dummies import DummyBroker, DummyLLM, DummyMarket
+
+# general workflow
+# 1. python -m benchmarks.run [--quick] times every case with timeit
+# 2. --save benchmarks/baseline.json stores the results as a baseline
+# 3. --compare benchmarks/baseline.json flags cases slower than the baseline
+#    by more than --tolerance (and exits with 1, so CI can fail on it)
+
+
+logger = logging.getLogger(__name__)
+
+NOW = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+RULE = Rule(stop_loss_pct=0.1, take_profit_pct=0.2)
+
+
+class Case(BaseModel):
+    func: Callable[[], object]
+    # restores the starting state (e.g. the table size) before each repeat
+    reset: Optional[Callable[[], None]] = None
+
+
+class BenchmarkResult(BaseModel):
+    name: str
+    best: float # seconds per call
+    median: float
+    number: int # calls per repeat
+    repeat: int
+
+
+# ---- Inputs ----
+
+def make_bars(symbol: str, n: int) -> list[StockBar]:
+    return [
+        StockBar(
+            symbol=symbol, time=NOW - timedelta(days=i), open=100.0, high=101.0,
+            low=99.0, close=100.5, volume=1000, trade_count=10,
+            volume_weighted_avg_price=100.2
+        )
+        for i in range(n)
+    ]
+
+
+def make_portfolio(n: int) -> Portfolio:
+    positions = [
+        Position(symbol=f"S{i}", shares=10.0, value=1000.0, rules=RULE)
+        for i in range(n)
+    ]
+    return Portfolio(
+        positions=positions, cash=1000.0, total_value=1000.0 * (n + 1), timestamp=NOW
+    )
+
+
+def make_relative_portfolio(n: int) -> RelativePortfolio:
+    # keep half of the held symbols (resized) and add as many new ones
+    symbols = [f"S{i}" for i in range(0, n, 2)] + [f"N{i}" for i in range(n // 2)]
+    return RelativePortfolio(
+        positions=[
+            RelativePosition(symbol=symbol, percent_of_portfolio=0.9 / len(symbols), rules=RULE)
+            for symbol in symbols
+        ],
+        percent_cash=0.1,
+    )
+
+
+def populate_db(db: SQLiteDatabase, rows: int, users: int = 100, chunk: int = 50_000) -> None:
+    from sqlmodel import Session, insert
+    action = {'query': "q" * 200, 'response': {'strategy_report': "r" * 200}}
+    with Session(db.engine) as session:
+        for offset in range(0, rows, chunk):
+            session.execute(insert(ActionTable), [
+                {
+                    'user': f"user_{i % users}",
+                    'category': 'portfolio_update' if i % 2 else 'strategy',
+                    'action': action,
+                    'timestamp': NOW + timedelta(minutes=i),
+                }
+                for i in range(offset, min(offset + chunk, rows))
+            ])
+        session.commit()
+
+
+# ---- Cases ----
+
+def context_cases(sizes: list[int]) -> dict[str, Case]:
+    cases = {}
+    for n in sizes:
+        bars = make_bars("AAPL", n)
+        request = LLMRequest(
+            prompt="prompt", background="background",
+            context=[
+                ContextItem(content=bars, priority=0),
+                ContextItem(content=make_portfolio(n // 10 or 1), priority=2),
+            ],
+            expected_format=RelativePortfolio,
+        )
+        budget_request = request.model_copy(update={'token_budget': 2_000})
+        cases[f"make_query[bars={n}]"] = Case(func=lambda r=request: BaseLLM.make_query(r))
+        cases[f"make_query_budget[bars={n}]"] = Case(
+            func=lambda r=budget_request: BaseLLM.make_query(r)
+        )
+        cases[f"format_data_model[bars={n}]"] = Case(func=lambda b=bars: format_data_model(b))
+    return cases
+
+
+def trade_cases(sizes: list[int]) -> dict[str, Case]:
+    cases = {}
+    for n in sizes:
+        current, desired = make_portfolio(n), make_relative_portfolio(n)
+        prices = {pos.symbol: 100.0 for pos in desired.positions}
+        cases[f"make_trades_from_portfolio[positions={n}]"] = Case(
+            func=lambda c=current, d=desired, p=prices: make_trades_from_portfolio(c, d, p)
+        )
+    return cases
+
+
+def truncate_to(db: SQLiteDatabase, rows: int) -> None:
+    # populate_db inserts ids 1..rows; drop whatever the benchmark added since
+    from sqlmodel import Session, delete
+    with Session(db.engine) as session:
+        session.execute(delete(ActionTable).where(ActionTable.id > rows))
+        session.commit()
+
+
+def db_cases(sizes: list[int], directory: str) -> dict[str, Case]:
+    cases = {}
+    for n in sizes:
+        db = SQLiteDatabase(f"sqlite:///{os.path.join(directory, f'history_{n}.db')}")
+        populate_db(db, n)
+        action = {'query': "q" * 200, 'response': {'positions': [], 'percent_cash': 1.0}}
+        cases[f"db.write[rows={n}]"] = Case(
+            func=lambda db=db: db.write(user="user_0", category='portfolio_update', action=action),
+            reset=lambda db=db, n=n: truncate_to(db, n),
+        )
+        cases[f"db.read[rows={n}]"] = Case(
+            func=lambda db=db: db.read(user="user_1", category='portfolio_update')
+        )
+        cases[f"db.read_latest[rows={n}]"] = Case(
+            func=lambda db=db: db.read_latest(user="user_1", category='portfolio_update')
+        )
+    return cases
+
+
+def pipeline_cases(users: int, directory: str) -> dict[str, Case]:
+    gigas: list[Giga] = []
+    resets = 0
+
+    def reset():
+        # every repeat starts from an empty database
+        nonlocal resets
+        resets += 1
+        db = SQLiteDatabase(f"sqlite:///{os.path.join(directory, f'pipeline_{resets}.db')}")
+        gigas[:] = [
+            Giga(
+                broker=DummyBroker(), market=DummyMarket(),
+                portfolio_update_brain=DummyLLM(), research_brain=DummyLLM(),
+                user_preferences=Preferences(), db=db, user=f"user_{i}"
+            )
+            for i in range(users)
+        ]
+
+    def run_all():
+        for giga in gigas:
+            giga.giga_pipeline()
+
+    return {f"giga_pipeline[users={users}]": Case(func=run_all, reset=reset)}
+
+
+# ---- Harness ----
+
+def measure(name: str, case: Case, repeat: int, min_time: float) -> BenchmarkResult:
+    """
+    Time case.func with a call count chosen from one calibration call so
+    each repeat takes about min_time seconds.
+    """
+    timer = timeit.Timer(case.func)
+    if case.reset:
+        case.reset()
+    calibration = timer.timeit(number=1)
+    number = max(1, math.ceil(min_time / calibration)) if calibration > 0 else 1
+    times = []
+    for _ in range(repeat):
+        if case.reset:
+            case.reset()
+        times.append(timer.timeit(number=number) / number)
+    return BenchmarkResult(
+        name=name, best=min(times), median=statistics.median(times),
+        number=number, repeat=repeat
+    )
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def compare(
+    results: list[BenchmarkResult], baseline: dict[str, dict], tolerance: float
+) -> list[str]:
+    """
+    Print each result against the baseline; returns the names that regressed.
+    """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result.name)
+        if previous is None:
+            print(f"{result.name:<50} {format_seconds(result.best):>10}  (new)")
+            continue
+        ratio = result.best / previous['best']
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(result.name)
+        print(
+            f"{result.name:<50} {format_seconds(result.best):>10} " +
+            f"{format_seconds(previous['best']):>10} {ratio:6.2f}x{flag}"
+        )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Time the pipeline's hot paths and compare with a baseline",
+    )
+    parser.add_argument("--quick", action="store_true", help="small sizes only (for CI)")
+    parser.add_argument("--only", help="run cases whose name contains this string")
+    parser.add_argument("--db-sizes", help="comma separated history sizes, e.g. 1000,1000000")
+    parser.add_argument("--users", type=int, help="users in the giga_pipeline case")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.quick:
+        context_sizes, position_sizes, db_sizes, users = [100, 1_000], [10, 100], [1_000], 10
+    else:
+        context_sizes = [100, 1_000, 10_000]
+        position_sizes = [10, 100, 1_000]
+        db_sizes = [1_000, 10_000, 100_000, 1_000_000]
+        users = 100
+    if args.db_sizes:
+        db_sizes = [int(size) for size in args.db_sizes.split(',')]
+    users = args.users or users
+
+    with tempfile.TemporaryDirectory() as directory:
+        builders = [
+            (("make_query", "format_data_model"), lambda: context_cases(context_sizes)),
+            (("make_trades",), lambda: trade_cases(position_sizes)),
+            (("db.",), lambda: db_cases(db_sizes, directory)),
+            (("giga_pipeline",), lambda: pipeline_cases(users, directory)),
+        ]
+        cases: dict[str, Case] = {}
+        for prefixes, build in builders:
+            # skip building (e.g. populating large databases) for unused cases
+            if args.only and not any(p in args.only or args.only in p for p in prefixes):
+                continue
+            for name, case in build().items():
+                if not args.only or args.only in name:
+                    cases[name] = case
+
+        results = []
+        for name, case in cases.items():
+            result = measure(name, case, args.repeat, args.min_time)
+            results.append(result)
+            if not args.compare:
+                print(f"{name:<50} {format_seconds(result.best):>10} (median {format_seconds(result.median)})")
+            tracer.reset() # the pipeline cases fill the shared tracer
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({r.name: r.model_dump() for r in results}, f, indent=2)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+from datetime import datetime, timedelta
+from typing import Optional
+import json
+import logging
+import os
+
+from pydantic import BaseModel
+
+from chadGPT.db import ActionTable, LazyAction, SQLiteDatabase, as_utc, get_current_utc_time
+from chadGPT.metrics import tracer
+
+# general workflow
+# 1. compact() finds the rows each RetentionPolicy no longer keeps in SQLite
+# 2. they are written (with their blobs inlined) to Parquet files partitioned
+#    as <archive_dir>/<category>/<YYYY-MM-DD>/part-<first id>-<last id>.parquet
+# 3. only then are the rows deleted and unreferenced blobs collected, so a
+#    crash in between leaves a row in both places, and the next compact()
+#    may archive it again in a differently named file (read() and
+#    read_archive() return every id once)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(BaseModel):
+    category: str
+    keep_latest: Optional[int] = None # records per user kept in SQLite
+    keep_days: Optional[int] = None # records newer than this are kept in SQLite
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Archiving ActionTable history requires pyarrow") from e
+    return pyarrow, pyarrow.parquet
+
+
+class ActionArchive:
+    """
+    Keeps the ActionTable small by moving the records that the retention
+    policies no longer keep into date-partitioned Parquet files, and reads
+    records across the hot table and the archive. Categories without a
+    policy are never archived. A record is kept while it is one of its
+    user's keep_latest newest records of the category or younger than
+    keep_days.
+    """
+    def __init__(
+        self,
+        db: SQLiteDatabase,
+        archive_dir: str,
+        policies: list[RetentionPolicy],
+        batch_size: int = 10_000,
+    ):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.policies = policies
+        self.batch_size = batch_size
+
+    def expired_ids(self, policy: RetentionPolicy, now: datetime) -> list[int]:
+        from sqlmodel import Session, func, select
+        rank = func.row_number().over(
+            partition_by=ActionTable.user, order_by=ActionTable.id.desc()
+        ).label('rank')
+        ranked = (
+            select(ActionTable.id, ActionTable.timestamp, rank)
+            .where(ActionTable.category == policy.category)
+            .subquery()
+        )
+        conditions = []
+        if policy.keep_latest is not None:
+            conditions.append(ranked.c.rank > policy.keep_latest)
+        if policy.keep_days is not None:
+            cutoff = as_utc(now) - timedelta(days=policy.keep_days)
+            conditions.append(ranked.c.timestamp < cutoff)
+        if not conditions:
+            return []
+        with Session(self.db.engine) as session:
+            query = select(ranked.c.id).where(*conditions).order_by(ranked.c.id)
+            return list(session.exec(query).all())
+
+    def compact(self, now: datetime | None = None) -> int:
+        """
+        Archive and delete the expired records of every policy's category.
+        :return: The number of records archived.
+        """
+        from sqlmodel import Session, select
+        now = now or get_current_utc_time()
+        archived = 0
+        with tracer.span('archive.compact') as span:
+            for policy in self.policies:
+                ids = self.expired_ids(policy, now)
+                for start in range(0, len(ids), self.batch_size):
+                    batch = ids[start:start + self.batch_size]
+                    with Session(self.db.engine) as session:
+                        records = session.exec(
+                            select(ActionTable).where(ActionTable.id.in_(batch))
+                        ).all()
+                    self.write_partitions(policy.category, records)
+                    archived += self.db.delete(batch)
+            if archived:
+                blobs = self.db.collect_blobs()
+                logger.info(f"Archived {archived} records and removed {blobs} unused blobs")
+            span['records'] = archived
+        return archived
+
+    def write_partitions(self, category: str, records: list[ActionTable]) -> None:
+        pa, pq = import_pyarrow()
+        days: dict[str, list[ActionTable]] = {}
+        for record in records:
+            days.setdefault(as_utc(record.timestamp).date().isoformat(), []).append(record)
+
+        for day, day_records in days.items():
+            directory = os.path.join(self.archive_dir, category, day)
+            os.makedirs(directory, exist_ok=True)
+            table = pa.table({
+                'id': pa.array([r.id for r in day_records], pa.int64()),
+                'user': pa.array([r.user for r in day_records], pa.string()),
+                'timestamp': pa.array(
+                    [as_utc(r.timestamp) for r in day_records],
+                    pa.timestamp('us', tz='UTC')
+                ),
+                # blobs are inlined so the archive does not depend on the BlobTable
+                'action': pa.array([
+                    json.dumps(LazyAction(r.action or {}, self.db.read_blob).resolve())
+                    for r in day_records
+                ], pa.string()),
+            })
+            # named by id range, so archiving a batch again overwrites the same file
+            file_name = f"part-{day_records[0].id}-{day_records[-1].id}.parquet"
+            temp_path = os.path.join(directory, f".{file_name}.tmp")
+            pq.write_table(table, temp_path, compression='zstd')
+            os.replace(temp_path, os.path.join(directory, file_name))
+
+    def read_archive(
+        self,
+        user: str | None = None,
+        category: str | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ) -> list[ActionTable]:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        _, pq = import_pyarrow()
+        categories = [category] if category else sorted(os.listdir(self.archive_dir))
+        records = []
+        seen_ids: set[int] = set()
+        for archived_category in categories:
+            category_dir = os.path.join(self.archive_dir, archived_category)
+            if not os.path.isdir(category_dir):
+                continue
+            for day in sorted(os.listdir(category_dir)):
+                # skip whole partitions outside the time range
+                if start and day < as_utc(start).date().isoformat():
+                    continue
+                if end and day > as_utc(end).date().isoformat():
+                    continue
+                day_dir = os.path.join(category_dir, day)
+                for file_name in sorted(os.listdir(day_dir)):
+                    if not file_name.endswith('.parquet'):
+                        continue
+                    table = pq.read_table(
+                        os.path.join(day_dir, file_name),
+                        filters=[('user', '==', user)] if user else None
+                    )
+                    for row in table.to_pylist():
+                        # rows archived again after a crash are in two files
+                        if row['id'] in seen_ids:
+                            continue
+                        if start and row['timestamp'] < as_utc(start):
+                            continue
+                        if end and row['timestamp'] >= as_utc(end):
+                            continue
+                        seen_ids.add(row['id'])
+                        records.append(ActionTable(
+                            id=row['id'], user=row['user'], category=archived_category,
+                            timestamp=row['timestamp'],
+                            action=json.loads(row['action'])
+                        ))
+        return records
+
+    def read(
+        self,
+        user: str | None = None,
+        category: str | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ) -> list[ActionTable]:
+        """
+        Records from both the hot table and the archive, ordered by id.
+        :param user: Only this user's records.
+        :param category: Only records of this category.
+        :param start: Only records at or after this time.
+        :param end: Only records before this time.
+        """
+        from sqlmodel import Session, select
+        filters = []
+        if user is not None:
+            filters.append(ActionTable.user == user)
+        if category is not None:
+            filters.append(ActionTable.category == category)
+        if start is not None:
+            filters.append(ActionTable.timestamp >= as_utc(start))
+        if end is not None:
+            filters.append(ActionTable.timestamp < as_utc(end))
+
+        with tracer.span('archive.read') as span:
+            with Session(self.db.engine) as session:
+                hot = session.exec(select(ActionTable).where(*filters)).all()
+            for record in hot:
+                record.action = LazyAction(record.action or {}, self.db.read_blob)
+            hot_ids = {record.id for record in hot}
+            # a record archived just before a crash can also still be hot
+            archived = [
+                record for record in self.read_archive(user, category, start, end)
+                if record.id not in hot_ids
+            ]
+            span['records'] = len(hot) + len(archived)
+            return sorted([*archived, *hot], key=lambda record: record.id)
@@ -0,0 +1,193 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable
+import logging
+
+from pydantic import BaseModel
+
+from chadGPT.brain import BaseLLM
+from chadGPT.data_models import Fill, Preferences, Stock, StockBar, TradeOrder
+from chadGPT.db import BaseDatabase, SQLiteDatabase
+from chadGPT.giga import Giga
+from chadGPT.trader import BaseBroker, BaseMarketResearch, SimulatedBroker
+
+# Backtesting replays Giga over historical bars on a simulated clock:
+# 1. advance the clock to the next bar time
+# 2. fill pending orders and apply stop-loss/take-profit rules on the new bars
+# 3. run the strategy / portfolio update jobs that are due at that time
+# 4. mark the portfolio to market (equity curve)
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedClock:
+    def __init__(self, start: datetime):
+        self.time = start
+
+    def now(self) -> datetime:
+        return self.time
+
+    def set(self, time: datetime) -> None:
+        if time < self.time:
+            raise ValueError(f"Clock cannot go back in time: {time} < {self.time}")
+        self.time = time
+
+
+class HistoricalMarket(BaseMarketResearch):
+    """
+    Market research backed by a historical bar dataset. Bars are stamped at
+    their close, and nothing after the clock's current time is visible.
+    """
+    def __init__(self, bars: list[StockBar], clock: SimulatedClock):
+        self.clock = clock
+        self.bars: dict[str, list[StockBar]] = defaultdict(list)
+        for bar in sorted(bars, key=lambda b: b.time):
+            self.bars[bar.symbol].append(bar)
+        self.times = {
+            symbol: [bar.time for bar in symbol_bars]
+            for symbol, symbol_bars in self.bars.items()
+        }
+
+    def get_current_value(self, symbol: str) -> Stock | None:
+        index = bisect_right(self.times.get(symbol, []), self.clock.now())
+        if index == 0:
+            return None
+        bar = self.bars[symbol][index - 1]
+        return Stock(symbol=symbol, price=bar.close, time=bar.time)
+
+    def get_historic_value(
+        self, symbol: str, start: datetime, end: datetime, aggregation: str
+    ) -> list[StockBar]:
+        # bars are returned at the dataset's own resolution
+        times = self.times.get(symbol, [])
+        end = min(end, self.clock.now())
+        return self.bars[symbol][bisect_left(times, start):bisect_right(times, end)]
+
+
+def period_key(time: datetime, frequency: str) -> tuple:
+    """
+    Identifies the scheduling period a time falls in; a job is due whenever
+    the period changes.
+    """
+    if frequency == 'hourly':
+        return (time.date(), time.hour)
+    if frequency == 'daily':
+        return (time.date(),)
+    if frequency == 'weekly':
+        return tuple(time.isocalendar())[:2]
+    if frequency == 'monthly':
+        return (time.year, time.month)
+    raise ValueError(f"invalid frequency: {frequency}")
+
+
+class EquityPoint(BaseModel):
+    time: datetime
+    cash: float
+    total_value: float
+
+
+class BacktestResult(BaseModel):
+    equity_curve: list[EquityPoint]
+    trades: list[TradeOrder] # every order the pipeline submitted, in order
+    fills: list[Fill] = [] # filled by a SimulatedBroker
+    strategy_updates: int
+    portfolio_updates: int
+
+    @property
+    def total_return(self) -> float:
+        if not self.equity_curve or self.equity_curve[0].total_value == 0:
+            return 0.0
+        return self.equity_curve[-1].total_value / self.equity_curve[0].total_value - 1
+
+
+class Backtest:
+    """
+    Replays Giga over bars. The broker is built by broker_factory from the
+    historical market and the simulated clock, so it can price and stamp
+    its fills without seeing the future; by default it is a SimulatedBroker
+    with starting_cash and slippage_pct.
+    """
+    def __init__(
+        self,
+        bars: list[StockBar],
+        research_brain: BaseLLM,
+        broker_factory: Callable[
+            [BaseMarketResearch, Callable[[], datetime]], BaseBroker
+        ] | None = None,
+        portfolio_update_brain: BaseLLM | None = None,
+        user_preferences: Preferences = Preferences(),
+        starting_cash: float = 100_000.0,
+        slippage_pct: float = 0.0,
+        db: BaseDatabase | None = None,
+        user: str = "backtest_user",
+    ):
+        if not bars:
+            raise ValueError("Backtest requires at least one bar")
+        self.bars_by_time: dict[datetime, list[StockBar]] = defaultdict(list)
+        for bar in bars:
+            self.bars_by_time[bar.time].append(bar)
+        self.times = sorted(self.bars_by_time)
+        self.clock = SimulatedClock(self.times[0])
+        self.market = HistoricalMarket(bars, self.clock)
+        if broker_factory is None:
+            self.broker = SimulatedBroker(
+                self.market, cash=starting_cash, clock=self.clock.now,
+                slippage_pct=slippage_pct
+            )
+        else:
+            self.broker = broker_factory(self.market, self.clock.now)
+        self.user_preferences = user_preferences
+        self.giga = Giga(
+            broker=self.broker,
+            market=self.market,
+            portfolio_update_brain=portfolio_update_brain or research_brain,
+            research_brain=research_brain,
+            user_preferences=user_preferences,
+            db=db or SQLiteDatabase("sqlite://"),
+            user=user,
+            clock=self.clock.now,
+        )
+
+    def run(self) -> BacktestResult:
+        equity_curve: list[EquityPoint] = []
+        trades: list[TradeOrder] = []
+        strategy = None
+        strategy_period = portfolio_period = None
+        strategy_updates = portfolio_updates = 0
+
+        for time in self.times:
+            self.clock.set(time)
+            if isinstance(self.broker, SimulatedBroker):
+                self.broker.process_bars(self.bars_by_time[time])
+
+            period = period_key(time, self.user_preferences.strategy_update_frequency)
+            if period != strategy_period:
+                strategy_period = period
+                strategy = self.giga.generate_strategy()
+                strategy_updates += 1
+
+            period = period_key(time, self.user_preferences.portfolio_update_frequency)
+            if period != portfolio_period:
+                portfolio_period = period
+                trades.extend(self.giga.update_portfolio_pipeline(strategy=strategy))
+                portfolio_updates += 1
+
+            portfolio = self.broker.get_portfolio()
+            equity_curve.append(EquityPoint(
+                time=time, cash=portfolio.cash, total_value=portfolio.total_value
+            ))
+
+        fills = self.broker.fills if isinstance(self.broker, SimulatedBroker) else []
+        logger.info(
+            f"Backtest finished: {len(self.times)} steps, " +
+            f"{len(trades)} trades, {len(fills)} fills"
+        )
+        return BacktestResult(
+            equity_curve=equity_curve,
+            trades=trades,
+            fills=fills,
+            strategy_updates=strategy_updates,
+            portfolio_updates=portfolio_updates,
+        )
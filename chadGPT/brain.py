@@ -1,19 +1,28 @@
 from abc import ABC, abstractmethod
-from typing import Literal
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Literal
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 
 from openai import OpenAI
 from pydantic import BaseModel
 import pyperclip
 
-from chadGPT.data_models import LLMRequest, Portfolio
+from chadGPT.data_models import ContextItem, LLMRequest, Portfolio
 from chadGPT.environment_setup import is_environment_ready
+from chadGPT.metrics import tracer
 
 
 logger = logging.getLogger(__name__)
 
+CHARS_PER_TOKEN = 4
+MIN_TRUNCATED_TOKENS = 16 # smaller remainders are dropped entirely
+
 
 def apply_delimiter(
     block_name: str, query: str, delimiter_type: Literal['<html>', 'caps:']
@@ -47,6 +56,84 @@ def format_data_model(model: BaseModel | str | list[BaseModel | str]) -> str:
     return query
 
 
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local estimate of the token count of text (~4 characters per token).
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    marker = " ...[truncated]"
+    max_chars = max_tokens * CHARS_PER_TOKEN - len(marker)
+    if max_chars <= 0:
+        return ""
+    return text[:max_chars] + marker
+
+
+def assemble_context(
+    context: list[ContextItem | BaseModel | str] | str | None,
+    token_budget: int | None = None
+) -> str:
+    """
+    Format the context items, pruning the lowest priority items first
+    (summary, then truncation, then removal) until they fit the token budget.
+    """
+    if context is None:
+        context = []
+    if isinstance(context, str):
+        items = [ContextItem(content=context)]
+    else:
+        items = [
+            c if isinstance(c, ContextItem) else ContextItem(content=c)
+            for c in context
+        ]
+    texts = [format_data_model(item.content) for item in items]
+    original_tokens = [estimate_tokens(t) for t in texts]
+    tokens = list(original_tokens)
+
+    def total() -> int:
+        # account for the ",\n" separators between items
+        return sum(tokens) + max(len([t for t in texts if t]) - 1, 0)
+
+    if token_budget is not None:
+        # lowest priority first; later items go first within a priority
+        order = sorted(
+            range(len(items)), key=lambda i: (items[i].priority, -i)
+        )
+        for i in order:
+            if total() <= token_budget:
+                break
+            summary = items[i].summary
+            if summary is not None and estimate_tokens(summary) < tokens[i]:
+                texts[i] = summary
+                tokens[i] = estimate_tokens(summary)
+            overflow = total() - token_budget
+            if overflow <= 0:
+                continue
+            keep = tokens[i] - overflow
+            if keep >= MIN_TRUNCATED_TOKENS:
+                texts[i] = truncate_to_tokens(texts[i], keep)
+            else:
+                texts[i] = ""
+            tokens[i] = estimate_tokens(texts[i])
+
+    for i, item in enumerate(items):
+        logger.debug(
+            f"Context item {i} (priority {item.priority}): " +
+            f"{original_tokens[i]} -> {tokens[i]} tokens"
+        )
+    logger.debug(
+        f"Context tokens: {sum(original_tokens)} -> {total()} " +
+        f"(budget: {token_budget})"
+    )
+
+    texts = [t for t in texts if t]
+    if isinstance(context, str):
+        return texts[0] if texts else ""
+    return "{\n" + ",\n".join(texts) + "\n}"
+
+
 class BaseLLM(ABC):
 
     @abstractmethod
@@ -56,52 +143,63 @@ class BaseLLM(ABC):
     @staticmethod
     def make_query(request: LLMRequest) -> str:
         # unpack the query
-        query = ""
-        query += apply_delimiter(
+        background = apply_delimiter(
             block_name='background',
             query=request.background,
             delimiter_type='<html>'
         )
-        if isinstance(request.context,str):
-            query += apply_delimiter(
-                block_name='context',
-                query=request.context,
-                delimiter_type='<html>'
-            )
-        else:
-            query += apply_delimiter(
-                block_name='context',
-                query=format_data_model(request.context),
-                delimiter_type='<html>'
-            )
-        
-        query += f"\n<prompt> {request.prompt} </prompt>\n"
+        prompt = f"\n<prompt> {request.prompt} </prompt>\n"
 
+        expected_format = ""
         if request.expected_format is not None:
 
             expected_response = f"Please return an answer matching the below format (given by the pydantic basemodel.model_json_schema() function):\n"
             expected_response += f"{json.dumps(request.expected_format.model_json_schema(), indent=2)}"
-            query += apply_delimiter(
+            expected_format = apply_delimiter(
                 block_name='expected_format',
                 query=expected_response,
                 delimiter_type='<html>'
             )
-        
-        return query
+
+        # the context gets whatever is left of the budget after the static blocks
+        context_budget = None
+        if request.token_budget is not None:
+            static_tokens = estimate_tokens(
+                background + prompt + expected_format +
+                apply_delimiter('context', '', '<html>')
+            )
+            context_budget = max(request.token_budget - static_tokens, 0)
+
+        context = apply_delimiter(
+            block_name='context',
+            query=assemble_context(request.context, context_budget),
+            delimiter_type='<html>'
+        )
+
+        if request.layout == 'cache_friendly':
+            # most widely shared blocks first, per-run context last
+            return expected_format + background + prompt + context
+        return background + context + prompt + expected_format
 
 
     def ask(self, request: LLMRequest) -> str | BaseModel:
-        query = self.make_query(request)
-        answer = self.submit_query(query)
+        with tracer.span('llm.make_query') as span:
+            query = self.make_query(request)
+            span['prompt_chars'] = len(query)
+            span['prompt_tokens'] = estimate_tokens(query)
+        with tracer.span('llm.submit_query', llm=self.__class__.__name__) as span:
+            answer = self.submit_query(query)
+            span['response_chars'] = len(answer)
 
         if request.expected_format:
-            # read answer into dictionary
-            logger.debug(f"Received answer: {answer}")
-            answer = json.loads(answer)
+            with tracer.span('llm.parse'):
+                # read answer into dictionary
+                logger.debug(f"Received answer: {answer}")
+                answer = json.loads(answer)
 
-            # unpack answer into object
-            answer = request.expected_format(**answer)
-            assert isinstance(answer, request.expected_format)
+                # unpack answer into object
+                answer = request.expected_format(**answer)
+                assert isinstance(answer, request.expected_format)
 
         return answer
 
@@ -145,8 +243,12 @@ class OpenAILLM(BaseLLM):
     def ask(self, request: LLMRequest) -> str | BaseModel:
         expected_format = request.expected_format
         request.expected_format = None  # remove expected format for the query
-        query = self.make_query(request)
-        answer = self.submit_query(query, expected_format)
+        with tracer.span('llm.make_query') as span:
+            query = self.make_query(request)
+            span['prompt_chars'] = len(query)
+            span['prompt_tokens'] = estimate_tokens(query)
+        with tracer.span('llm.submit_query', llm=self.__class__.__name__):
+            answer = self.submit_query(query, expected_format)
 
         if request.expected_format:
             # read answer into dictionary
@@ -184,6 +286,222 @@ class OpenAILLM(BaseLLM):
         answer = getattr(response, output_name, '')
         return answer
 
+class BackendStats:
+    """
+    Rolling latency/failure statistics for one backend of a RoutedLLM.
+    """
+    def __init__(self, window: int):
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.degraded_until = 0.0
+
+    def percentile(self, q: float) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(int(q * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+
+class RoutedLLM(BaseLLM):
+    """
+    Composite LLM that routes each request to a list of backends, ordered by
+    preference (e.g. primary model first, cheaper fallback models after).
+
+    The request goes to the first healthy backend. If it has not answered
+    after the hedge_percentile of its recent latencies, a hedged duplicate
+    goes to the next backend, and so on. The first valid (parsed) response
+    wins and the losers are cancelled (their results are ignored if they
+    are already running). Backends with repeated failures or a tail latency
+    above degraded_latency are moved behind the healthy ones for cooldown
+    seconds. Calls run on one thread pool of max_workers threads (by default
+    four per backend), shared by all requests.
+    """
+    def __init__(
+        self,
+        backends: list[BaseLLM],
+        hedge_percentile: float = 0.95,
+        initial_hedge_delay: float = 30.0,
+        min_samples: int = 20,
+        window: int = 100,
+        max_consecutive_failures: int = 3,
+        degraded_latency: float | None = None,
+        cooldown: float = 300.0,
+        max_workers: int | None = None,
+    ):
+        if not backends:
+            raise ValueError("RoutedLLM requires at least one backend")
+        if min_samples < 1:
+            raise ValueError("min_samples must be at least 1")
+        self.backends = backends
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        self.max_consecutive_failures = max_consecutive_failures
+        self.degraded_latency = degraded_latency
+        self.cooldown = cooldown
+        self.stats = [BackendStats(window) for _ in backends]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or 4 * len(backends),
+            thread_name_prefix="routed-llm"
+        )
+
+    def is_degraded(self, index: int) -> bool:
+        with self._lock:
+            return time.monotonic() < self.stats[index].degraded_until
+
+    def route(self) -> list[int]:
+        """
+        Backend indices in the order they should be tried.
+        """
+        indices = range(len(self.backends))
+        healthy = [i for i in indices if not self.is_degraded(i)]
+        degraded = [i for i in indices if self.is_degraded(i)]
+        return healthy + degraded
+
+    def hedge_delay(self, index: int) -> float:
+        with self._lock:
+            stats = self.stats[index]
+            if len(stats.latencies) < self.min_samples:
+                return self.initial_hedge_delay
+            return stats.percentile(self.hedge_percentile)
+
+    def record(self, index: int, latency: float, success: bool) -> None:
+        with self._lock:
+            stats = self.stats[index]
+            if success:
+                stats.latencies.append(latency)
+                stats.consecutive_failures = 0
+            else:
+                stats.consecutive_failures += 1
+
+            too_many_failures = (
+                stats.consecutive_failures >= self.max_consecutive_failures
+            )
+            tail_latency = stats.percentile(self.hedge_percentile)
+            too_slow = (
+                self.degraded_latency is not None
+                and len(stats.latencies) >= self.min_samples
+                and tail_latency is not None
+                and tail_latency > self.degraded_latency
+            )
+            if too_many_failures or too_slow:
+                logger.warning(
+                    f"Backend {index} ({self.backends[index].__class__.__name__}) " +
+                    f"degraded for {self.cooldown}s"
+                )
+                stats.degraded_until = time.monotonic() + self.cooldown
+                stats.consecutive_failures = 0
+                stats.latencies.clear()
+
+    def _timed_call(self, index: int, call: Callable[[BaseLLM], Any]) -> Any:
+        start = time.monotonic()
+        try:
+            result = call(self.backends[index])
+        except Exception:
+            self.record(index, time.monotonic() - start, success=False)
+            raise
+        self.record(index, time.monotonic() - start, success=True)
+        return result
+
+    def _hedged(self, call: Callable[[BaseLLM], Any]) -> Any:
+        order = self.route()
+        pending: dict[Future, int] = {}
+        errors: list[Exception] = []
+        launched = 0
+        last_launch = 0.0
+
+        def launch():
+            nonlocal launched, last_launch
+            index = order[launched]
+            launched += 1
+            last_launch = time.monotonic()
+            logger.debug(f"Sending request to backend {index}")
+            pending[self._executor.submit(self._timed_call, index, call)] = index
+
+        try:
+            launch()
+            while pending:
+                timeout = None
+                if launched < len(order):
+                    elapsed = time.monotonic() - last_launch
+                    timeout = max(self.hedge_delay(order[launched - 1]) - elapsed, 0)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    logger.debug("Hedge delay exceeded, sending duplicate request")
+                    launch()
+                    continue
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        logger.warning(f"Backend {index} failed: {e}")
+                        errors.append(e)
+                # replace failed attempts right away
+                if launched < len(order):
+                    launch()
+            raise RuntimeError(f"All LLM backends failed: {errors}")
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self) -> None:
+        """
+        Stop the thread pool; calls still running are left to finish.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit_query(self, query: str) -> str:
+        def call(backend: BaseLLM) -> str:
+            answer = backend.submit_query(query)
+            if not answer or not answer.strip():
+                raise ValueError("Empty answer")
+            return answer
+
+        return self._hedged(call)
+
+    def ask(self, request: LLMRequest) -> str | BaseModel:
+        # each backend parses its own answer; copies keep concurrent backends
+        # from seeing each other's changes to the request
+        return self._hedged(lambda backend: backend.ask(request.model_copy()))
+
+
+class CachedLLM(BaseLLM):
+    """
+    Caches answers by query so repeated runs (e.g. backtests) replay earlier
+    answers instead of paying for new LLM calls. Without an inner LLM it is
+    replay-only and raises KeyError on a cache miss. The cache is persisted
+    as JSON when cache_path is given.
+    """
+    def __init__(self, inner: BaseLLM | None = None, cache_path: str | None = None):
+        self.inner = inner
+        self.cache_path = cache_path
+        self.cache: dict[str, str] = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.cache = json.load(f)
+
+    @staticmethod
+    def cache_key(query: str) -> str:
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def submit_query(self, query: str) -> str:
+        key = self.cache_key(query)
+        if key in self.cache:
+            return self.cache[key]
+        if self.inner is None:
+            raise KeyError(f"No cached answer for query {key}")
+
+        answer = self.inner.submit_query(query)
+        self.cache[key] = answer
+        if self.cache_path is not None:
+            with open(self.cache_path, 'w') as f:
+                json.dump(self.cache, f)
+        return answer
+
+
 if __name__ == "__main__":
     # test the consoleLLM
     # llm = ConsoleLLM()
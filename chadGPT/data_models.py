@@ -13,15 +13,31 @@ class Preferences(BaseModel):
     max_take_profit_percent: float = 0.15
     max_stop_loss_percent: float = 0.10
     max_portfolio_size: int = 15
+    prompt_token_budget: Optional[int] = None
+    prompt_layout: Literal['default', 'cache_friendly'] = 'default'
+    skip_unchanged_portfolio_updates: bool = False
+    price_move_threshold: float = 0.01 # relative price move since last update
+    weight_drift_threshold: float = 0.02 # drift from the last target weights
+    resume_max_age_minutes: int = 60 # older unfinished portfolio updates are abandoned
+    max_resume_attempts: int = 3 # a run that keeps failing is abandoned after this
     trade_type: Literal['paper', 'live'] = 'paper'
 
 
 # brain related data models (LLM)
+class ContextItem(BaseModel):
+    content: BaseModel | str | list[BaseModel | str]
+    priority: int = 0 # lower priority items are pruned first
+    summary: Optional[str] = None # used in place of content when pruned
+
+
 class LLMRequest(BaseModel):
     prompt: str
     background: Optional[str]
-    context: Optional[list[BaseModel | str] | str]
+    context: Optional[list[ContextItem | BaseModel | str] | str]
     expected_format: Optional[Type[BaseModel]]
+    token_budget: Optional[int] = None # estimated tokens for the whole query
+    # cache_friendly puts the static blocks first so queries share a prefix
+    layout: Literal['default', 'cache_friendly'] = 'default'
 
 
 class StrategyResponse(BaseModel):
@@ -33,11 +49,15 @@ class StrategyResponse(BaseModel):
 class Task(BaseModel):
     func: Callable # output should be a tuple
     args: tuple | None = None
+    name: str | None = None # required to be referenced in depends_on
+    depends_on: list[str] = [] # outputs of these tasks are appended to args
 
 
 class Job(BaseModel):
     schedule: str # cron schedule syntax see https://crontab.guru/
+    name: str | None = None # identifies the job across scheduler processes
     tasks: list[Task] # each sequential task should be unloaded into the next
+                      # (unless tasks declare depends_on, making a DAG)
 
 
 # trade related data models
@@ -70,6 +90,16 @@ class TradeOrder(BaseModel):
     amount: float
     trade_time: Optional[datetime]
     rules: Rule
+    client_order_id: Optional[str] = None # idempotency key for the broker
+
+
+class Fill(BaseModel):
+    type: Literal['buy', 'sell']
+    symbol: str
+    shares: float
+    price: float
+    time: datetime
+    reason: Literal['order', 'stop_loss', 'take_profit'] = 'order'
 
 
 class Position(BaseModel):
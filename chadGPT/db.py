@@ -1,15 +1,30 @@
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
-from typing import Literal, Optional
+from functools import lru_cache
+from typing import Any, Callable, Iterator, Literal, Optional
+import hashlib
+import json
+import zlib
 
 
+from pydantic import BaseModel
 from sqlmodel import Field, SQLModel
 from sqlalchemy import Column, JSON
 
+from chadGPT.metrics import tracer
+
 def get_current_utc_time() -> datetime:
     return datetime.now(timezone.utc)
 
+def as_utc(timestamp: datetime) -> datetime:
+    # naive datetimes are taken to be UTC, as they are stored
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
 class ActionTable(SQLModel, table=True):
+    # ids are never reused, so archived rows keep unique ids
+    __table_args__ = {'sqlite_autoincrement': True}
     id: int = Field(default=None, primary_key=True)
     user: str = Field(index=True)
     timestamp: datetime = Field(default_factory=get_current_utc_time)
@@ -17,14 +32,141 @@ class ActionTable(SQLModel, table=True):
     action: dict = Field(sa_column=Column(JSON))
 
 
+class BlobTable(SQLModel, table=True):
+    hash: str = Field(primary_key=True) # sha256 of the uncompressed JSON
+    data: bytes # zlib compressed JSON
+    size: int # uncompressed bytes
+
+
+class TradeIndexTable(SQLModel, table=True):
+    # one row per trade in a 'trades' action, for analytics queries
+    id: int = Field(default=None, primary_key=True)
+    action_id: int = Field(index=True)
+    user: str = Field(index=True)
+    timestamp: datetime = Field(index=True)
+    symbol: str = Field(index=True)
+    type: str # buy or sell
+    amount: float # shares
+
+
+BLOB_KEY = '$blob'
+
+# action fields with an expression index (looked up by read_matching)
+INDEXED_ACTION_FIELDS = ('run_id',)
+
+
+def action_field_sql(field: str) -> str:
+    # the path is inlined (not bound) so SQLite can use the expression index
+    if not field.isidentifier():
+        raise ValueError(f"Invalid action field: {field}")
+    return f"json_extract(action, '$.{field}')"
+
+Period = Literal['day', 'week', 'month']
+# weeks are ISO weeks (e.g. 2024-W01), so a week spanning New Year is one bucket
+PERIOD_FORMATS = {'day': '%Y-%m-%d', 'week': '%G-W%V', 'month': '%Y-%m'}
+
+
+class TradeActivity(BaseModel):
+    user: str
+    period: str
+    trades: int
+    buys: int
+    sells: int
+    turnover: float # shares bought and sold
+
+
+class SymbolExposure(BaseModel):
+    symbol: str
+    period: str
+    net_shares: float # shares bought minus sold up to the end of the period
+
+
+class StrategyChanges(BaseModel):
+    user: str
+    period: str
+    strategies: int # strategy records written
+    changes: int # records whose response differs from the previous one
+
+
+def period_label(timestamp: datetime, period: Period) -> str:
+    return timestamp.strftime(PERIOD_FORMATS[period])
+
+
+def period_label_sql(period: Period, column):
+    """
+    SQL expression for period_label of a timestamp column.
+    """
+    from sqlmodel import Integer, cast, func
+    if period != 'week':
+        return func.strftime(PERIOD_FORMATS[period], column)
+    # SQLite's strftime has no %G/%V: an ISO week belongs to the year of its
+    # Thursday and is numbered by that Thursday's day of the year
+    thursday = func.date(column, '-3 days', 'weekday 4')
+    week = (cast(func.strftime('%j', thursday), Integer) - 1) / 7 + 1
+    return func.printf('%s-W%02d', func.strftime('%Y', thursday), week)
+
+
+def in_range(timestamp: datetime, start: Optional[datetime], end: Optional[datetime]) -> bool:
+    return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and BLOB_KEY in value
+
+
+def encode_blob(value: Any) -> tuple[str, bytes, int]:
+    payload = json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha256(payload).hexdigest(), zlib.compress(payload), len(payload)
+
+
+def decode_blob(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+class LazyAction(dict):
+    """
+    Action dict whose blob references ({"$blob": hash}) are loaded the
+    first time the key is accessed.
+    """
+    def __init__(self, data: dict, load_blob: Callable[[str], Any]):
+        super().__init__(data)
+        self._load_blob = load_blob
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if is_blob_ref(value):
+            value = self._load_blob(value[BLOB_KEY])
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def resolve(self) -> dict:
+        """
+        A plain dict with every blob loaded.
+        """
+        return dict(self.items())
+
+
 class BaseDatabase(ABC):
     @abstractmethod
-    def write(self, user: str, category: str, action: dict) -> None:
+    def write(
+        self, user: str, category: str, action: dict,
+        timestamp: Optional[datetime] = None
+    ) -> None:
         """
         Write an action to the database.
         :param user: The user performing the action.
         :param category: The category of the action.
         :param action: The action details as a dictionary.
+        :param timestamp: When the action happened (defaults to now).
         """
         pass
 
@@ -37,23 +179,435 @@ class BaseDatabase(ABC):
         """
         pass
 
+    def read_latest(self, **filters) -> Optional[ActionTable]:
+        """
+        Read the most recent action matching the filters.
+        :param filters: Filters to apply to the query.
+        :return: The latest matching ActionTable record, or None.
+        """
+        records = self.read(**filters)
+        return records[-1] if records else None
+
+    def read_matching(self, action_fields: dict, **filters) -> list[ActionTable]:
+        """
+        Read actions whose top-level action fields have the given values.
+        :param action_fields: Field name to value, e.g. {'run_id': run_id}.
+        :param filters: Column filters to apply to the query.
+        :return: A list of ActionTable records matching both.
+        """
+        return [
+            record for record in self.read(**filters)
+            if all(record.action.get(k) == v for k, v in action_fields.items())
+        ]
+
+    # ---- Analytics ----
+    # the defaults read every record into Python; databases override them
+    # to aggregate in the query instead
+
+    def trade_activity(
+        self, user: Optional[str] = None, period: Period = 'day',
+        start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[TradeActivity]:
+        """
+        Trade counts and turnover per user and period.
+        :param user: Only this user's trades (all users if None).
+        :param period: Group by 'day', 'week' or 'month'.
+        :param start: Only trades at or after this time.
+        :param end: Only trades before this time.
+        :return: TradeActivity rows ordered by user and period.
+        """
+        filters = {'category': 'trades'}
+        if user is not None:
+            filters['user'] = user
+        totals: dict[tuple[str, str], TradeActivity] = {}
+        for record in self.read(**filters):
+            if not in_range(record.timestamp, start, end):
+                continue
+            key = (record.user, period_label(record.timestamp, period))
+            activity = totals.setdefault(key, TradeActivity(
+                user=key[0], period=key[1], trades=0, buys=0, sells=0, turnover=0.0
+            ))
+            for trade in record.action.get('trades') or []:
+                activity.trades += 1
+                activity.buys += trade['type'] == 'buy'
+                activity.sells += trade['type'] == 'sell'
+                activity.turnover += trade['amount']
+        return iter([totals[key] for key in sorted(totals) if totals[key].trades])
+
+    def symbol_exposure(
+        self, user: Optional[str] = None, period: Period = 'day',
+        symbols: Optional[list[str]] = None
+    ) -> Iterator[SymbolExposure]:
+        """
+        Net shares traded per symbol, accumulated over time.
+        :param user: Only this user's trades (all users if None).
+        :param period: Group by 'day', 'week' or 'month'.
+        :param symbols: Only these symbols (all symbols if None).
+        :return: SymbolExposure rows ordered by symbol and period, one for
+            each period in which the symbol was traded.
+        """
+        filters = {'category': 'trades'}
+        if user is not None:
+            filters['user'] = user
+        net: dict[tuple[str, str], float] = {}
+        for record in self.read(**filters):
+            label = period_label(record.timestamp, period)
+            for trade in record.action.get('trades') or []:
+                if symbols is not None and trade['symbol'] not in symbols:
+                    continue
+                sign = 1 if trade['type'] == 'buy' else -1
+                key = (trade['symbol'], label)
+                net[key] = net.get(key, 0.0) + sign * trade['amount']
+        rows, running, previous_symbol = [], 0.0, None
+        for symbol, label in sorted(net):
+            if symbol != previous_symbol:
+                running, previous_symbol = 0.0, symbol
+            running += net[(symbol, label)]
+            rows.append(SymbolExposure(symbol=symbol, period=label, net_shares=running))
+        return iter(rows)
+
+    def strategy_changes(
+        self, user: Optional[str] = None, period: Period = 'week',
+        start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[StrategyChanges]:
+        """
+        How often each user's strategy changed.
+        :param user: Only this user's strategies (all users if None).
+        :param period: Group by 'day', 'week' or 'month'.
+        :param start: Only strategies written at or after this time.
+        :param end: Only strategies written before this time.
+        :return: StrategyChanges rows ordered by user and period.
+        """
+        filters = {'category': 'strategy'}
+        if user is not None:
+            filters['user'] = user
+        totals: dict[tuple[str, str], StrategyChanges] = {}
+        previous: dict[str, str] = {}
+        for record in sorted(self.read(**filters), key=lambda r: r.id):
+            response = json.dumps(record.action.get('response'), sort_keys=True)
+            changed = record.user in previous and previous[record.user] != response
+            previous[record.user] = response
+            if not in_range(record.timestamp, start, end):
+                continue
+            key = (record.user, period_label(record.timestamp, period))
+            changes = totals.setdefault(key, StrategyChanges(
+                user=key[0], period=key[1], strategies=0, changes=0
+            ))
+            changes.strategies += 1
+            changes.changes += changed
+        return iter([totals[key] for key in sorted(totals)])
+
 class SQLiteDatabase(BaseDatabase):
-    def __init__(self, db_url: str):
+    def __init__(self, db_url: str, blob_threshold: Optional[int] = 1024):
+        """
+        :param db_url: SQLAlchemy database URL.
+        :param blob_threshold: Action values whose JSON is longer than this
+            are stored compressed in the BlobTable, once per distinct value,
+            and referenced from the action by hash (None stores them inline).
+        """
+        from sqlalchemy import text
         from sqlmodel import create_engine, Session
         self.engine = create_engine(db_url)
+        self.blob_threshold = blob_threshold
+        # cache the compressed bytes; each access decodes a fresh copy
+        self._blob_data = lru_cache(maxsize=256)(self._read_blob_data)
         SQLModel.metadata.create_all(self.engine)
+        with Session(self.engine) as session:
+            for field in INDEXED_ACTION_FIELDS:
+                session.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_actiontable_{field} " +
+                    f"ON actiontable ({action_field_sql(field)})"
+                ))
+            session.commit()
 
-    def write(self, user: str, category: str, action: dict) -> None:
+    def write(
+        self, user: str, category: str, action: dict,
+        timestamp: Optional[datetime] = None
+    ) -> None:
         from sqlmodel import Session
-        with Session(self.engine) as session:
-            action_record = ActionTable(user=user, category=category, action=action)
+        with tracer.span('db.write', category=category), Session(self.engine) as session:
+            action_record = ActionTable(
+                user=user, category=category, action=self._store_blobs(session, action),
+                timestamp=timestamp or get_current_utc_time()
+            )
             session.add(action_record)
+            if category == 'trades':
+                session.flush() # assigns the id
+                self._index_trades(session, action_record, action.get('trades'))
             session.commit()
 
+    def _index_trades(self, session, record: ActionTable, trades: Any) -> None:
+        for trade in trades if isinstance(trades, list) else []:
+            session.add(TradeIndexTable(
+                action_id=record.id, user=record.user, timestamp=record.timestamp,
+                symbol=trade['symbol'], type=trade['type'], amount=trade['amount']
+            ))
+
+    def _store_blobs(self, session, action: dict) -> dict:
+        # replace large top-level values with blob references
+        if self.blob_threshold is None:
+            return action
+        from sqlalchemy.dialects.sqlite import insert
+        stored = {}
+        for key, value in action.items():
+            if isinstance(value, (str, dict, list)) and not is_blob_ref(value):
+                blob_hash, data, size = encode_blob(value)
+                if size > self.blob_threshold:
+                    session.execute(
+                        insert(BlobTable)
+                        .values(hash=blob_hash, data=data, size=size)
+                        .on_conflict_do_nothing()
+                    )
+                    value = {BLOB_KEY: blob_hash}
+            stored[key] = value
+        return stored
+
+    def _read_blob_data(self, blob_hash: str) -> bytes:
+        from sqlmodel import Session
+        with tracer.span('db.read_blob'), Session(self.engine) as session:
+            blob = session.get(BlobTable, blob_hash)
+            if blob is None:
+                raise KeyError(f"Missing blob {blob_hash}")
+            return blob.data
+
+    def read_blob(self, blob_hash: str) -> Any:
+        """
+        Load a value stored in the BlobTable.
+        :param blob_hash: The hash from the {"$blob": hash} reference.
+        :return: The stored value.
+        """
+        return decode_blob(self._blob_data(blob_hash))
+
+    def _lazy(self, record: ActionTable) -> ActionTable:
+        record.action = LazyAction(record.action or {}, self.read_blob)
+        return record
+
     def read(self, **filters) -> list[ActionTable]:
         from sqlmodel import select, Session
         # make filters into where statements (key == value)
         actual_filters = (getattr(ActionTable, k) == v for k, v in filters.items())
-        with Session(self.engine) as session:
+        with tracer.span('db.read') as span, Session(self.engine) as session:
             query = select(ActionTable).where(*actual_filters)
-            return session.exec(query).all()
+            records = session.exec(query).all()
+            span['records'] = len(records)
+            return [self._lazy(record) for record in records]
+
+    def read_latest(self, **filters) -> Optional[ActionTable]:
+        from sqlmodel import select, Session
+        actual_filters = (getattr(ActionTable, k) == v for k, v in filters.items())
+        with tracer.span('db.read_latest'), Session(self.engine) as session:
+            query = (
+                select(ActionTable).where(*actual_filters)
+                .order_by(ActionTable.id.desc()).limit(1)
+            )
+            record = session.exec(query).first()
+            return self._lazy(record) if record is not None else None
+
+    def read_matching(self, action_fields: dict, **filters) -> list[ActionTable]:
+        from sqlalchemy import text
+        from sqlmodel import select, Session
+        conditions = [getattr(ActionTable, k) == v for k, v in filters.items()]
+        for i, (field, value) in enumerate(action_fields.items()):
+            # only values stored inline match (small values never become blobs)
+            conditions.append(
+                text(f"{action_field_sql(field)} = :value_{i}").bindparams(**{f"value_{i}": value})
+            )
+        with tracer.span('db.read_matching') as span, Session(self.engine) as session:
+            query = select(ActionTable).where(*conditions).order_by(ActionTable.id)
+            records = session.exec(query).all()
+            span['records'] = len(records)
+            return [self._lazy(record) for record in records]
+
+    def delete(self, ids: list[int]) -> int:
+        """
+        Delete actions by id (e.g. once they are archived).
+        :param ids: The ids of the ActionTable records to delete.
+        :return: The number of records deleted.
+        """
+        from sqlmodel import Session, delete
+        deleted = 0
+        with tracer.span('db.delete') as span, Session(self.engine) as session:
+            for start in range(0, len(ids), 500): # stay below SQLite's variable limit
+                result = session.execute(
+                    delete(ActionTable).where(ActionTable.id.in_(ids[start:start + 500]))
+                )
+                deleted += result.rowcount
+            session.commit()
+            span['records'] = deleted
+        return deleted
+
+    def collect_blobs(self) -> int:
+        """
+        Delete blobs that no action references any more.
+        :return: The number of blobs deleted.
+        """
+        from sqlalchemy import text
+        from sqlmodel import Session
+        with tracer.span('db.collect_blobs'), Session(self.engine) as session:
+            result = session.execute(text(f"""
+                DELETE FROM blobtable WHERE hash NOT IN (
+                    SELECT json_extract(item.value, '$."{BLOB_KEY}"')
+                    FROM actiontable, json_each(actiontable.action) AS item
+                    WHERE item.type = 'object'
+                    AND json_extract(item.value, '$."{BLOB_KEY}"') IS NOT NULL
+                )
+            """))
+            session.commit()
+            return result.rowcount
+
+    def index_trades(self) -> int:
+        """
+        Add the trades of 'trades' actions that are not in the
+        TradeIndexTable yet (e.g. written before it existed). Rows of
+        archived actions stay in the index, so analytics cover them too.
+        :return: The number of trades indexed.
+        """
+        from sqlalchemy import text
+        from sqlmodel import Session
+        unindexed = """
+            actiontable.category = 'trades'
+            AND actiontable.id NOT IN (SELECT action_id FROM tradeindextable)
+        """
+        with tracer.span('db.index_trades') as span, Session(self.engine) as session:
+            # trades stored inline are indexed in SQL with JSON1
+            result = session.execute(text(f"""
+                INSERT INTO tradeindextable (action_id, user, timestamp, symbol, type, amount)
+                SELECT actiontable.id, actiontable.user, actiontable.timestamp,
+                    json_extract(trade.value, '$.symbol'),
+                    json_extract(trade.value, '$.type'),
+                    json_extract(trade.value, '$.amount')
+                FROM actiontable, json_each(actiontable.action, '$.trades') AS trade
+                WHERE {unindexed}
+                AND json_type(actiontable.action, '$.trades') = 'array'
+            """))
+            indexed = result.rowcount
+            # trades moved into a blob are loaded in Python
+            blob_ids = session.execute(text(f"""
+                SELECT actiontable.id FROM actiontable
+                WHERE {unindexed}
+                AND json_type(actiontable.action, '$.trades."{BLOB_KEY}"') = 'text'
+            """)).scalars().all()
+            for action_id in blob_ids:
+                # the record is attached to the session: read the blob without
+                # touching record.action, or the commit stores the trades inline
+                record = session.get(ActionTable, action_id)
+                trades = self.read_blob(record.action['trades'][BLOB_KEY])
+                self._index_trades(session, record, trades)
+                indexed += len(trades)
+            session.commit()
+            span['records'] = indexed
+        return indexed
+
+    def trade_activity(
+        self, user: Optional[str] = None, period: Period = 'day',
+        start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[TradeActivity]:
+        from sqlmodel import Session, case, func, select
+        label = period_label_sql(period, TradeIndexTable.timestamp)
+        query = (
+            select(
+                TradeIndexTable.user, label,
+                func.count(),
+                func.sum(case((TradeIndexTable.type == 'buy', 1), else_=0)),
+                func.sum(case((TradeIndexTable.type == 'sell', 1), else_=0)),
+                func.sum(TradeIndexTable.amount),
+            )
+            .where(*self._trade_filters(user, start, end))
+            .group_by(TradeIndexTable.user, label)
+            .order_by(TradeIndexTable.user, label)
+        )
+        with tracer.span('db.trade_activity'), Session(self.engine) as session:
+            for row in session.execute(query):
+                yield TradeActivity(
+                    user=row[0], period=row[1], trades=row[2], buys=row[3],
+                    sells=row[4], turnover=row[5]
+                )
+
+    def symbol_exposure(
+        self, user: Optional[str] = None, period: Period = 'day',
+        symbols: Optional[list[str]] = None
+    ) -> Iterator[SymbolExposure]:
+        from sqlmodel import Session, case, func, select
+        label = period_label_sql(period, TradeIndexTable.timestamp).label('period')
+        signed = case(
+            (TradeIndexTable.type == 'buy', TradeIndexTable.amount),
+            else_=-TradeIndexTable.amount
+        )
+        filters = self._trade_filters(user)
+        if symbols is not None:
+            filters.append(TradeIndexTable.symbol.in_(symbols))
+        per_period = (
+            select(TradeIndexTable.symbol, label, func.sum(signed).label('net'))
+            .where(*filters)
+            .group_by(TradeIndexTable.symbol, label)
+            .subquery()
+        )
+        running = func.sum(per_period.c.net).over(
+            partition_by=per_period.c.symbol, order_by=per_period.c.period
+        )
+        query = (
+            select(per_period.c.symbol, per_period.c.period, running)
+            .order_by(per_period.c.symbol, per_period.c.period)
+        )
+        with tracer.span('db.symbol_exposure'), Session(self.engine) as session:
+            for row in session.execute(query):
+                yield SymbolExposure(symbol=row[0], period=row[1], net_shares=row[2])
+
+    def strategy_changes(
+        self, user: Optional[str] = None, period: Period = 'week',
+        start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[StrategyChanges]:
+        from sqlmodel import Session, case, func, select
+        # a large response is identified by its blob hash, a small one by its JSON
+        response = func.coalesce(
+            func.json_extract(ActionTable.action, f'$.response."{BLOB_KEY}"'),
+            func.json_extract(ActionTable.action, '$.response'),
+        ).label('response')
+        previous = func.lag(response).over(
+            partition_by=ActionTable.user, order_by=ActionTable.id
+        ).label('previous')
+        filters = [ActionTable.category == 'strategy']
+        if user is not None:
+            filters.append(ActionTable.user == user)
+        history = (
+            select(ActionTable.user, ActionTable.timestamp, response, previous)
+            .where(*filters)
+            .subquery()
+        )
+        # the range is applied after LAG so the first record in it can count as a change
+        range_filters = []
+        if start is not None:
+            range_filters.append(history.c.timestamp >= start)
+        if end is not None:
+            range_filters.append(history.c.timestamp < end)
+        label = period_label_sql(period, history.c.timestamp)
+        changed = case(
+            (history.c.previous.is_(None), 0),
+            (history.c.previous != history.c.response, 1),
+            else_=0
+        )
+        query = (
+            select(history.c.user, label, func.count(), func.sum(changed))
+            .where(*range_filters)
+            .group_by(history.c.user, label)
+            .order_by(history.c.user, label)
+        )
+        with tracer.span('db.strategy_changes'), Session(self.engine) as session:
+            for row in session.execute(query):
+                yield StrategyChanges(
+                    user=row[0], period=row[1], strategies=row[2], changes=row[3]
+                )
+
+    @staticmethod
+    def _trade_filters(
+        user: Optional[str] = None,
+        start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> list:
+        filters = []
+        if user is not None:
+            filters.append(TradeIndexTable.user == user)
+        if start is not None:
+            filters.append(TradeIndexTable.timestamp >= start)
+        if end is not None:
+            filters.append(TradeIndexTable.timestamp < end)
+        return filters
@@ -1,17 +1,21 @@
 from abc import ABC, abstractmethod
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
+from typing import Callable
+import hashlib
 import logging
 import os
-
-from pydantic import BaseModel
+import uuid
 
 from chadGPT.data_models import (
-    Job, Task, LLMRequest
+    Job, Task, LLMRequest, ContextItem, StockBar, TradeOrder
 )
 from chadGPT.brain import BaseLLM, apply_delimiter
 from chadGPT.data_models import Preferences, StrategyResponse, RelativePortfolio, Portfolio
 from chadGPT.trader import BaseBroker, BaseMarketResearch, make_trades_from_portfolio
-from chadGPT.db import BaseDatabase, SQLiteDatabase
+from chadGPT.db import BaseDatabase, SQLiteDatabase, get_current_utc_time
+from chadGPT.metrics import tracer
+from chadGPT.profiling import Profiler, profiled, set_run_id
+from chadGPT.work_queue import check_lease, current_job_key
 
 # general workflow
 # 1. Strategy Generation/Update (frequency)
@@ -22,6 +26,47 @@ from chadGPT.db import BaseDatabase, SQLiteDatabase
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# context priorities (lower priority items are pruned first to fit the budget)
+PRIORITY_MARKET_DATA = 0
+PRIORITY_PREVIOUS_STRATEGY = 1
+PRIORITY_PORTFOLIO = 2
+PRIORITY_SETTINGS = 3
+
+
+def summarize_bars(symbol: str, bars: list[StockBar]) -> str:
+    if not bars:
+        return f"{symbol}: no bars"
+    return (
+        f"{symbol}: {len(bars)} bars from {bars[0].time.isoformat()} " +
+        f"to {bars[-1].time.isoformat()}, open {bars[0].open}, " +
+        f"close {bars[-1].close}, low {min(b.low for b in bars)}, " +
+        f"high {max(b.high for b in bars)}"
+    )
+
+
+def fingerprint_strategy(strategy: StrategyResponse | str) -> str:
+    if isinstance(strategy, StrategyResponse):
+        strategy = strategy.model_dump_json()
+    return hashlib.sha256(str(strategy).encode()).hexdigest()
+
+
+def portfolio_weights(portfolio: Portfolio) -> dict[str, float]:
+    """
+    Fraction of the portfolio held in each symbol (and in '$cash').
+    """
+    total = portfolio.total_value
+    if total <= 0:
+        return {}
+    weights = {pos.symbol: pos.value / total for pos in portfolio.positions}
+    weights['$cash'] = portfolio.cash / total
+    return weights
+
+
+def relative_portfolio_weights(portfolio: RelativePortfolio) -> dict[str, float]:
+    weights = {pos.symbol: pos.percent_of_portfolio for pos in portfolio.positions}
+    weights['$cash'] = portfolio.percent_cash
+    return weights
+
 
 class Orchestrator(ABC):
     @abstractmethod
@@ -42,8 +87,9 @@ class Giga(Orchestrator):
         user_preferences: Preferences = Preferences(),
         db: BaseDatabase = SQLiteDatabase("sqlite:///data/chadGPT.db"),
         user: str = "default_user",
+        clock: Callable[[], datetime] = get_current_utc_time,
+        profiler: Profiler | None = None,
     ):
-        print('running')
         self.broker = broker
         self.market = market
         self.portfolio_update_brain = portfolio_update_brain
@@ -51,50 +97,64 @@ class Giga(Orchestrator):
         self.user_preferences = user_preferences
         self.db = db
         self.user = user
+        self.clock = clock # injectable so backtests can run on simulated time
+        self.profiler = profiler
 
     def get_previous_strategy(self) -> StrategyResponse | str:
         """
         Retrieve the previous strategy from the database.
         This could be implemented to read from a specific table or log.
         """
-        actions = self.db.read(user=self.user, category='strategy')
-        if actions:
-            strategy = actions[-1].action.get('response', '')
+        latest = self.db.read_latest(user=self.user, category='strategy')
+        if latest:
+            strategy = latest.action.get('response', '')
             if isinstance(strategy, dict):
                 return StrategyResponse(**strategy)
         return ""
     
-    def gather_research_context(self) -> list[BaseModel | str]:
+    @tracer.traced('giga.gather_research_context')
+    def gather_research_context(self) -> list[ContextItem]:
         # gather context such as current portfolio, market data, previous strategies
-        context: list[BaseModel | str] = []
+        context: list[ContextItem] = []
         current_portfolio = self.broker.get_portfolio()
-        context.append(current_portfolio)
+        context.append(ContextItem(
+            content=current_portfolio, priority=PRIORITY_PORTFOLIO
+        ))
         previous_strategy = apply_delimiter(
             block_name='previous_strategy', 
             query=self.get_previous_strategy(),
             delimiter_type='caps:'
         )
-        context.append(previous_strategy)
+        context.append(ContextItem(
+            content=previous_strategy, priority=PRIORITY_PREVIOUS_STRATEGY
+        ))
         # additional market data could be gathered here as needed
         update_frequency = self.user_preferences.portfolio_update_frequency
-        context.append(apply_delimiter(
-            block_name='portfolio_update_frequency',
-            query=update_frequency,
-            delimiter_type='caps:'
+        context.append(ContextItem(
+            content=apply_delimiter(
+                block_name='portfolio_update_frequency',
+                query=update_frequency,
+                delimiter_type='caps:'
+            ),
+            priority=PRIORITY_SETTINGS
         ))
         strategy_update_frequency = self.user_preferences.strategy_update_frequency
-        context.append(apply_delimiter(
-            block_name='strategy_update_frequency',
-            query=strategy_update_frequency,
-            delimiter_type='caps:'
+        context.append(ContextItem(
+            content=apply_delimiter(
+                block_name='strategy_update_frequency',
+                query=strategy_update_frequency,
+                delimiter_type='caps:'
+            ),
+            priority=PRIORITY_SETTINGS
         ))
 
         return context
 
+    @tracer.traced('giga.gather_portfolio_update_context')
     def gather_portfolio_update_context(
         self, strategy: StrategyResponse | None = None
-    ) -> list[BaseModel | str]:
-        context = []
+    ) -> list[ContextItem]:
+        context: list[ContextItem] = []
         # get previous strategy if not provided
         if strategy is None:
             strategy = self.get_previous_strategy()
@@ -112,10 +172,13 @@ class Giga(Orchestrator):
         else:
             strategy_report = str(strategy)
         
-        context.append(apply_delimiter(
-            block_name='strategy_report',
-            query=strategy_report,
-            delimiter_type='caps:'
+        context.append(ContextItem(
+            content=apply_delimiter(
+                block_name='strategy_report',
+                query=strategy_report,
+                delimiter_type='caps:'
+            ),
+            priority=PRIORITY_PREVIOUS_STRATEGY
         ))
         
         # get stock symbols from the previous time period
@@ -124,32 +187,46 @@ class Giga(Orchestrator):
             'daily': '1',
             'weekly': '7'
         }
-        timestamp: str = datetime.now(timezone.utc).isoformat()
-        context.append(apply_delimiter(
-            block_name='current_time',
-            query=timestamp,
-            delimiter_type='caps:'
+        now = self.clock()
+        timestamp: str = now.isoformat()
+        context.append(ContextItem(
+            content=apply_delimiter(
+                block_name='current_time',
+                query=timestamp,
+                delimiter_type='caps:'
+            ),
+            priority=PRIORITY_SETTINGS
         ))
 
         look_back_days = update_period_dict.get(
             self.user_preferences.portfolio_update_frequency, '7'
         )
         for symbol in stock_symbols_to_watch:
-            historic_data = self.market.get_historic_value(
-                symbol=symbol,
-                start=datetime.now(timezone.utc).isoformat(),
-                end=(datetime.now(timezone.utc) - timedelta(days=int(look_back_days))).isoformat(),
-                aggregation='daily'
-            )
-            for h in historic_data:
-                context.append(historic_data)
+            with tracer.span('market.get_historic_value', symbol=symbol) as span:
+                historic_data = self.market.get_historic_value(
+                    symbol=symbol,
+                    start=now - timedelta(days=int(look_back_days)),
+                    end=now,
+                    aggregation='daily'
+                )
+                span['bars'] = len(historic_data or [])
+            if historic_data:
+                context.append(ContextItem(
+                    content=historic_data,
+                    priority=PRIORITY_MARKET_DATA,
+                    summary=summarize_bars(symbol, historic_data)
+                ))
         
         # add current portfolio to context
         current_portfolio = self.broker.get_portfolio()
-        context.append(current_portfolio)
+        context.append(ContextItem(
+            content=current_portfolio, priority=PRIORITY_PORTFOLIO
+        ))
 
         return context
 
+    @tracer.traced('giga.generate_strategy')
+    @profiled('generate_strategy')
     def generate_strategy(self, save_to_db: bool = True) -> StrategyResponse:
         context = self.gather_research_context()
         prompt = self.user_preferences.research_prompt
@@ -180,7 +257,9 @@ class Giga(Orchestrator):
                          made available through the sale of stocks.
                          """,
             context = context,
-            expected_format = StrategyResponse
+            expected_format = StrategyResponse,
+            token_budget = self.user_preferences.prompt_token_budget,
+            layout = self.user_preferences.prompt_layout
         )
 
         strategy = self.research_brain.ask(llm_request)
@@ -191,14 +270,90 @@ class Giga(Orchestrator):
                 action={
                     'query': BaseLLM.make_query(llm_request),
                     'response': strategy.model_dump()
-                }
+                },
+                timestamp=self.clock()
             )
 
         return strategy
     
+    def get_current_prices(self, symbols: list[str]) -> dict[str, float]:
+        prices = {}
+        with tracer.span('market.get_current_prices', symbols=len(symbols)):
+            for symbol in symbols:
+                stock = self.market.get_current_value(symbol)
+                if stock is not None:
+                    prices[symbol] = stock.price
+        return prices
+
+    def get_portfolio_update_inputs(
+        self, strategy: StrategyResponse | None = None
+    ) -> dict:
+        """
+        Snapshot of the inputs that decide whether a portfolio update is needed.
+        """
+        if strategy is None:
+            strategy = self.get_previous_strategy()
+        current_portfolio = self.broker.get_portfolio()
+
+        symbols = {pos.symbol for pos in current_portfolio.positions}
+        if isinstance(strategy, StrategyResponse):
+            symbols.update(strategy.stock_symbols_to_watch)
+        return {
+            'strategy_fingerprint': fingerprint_strategy(strategy),
+            'prices': self.get_current_prices(sorted(symbols)),
+            'weights': portfolio_weights(current_portfolio),
+        }
+
+    def get_reusable_portfolio_update(
+        self, inputs: dict
+    ) -> RelativePortfolio | None:
+        """
+        Return the previous portfolio update if nothing material changed since
+        it was made: same strategy, no watched price moved more than
+        price_move_threshold and no weight drifted more than
+        weight_drift_threshold from the previous target.
+        """
+        latest = self.db.read_latest(user=self.user, category='portfolio_update')
+        if latest is None:
+            return None
+        previous = latest.action
+        previous_inputs = previous.get('inputs')
+        if previous_inputs is None:
+            return None
+
+        if inputs['strategy_fingerprint'] != previous_inputs['strategy_fingerprint']:
+            logger.debug("Strategy changed since the last portfolio update")
+            return None
+
+        prices, previous_prices = inputs['prices'], previous_inputs['prices']
+        if prices.keys() != previous_prices.keys():
+            logger.debug("Watched symbols changed since the last portfolio update")
+            return None
+        for symbol, price in prices.items():
+            previous_price = previous_prices[symbol]
+            move = abs(price / previous_price - 1) if previous_price else float('inf')
+            if move > self.user_preferences.price_move_threshold:
+                logger.debug(f"{symbol} moved {move:.2%} since the last portfolio update")
+                return None
+
+        previous_portfolio = RelativePortfolio(**previous['response'])
+        targets = relative_portfolio_weights(previous_portfolio)
+        weights = inputs['weights']
+        for symbol in targets.keys() | weights.keys():
+            drift = abs(weights.get(symbol, 0.0) - targets.get(symbol, 0.0))
+            if drift > self.user_preferences.weight_drift_threshold:
+                logger.debug(f"{symbol} drifted {drift:.2%} from its target weight")
+                return None
+
+        return previous_portfolio
+
+    @tracer.traced('giga.get_portfolio_updates')
     def get_portfolio_updates(
-        self, strategy: StrategyResponse | None = None, save_to_db: bool = True
+        self, strategy: StrategyResponse | None = None, save_to_db: bool = True,
+        inputs: dict | None = None, run_id: str | None = None
     ) -> RelativePortfolio:
+        if inputs is None and self.user_preferences.skip_unchanged_portfolio_updates:
+            inputs = self.get_portfolio_update_inputs(strategy=strategy)
         context = self.gather_portfolio_update_context(strategy=strategy)
         prompt = self.user_preferences.portfolio_update_prompt
         if prompt is None:
@@ -219,22 +374,33 @@ class Giga(Orchestrator):
                          made available through the sale of stocks.
                          """,
             context = context,
-            expected_format = RelativePortfolio
+            expected_format = RelativePortfolio,
+            token_budget = self.user_preferences.prompt_token_budget,
+            layout = self.user_preferences.prompt_layout
         )
 
         relative_portfolio = self.portfolio_update_brain.ask(llm_request)
         if save_to_db:
+            action = {
+                'query': BaseLLM.make_query(llm_request),
+                'response': relative_portfolio.model_dump()
+            }
+            if inputs is not None:
+                action['inputs'] = inputs
+            if run_id is not None:
+                # doubles as the checkpoint of this pipeline stage
+                action['run_id'] = run_id
             self.db.write(
                 user=self.user, 
                 category='portfolio_update', 
-                action={
-                    'query': BaseLLM.make_query(llm_request),
-                    'response': relative_portfolio.model_dump()
-                }
+                action=action,
+                timestamp=self.clock()
             )
 
         return relative_portfolio
 
+    @tracer.traced('giga.giga_pipeline')
+    @profiled('giga_pipeline')
     def giga_pipeline(self):
         """
         1. Generate a new investment strategy
@@ -246,32 +412,175 @@ class Giga(Orchestrator):
         
         return strategy, trades
 
-    def update_portfolio_pipeline(self, strategy: StrategyResponse | None = None, save_to_db: bool = True):
+    def checkpoint(self, run_id: str, stage: str, data=None) -> None:
+        self.db.write(
+            user=self.user,
+            category='checkpoint',
+            action={'run_id': run_id, 'stage': stage, 'data': data},
+            timestamp=self.clock()
+        )
+
+    def get_checkpoints(self, run_id: str) -> dict[str, list]:
+        """
+        Data of every checkpoint written by a run, grouped by stage.
+        """
+        checkpoints: dict[str, list] = {}
+        records = self.db.read_matching(
+            {'run_id': run_id}, user=self.user, category='checkpoint'
+        )
+        for record in records:
+            checkpoints.setdefault(record.action['stage'], []).append(
+                record.action['data']
+            )
+        return checkpoints
+
+    def get_unfinished_run(self) -> str | None:
+        latest = self.db.read_latest(user=self.user, category='checkpoint')
+        if latest and latest.action['stage'] not in ('complete', 'abandoned'):
+            return latest.action['run_id']
+        return None
+
+    def run_fingerprint(self, strategy: StrategyResponse | None = None) -> str:
+        """
+        Fingerprint of what a portfolio update run is asked to do; a crashed
+        run is only resumed by a call with the same fingerprint.
+        """
+        if strategy is None:
+            strategy = self.get_previous_strategy()
+        return hashlib.sha256(
+            (fingerprint_strategy(strategy) + self.user_preferences.model_dump_json()).encode()
+        ).hexdigest()
+
+    def stale_run_reason(self, checkpoints: dict[str, list], fingerprint: str) -> str | None:
+        """
+        Why a crashed run must not be resumed, or None if it can be.
+        """
+        started = (checkpoints.get('started') or [None])[0]
+        if not isinstance(started, dict) or 'fingerprint' not in started:
+            return "no fingerprint was recorded when it started"
+        if started['fingerprint'] != fingerprint:
+            return "the strategy or preferences changed"
+        max_age = timedelta(minutes=self.user_preferences.resume_max_age_minutes)
+        if self.clock() - datetime.fromisoformat(started['started_at']) > max_age:
+            return "it started too long ago"
+        if len(checkpoints.get('resumed', [])) >= self.user_preferences.max_resume_attempts:
+            return "it failed on every resume attempt"
+        return None
+
+    @tracer.traced('giga.update_portfolio_pipeline')
+    @profiled('update_portfolio_pipeline')
+    def update_portfolio_pipeline(
+        self, strategy: StrategyResponse | None = None, save_to_db: bool = True,
+        run_id: str | None = None
+    ):
         """
         2. Update the portfolio based on the strategy
         3. Execute trades to rebalance the portfolio
+
+        Each stage is checkpointed under run_id, so a run that crashed is
+        resumed by the next call: the LLM is not asked again once its
+        answer is stored, and orders that already went out are not resent
+        (each order also carries an idempotency key for the broker).
+        A crashed run is only resumed by a call with the same strategy and
+        preferences, within resume_max_age_minutes and at most
+        max_resume_attempts times; otherwise it is marked 'abandoned' and a
+        new run starts. Run from a work queue item, the run_id is derived
+        from the item's key, so another attempt at the item continues the
+        same run. With save_to_db=False nothing is written, so runs are
+        neither checkpointed nor resumed.
         """
-        relative_portfolio = self.get_portfolio_updates(strategy=strategy)
-        
-        current_portfolio = self.broker.get_portfolio()
-        trades = make_trades_from_portfolio(
-            current_portfolio=current_portfolio,
-            desired_portfolio=relative_portfolio
-        )
+        checkpoints = {}
         if save_to_db:
-            self.db.write(
-                user=self.user, 
-                category='trades', 
-                action={
-                    'strategy': strategy.model_dump() if strategy else None,
-                    'relative_portfolio': relative_portfolio.model_dump(),
-                    'trades': [trade.model_dump() for trade in trades]
-                }
+            if run_id is None and current_job_key() is not None:
+                # every attempt at a work queue item continues the same run
+                run_id = uuid.uuid5(uuid.NAMESPACE_URL, f"{self.user}/{current_job_key()}").hex
+            if run_id is None:
+                run_id = self.get_unfinished_run()
+            if run_id is not None:
+                checkpoints = self.get_checkpoints(run_id)
+        if 'complete' in checkpoints:
+            return [TradeOrder(**t) for t in checkpoints.get('trades_planned', [[]])[-1]]
+
+        fingerprint = self.run_fingerprint(strategy) if save_to_db else None
+        if checkpoints:
+            reason = self.stale_run_reason(checkpoints, fingerprint)
+            if reason is None:
+                logger.info(f"Resuming unfinished portfolio update run {run_id}")
+                self.checkpoint(run_id, 'resumed')
+            else:
+                logger.warning(f"Abandoning portfolio update run {run_id}: {reason}")
+                self.checkpoint(run_id, 'abandoned', reason)
+                run_id, checkpoints = None, {}
+
+        inputs = None
+        if not checkpoints:
+            if self.user_preferences.skip_unchanged_portfolio_updates:
+                inputs = self.get_portfolio_update_inputs(strategy=strategy)
+                if self.get_reusable_portfolio_update(inputs) is not None:
+                    logger.info(
+                        "No material change since the last portfolio update; " +
+                        "skipping the LLM call and trades"
+                    )
+                    return []
+            run_id = run_id or uuid.uuid4().hex
+            if save_to_db:
+                self.checkpoint(run_id, 'started', {
+                    'fingerprint': fingerprint, 'started_at': self.clock().isoformat()
+                })
+        set_run_id(run_id)
+
+        if 'trades_planned' in checkpoints:
+            trades = [TradeOrder(**t) for t in checkpoints['trades_planned'][-1]]
+        else:
+            previous = self.db.read_latest(user=self.user, category='portfolio_update')
+            if previous and previous.action.get('run_id') == run_id:
+                relative_portfolio = RelativePortfolio(**previous.action['response'])
+            else:
+                relative_portfolio = self.get_portfolio_updates(
+                    strategy=strategy, save_to_db=save_to_db, inputs=inputs, run_id=run_id
+                )
+
+            current_portfolio = self.broker.get_portfolio()
+            held = {pos.symbol for pos in current_portfolio.positions}
+            trades = make_trades_from_portfolio(
+                current_portfolio=current_portfolio,
+                desired_portfolio=relative_portfolio,
+                prices=self.get_current_prices([
+                    pos.symbol for pos in relative_portfolio.positions
+                    if pos.symbol not in held
+                ])
             )
-        
+            for i, trade in enumerate(trades):
+                trade.client_order_id = f"{run_id}-{i}"
+            if save_to_db:
+                self.checkpoint(
+                    run_id, 'trades_planned',
+                    [trade.model_dump(mode='json') for trade in trades]
+                )
+                self.db.write(
+                    user=self.user, 
+                    category='trades', 
+                    action={
+                        'strategy': strategy.model_dump() if strategy else None,
+                        'relative_portfolio': relative_portfolio.model_dump(),
+                        'trades': [trade.model_dump() for trade in trades],
+                        'run_id': run_id
+                    },
+                    timestamp=self.clock()
+                )
+
+        submitted = set(checkpoints.get('order_submitted', []))
         for trade in trades:
-            self.broker.create_order(trade)
-        
+            if trade.client_order_id in submitted:
+                continue
+            check_lease() # stop if a work queue worker lost this run to another
+            with tracer.span('broker.create_order', symbol=trade.symbol, type=trade.type):
+                self.broker.create_order(trade)
+            if save_to_db:
+                self.checkpoint(run_id, 'order_submitted', trade.client_order_id)
+
+        if save_to_db:
+            self.checkpoint(run_id, 'complete')
         return trades
 
     def create_jobs(self) -> list[Job]:
@@ -297,7 +606,8 @@ class Giga(Orchestrator):
 
         portfolio_update_job = Job(
             schedule=schedule,
-            tasks=tasks
+            tasks=tasks,
+            name=f"{self.user}:portfolio_update"
         )
 
         research_update_job = Job(
@@ -308,7 +618,8 @@ class Giga(Orchestrator):
                 Task(
                     func=self.generate_strategy
                 )
-            ]
+            ],
+            name=f"{self.user}:strategy"
         )
         return [portfolio_update_job, research_update_job]
 
@@ -323,7 +634,7 @@ class Giga(Orchestrator):
             # save as markdown file
             with open(file_path, 'w') as f:
                 f.write(f"# Latest Strategy Report\n\n")
-                f.write(f"Generated on: {datetime.now(timezone.utc).isoformat()}\n\n")
+                f.write(f"Generated on: {self.clock().isoformat()}\n\n")
                 f.write(report)
         else:
             print(strategy)
@@ -0,0 +1,181 @@
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterator, Optional
+import functools
+import logging
+import os
+import threading
+import time
+
+from pydantic import BaseModel
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(4 ** i for i in range(12)) # 1 to ~4M (chars, tokens, bars)
+
+
+class SpanRecord(BaseModel):
+    name: str
+    parent: Optional[str]
+    start: datetime
+    duration: float
+    attributes: dict[str, Any]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def prometheus_lines(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:g}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+_current_span: ContextVar[Optional[str]] = ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """
+    Records a span (duration plus numeric payload sizes such as prompt
+    characters, tokens or bar counts) around each pipeline stage, keeps
+    per-stage histograms and exports them in the Prometheus text format.
+    Spans are also sent to an OTLP collector once enable_otlp is called.
+    """
+    def __init__(self, max_spans: int = 10_000):
+        self.spans: deque[SpanRecord] = deque(maxlen=max_spans)
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.otel_tracer = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[dict[str, Any]]:
+        """
+        Time the block as stage name. The yielded dict can be filled with
+        more attributes (e.g. payload sizes) before the block ends.
+        """
+        parent = _current_span.get()
+        token = _current_span.set(name)
+        start = datetime.now(timezone.utc)
+        start_counter = time.perf_counter()
+        with ExitStack() as stack:
+            otel_span = None
+            if self.otel_tracer is not None:
+                otel_span = stack.enter_context(
+                    self.otel_tracer.start_as_current_span(name)
+                )
+            try:
+                yield attributes
+            except Exception as e:
+                attributes['error'] = repr(e)
+                raise
+            finally:
+                duration = time.perf_counter() - start_counter
+                _current_span.reset(token)
+                if otel_span is not None:
+                    otel_span.set_attributes({
+                        k: v for k, v in attributes.items()
+                        if isinstance(v, (int, float, str, bool))
+                    })
+                self.record(SpanRecord(
+                    name=name, parent=parent, start=start,
+                    duration=duration, attributes=attributes
+                ))
+
+    def traced(self, name: str) -> Callable:
+        """
+        Decorator that runs every call of the function in a span.
+        """
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, span: SpanRecord) -> None:
+        with self._lock:
+            self.spans.append(span)
+            self._observe('stage_duration_seconds', span.name, span.duration, DURATION_BUCKETS)
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._observe(key, span.name, value, SIZE_BUCKETS)
+
+    def _observe(self, metric: str, stage: str, value: float, buckets: tuple) -> None:
+        key = (metric, stage)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self, prefix: str = 'chadgpt') -> str:
+        with self._lock:
+            lines = []
+            for metric in sorted({metric for metric, _ in self.histograms}):
+                name = f"{prefix}_{metric}"
+                lines.append(f"# TYPE {name} histogram")
+                for (m, stage), histogram in sorted(self.histograms.items()):
+                    if m == metric:
+                        lines += histogram.prometheus_lines(name, f'stage="{stage}"')
+            return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str) -> None:
+        """
+        Write the metrics for the node_exporter textfile collector (the file
+        is replaced atomically so scrapes never see a partial file).
+        """
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, file_path)
+
+    def enable_otlp(self, endpoint: str = "http://localhost:4318") -> None:
+        """
+        Also send every span to an OTLP/HTTP collector (requires the
+        opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages).
+        """
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError as e:
+            raise ImportError(
+                "OTLP export requires opentelemetry-sdk and " +
+                "opentelemetry-exporter-otlp-proto-http"
+            ) from e
+        provider = TracerProvider(resource=Resource.create({"service.name": "chadGPT"}))
+        provider.add_span_processor(
+            BatchSpanProcessor(OTLPSpanExporter(endpoint=f"{endpoint}/v1/traces"))
+        )
+        self.otel_tracer = provider.get_tracer("chadGPT")
+
+
+# shared tracer for the whole pipeline (like logging.getLogger)
+tracer = Tracer()
@@ -0,0 +1,212 @@
+from bisect import bisect_left, insort
+from itertools import count
+from typing import Container, Iterable
+import logging
+import threading
+
+from chadGPT.data_models import Rule, Stock, TradeOrder
+from chadGPT.trader import BaseBroker, BaseMarketResearch
+
+
+logger = logging.getLogger(__name__)
+
+
+class TriggerIndex:
+    """
+    Sorted trigger levels of one symbol.
+
+    Stop-losses are kept ascending, so the ones crossed by a price p
+    (level >= p) are a tail of the list. Take-profits are kept as negated
+    levels, so the ones crossed (level <= p) are a tail as well. A price
+    update is a bisect plus a slice of the k crossed entries: O(log n + k).
+    Removed positions are skipped lazily and compacted once they dominate.
+    """
+    def __init__(self):
+        self.stops: list[tuple[float, int]] = []
+        self.take_profits: list[tuple[float, int]] = []
+        self.stale = 0
+
+    def add(self, stop_price: float | None, take_price: float | None, entry_id: int):
+        if stop_price is not None:
+            insort(self.stops, (stop_price, entry_id))
+        if take_price is not None:
+            insort(self.take_profits, (-take_price, entry_id))
+
+    def pop_crossed(self, price: float) -> list[int]:
+        i = bisect_left(self.stops, (price, -1))
+        j = bisect_left(self.take_profits, (-price, -1))
+        crossed = [entry_id for _, entry_id in self.stops[i:]]
+        crossed += [entry_id for _, entry_id in self.take_profits[j:]]
+        del self.stops[i:]
+        del self.take_profits[j:]
+        return crossed
+
+    def compact(self, live: Container[int]):
+        self.stops = [e for e in self.stops if e[1] in live]
+        self.take_profits = [e for e in self.take_profits if e[1] in live]
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self.stops) + len(self.take_profits)
+
+
+class RuleMonitor:
+    """
+    Watches the stop-loss/take-profit rules of every open position across
+    many accounts between scheduled rebalances. Trigger levels are relative
+    to each position's reference price, and a crossed level submits a sell
+    order for the whole position through the account's broker.
+
+    The reference price is the position's cost basis: the value per share
+    when the position was first synced, averaged with the price of any
+    shares added by later syncs. With trailing=True it is instead re-anchored
+    to the current value per share on every sync, like a trailing stop.
+    """
+    def __init__(self, trailing: bool = False):
+        self.trailing = trailing
+        # (account, symbol) -> (shares, average entry price) of held positions
+        self.cost_basis: dict[tuple[str, str], tuple[float, float]] = {}
+        self.brokers: dict[str, BaseBroker] = {}
+        self.indexes: dict[str, TriggerIndex] = {}
+        # entry id -> (account, symbol, shares, rules, trigger count) for live positions
+        self.entries: dict[int, tuple[str, str, float, Rule, int]] = {}
+        self.positions: dict[tuple[str, str], int] = {}
+        self.account_symbols: dict[str, set[str]] = {}
+        self._ids = count()
+        self._lock = threading.Lock()
+
+    def add_account(self, account: str, broker: BaseBroker) -> None:
+        self.brokers[account] = broker
+        self.sync_account(account)
+
+    def sync_account(self, account: str) -> None:
+        """
+        Re-index an account's positions (e.g. after a rebalance).
+        """
+        portfolio = self.brokers[account].get_portfolio()
+        with self._lock:
+            for symbol in list(self.account_symbols.get(account, ())):
+                self._unwatch(account, symbol)
+            held = set()
+            for pos in portfolio.positions:
+                if pos.shares <= 0:
+                    continue
+                held.add(pos.symbol)
+                reference_price = self._update_cost_basis(
+                    account, pos.symbol, pos.shares, pos.value / pos.shares
+                )
+                self._watch(account, pos.symbol, pos.shares, reference_price, pos.rules)
+            for key in [k for k in self.cost_basis if k[0] == account and k[1] not in held]:
+                del self.cost_basis[key]
+
+    def _update_cost_basis(
+        self, account: str, symbol: str, shares: float, price: float
+    ) -> float:
+        previous = self.cost_basis.get((account, symbol))
+        if previous is None or self.trailing:
+            entry_price = price
+        else:
+            previous_shares, entry_price = previous
+            if shares > previous_shares:
+                # shares bought since the last sync are added at the current price
+                entry_price = (
+                    entry_price * previous_shares + price * (shares - previous_shares)
+                ) / shares
+        self.cost_basis[(account, symbol)] = (shares, entry_price)
+        return entry_price
+
+    def watch(
+        self, account: str, symbol: str, shares: float,
+        reference_price: float, rules: Rule
+    ) -> None:
+        with self._lock:
+            self._unwatch(account, symbol)
+            self.cost_basis[(account, symbol)] = (shares, reference_price)
+            self._watch(account, symbol, shares, reference_price, rules)
+
+    def unwatch(self, account: str, symbol: str) -> None:
+        with self._lock:
+            self._unwatch(account, symbol)
+            self.cost_basis.pop((account, symbol), None)
+
+    def _watch(
+        self, account: str, symbol: str, shares: float,
+        reference_price: float, rules: Rule
+    ) -> None:
+        stop_price = take_price = None
+        if rules.stop_loss_pct is not None:
+            stop_price = reference_price * (1 - rules.stop_loss_pct)
+        if rules.take_profit_pct is not None:
+            take_price = reference_price * (1 + rules.take_profit_pct)
+        if stop_price is None and take_price is None:
+            return
+
+        entry_id = next(self._ids)
+        triggers = (stop_price is not None) + (take_price is not None)
+        self.entries[entry_id] = (account, symbol, shares, rules, triggers)
+        self.positions[(account, symbol)] = entry_id
+        self.account_symbols.setdefault(account, set()).add(symbol)
+        self.indexes.setdefault(symbol, TriggerIndex()).add(
+            stop_price, take_price, entry_id
+        )
+
+    def _unwatch(self, account: str, symbol: str, popped: int = 0) -> None:
+        entry_id = self.positions.pop((account, symbol), None)
+        if entry_id is None:
+            return
+        triggers = self.entries.pop(entry_id)[-1]
+        self.account_symbols[account].discard(symbol)
+        index = self.indexes[symbol]
+        index.stale += triggers - popped
+        if index.stale * 2 > len(index):
+            index.compact(self.entries)
+
+    def on_price(self, stock: Stock) -> list[TradeOrder]:
+        """
+        Submit exit orders for every position whose trigger was crossed.
+        """
+        with self._lock:
+            index = self.indexes.get(stock.symbol)
+            if index is None:
+                return []
+            triggered = []
+            for entry_id in index.pop_crossed(stock.price):
+                entry = self.entries.get(entry_id)
+                if entry is None:
+                    # stale entry, or the other trigger of a position that exited
+                    index.stale = max(index.stale - 1, 0)
+                    continue
+                account, symbol, shares, rules, _ = entry
+                self._unwatch(account, symbol, popped=1)
+                self.cost_basis.pop((account, symbol), None)
+                triggered.append((account, TradeOrder(
+                    type='sell', symbol=symbol, amount=shares,
+                    trade_time=stock.time, rules=rules
+                )))
+
+        for account, order in triggered:
+            logger.info(
+                f"Rule triggered for {account}: selling {order.amount} " +
+                f"{order.symbol} at {stock.price}"
+            )
+            self.brokers[account].create_order(order)
+        return [order for _, order in triggered]
+
+    def run(self, prices: Iterable[Stock]) -> list[TradeOrder]:
+        orders = []
+        for stock in prices:
+            orders += self.on_price(stock)
+        return orders
+
+    def poll(self, market: BaseMarketResearch) -> list[TradeOrder]:
+        """
+        Check the current price of every watched symbol once.
+        """
+        with self._lock:
+            symbols = [s for s, index in self.indexes.items() if len(index)]
+        orders = []
+        for symbol in symbols:
+            stock = market.get_current_value(symbol)
+            if stock is not None:
+                orders += self.on_price(stock)
+        return orders
@@ -0,0 +1,275 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+import argparse
+import base64
+import cProfile
+import functools
+import inspect
+import logging
+import marshal
+import pstats
+import random
+import threading
+import time
+
+from pydantic import BaseModel
+
+from chadGPT.db import BaseDatabase, SQLiteDatabase
+
+# general workflow
+# 1. a Profiler is passed to Giga / Scheduler; each pipeline run is wrapped in profiler.profile
+# 2. runs of selected users, a random sample of runs and runs slower than
+#    the latency threshold are stored as 'profile' records in the ActionTable
+# 3. python -m chadGPT.profiling list|show|diff|flamegraph inspects them
+
+
+logger = logging.getLogger(__name__)
+
+FunctionKey = tuple[str, int, str] # (file, line, function name), as in pstats
+
+
+class ProfilingConfig(BaseModel):
+    users: list[str] = [] # always profile these users' runs
+    sample_rate: float = 0.0 # fraction of all other runs to profile
+    latency_threshold: Optional[float] = None # keep profiled runs slower than this (seconds)
+    latency_sample_rate: float = 0.1 # fraction of runs profiled to look for slow ones
+
+
+# attributes of the outermost active profile (None while not profiling)
+_current_profile: ContextVar[dict | None] = ContextVar('current_profile', default=None)
+# only one cProfile can be active per process on Python 3.12+ (sys.monitoring)
+_profile_lock = threading.Lock()
+
+
+def set_run_id(run_id: str) -> None:
+    """
+    Store run_id with the active profile, if any, so the profile joins to
+    the records of the run it covers. Called by the pipeline once it has
+    picked (or generated) its run_id.
+    """
+    profile = _current_profile.get()
+    if profile is not None and profile['run_id'] is None:
+        profile['run_id'] = run_id
+
+
+class Profiler:
+    """
+    Captures a cProfile profile of selected pipeline runs and stores it in
+    the database next to the run's other records. cProfile only sees the
+    thread that started the run, so tasks of a DAG job that run on worker
+    threads are not included. One run is profiled at a time: a run that
+    starts while another thread's run is profiled is not profiled.
+    """
+    def __init__(
+        self,
+        db: BaseDatabase,
+        config: ProfilingConfig = ProfilingConfig(),
+        rng: random.Random | None = None,
+    ):
+        self.db = db
+        self.config = config
+        self.rng = rng or random.Random()
+
+    def is_selected(self, user: str) -> bool:
+        return user in self.config.users or self.rng.random() < self.config.sample_rate
+
+    @contextmanager
+    def profile(self, run: str, user: str, run_id: str | None = None) -> Iterator[None]:
+        """
+        Profile the block as a run of user. Selected runs are always kept;
+        with a latency threshold, a latency_sample_rate fraction of the
+        other runs is profiled and kept if slow. All remaining runs are not
+        profiled at all; nested calls are covered by the outermost profile.
+        """
+        threshold = self.config.latency_threshold
+        selected = self.is_selected(user)
+        watched = threshold is not None and self.rng.random() < self.config.latency_sample_rate
+        if _current_profile.get() is not None or not (selected or watched):
+            yield
+            return
+        if not _profile_lock.acquire(blocking=False):
+            logger.debug(f"Not profiling {run} for {user}: another run is profiled")
+            yield
+            return
+
+        attributes = {'run_id': run_id}
+        token = _current_profile.set(attributes)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _profile_lock.release()
+            duration = time.perf_counter() - start
+            _current_profile.reset(token)
+            if selected or (threshold is not None and duration >= threshold):
+                self.save(profile, run, user, duration, attributes['run_id'])
+
+    def save(
+        self, profile: cProfile.Profile, run: str, user: str, duration: float,
+        run_id: str | None = None
+    ) -> None:
+        profile.create_stats()
+        self.db.write(
+            user=user,
+            category='profile',
+            action={
+                'run': run,
+                'run_id': run_id,
+                'duration': duration,
+                'stats': encode_stats(profile.stats),
+            }
+        )
+        logger.info(f"Stored profile of {run} for {user} ({duration:.3f}s)")
+
+
+def profiled(run: str) -> Callable:
+    """
+    Decorator that profiles calls of a method of an object with profiler
+    (None to disable) and user attributes, such as Giga. A run_id argument
+    (positional or keyword) is stored with the profile; otherwise the
+    method can report the run_id it uses with set_run_id.
+    """
+    def decorator(method: Callable) -> Callable:
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            run_id = signature.bind_partial(self, *args, **kwargs).arguments.get('run_id')
+            with self.profiler.profile(run, self.user, run_id=run_id):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def encode_stats(stats: dict) -> str:
+    # same marshal format as pstats.Stats.dump_stats
+    return base64.b64encode(marshal.dumps(stats)).decode('ascii')
+
+
+def load_stats(encoded: str) -> pstats.Stats:
+    stats = pstats.Stats()
+    stats.stats = marshal.loads(base64.b64decode(encoded))
+    stats.get_top_level_stats()
+    return stats
+
+
+def function_label(key: FunctionKey) -> str:
+    file_name, line, name = key
+    if file_name == '~':
+        return name # built-in
+    return f"{name} ({file_name.rsplit('/', 1)[-1]}:{line})"
+
+
+def cumulative_times(stats: pstats.Stats) -> dict[FunctionKey, float]:
+    return {key: value[3] for key, value in stats.stats.items()}
+
+
+def diff_stats(
+    before: pstats.Stats, after: pstats.Stats
+) -> list[tuple[FunctionKey, float, float]]:
+    """
+    Cumulative seconds per function in both profiles, largest change first.
+    """
+    before_times, after_times = cumulative_times(before), cumulative_times(after)
+    rows = [
+        (key, before_times.get(key, 0.0), after_times.get(key, 0.0))
+        for key in before_times.keys() | after_times.keys()
+    ]
+    return sorted(rows, key=lambda row: abs(row[2] - row[1]), reverse=True)
+
+
+def folded_stacks(stats: pstats.Stats, max_depth: int = 64) -> dict[str, float]:
+    """
+    Approximate call stacks in the folded format of flamegraph.pl and
+    speedscope ("root;child;leaf seconds"). cProfile only records
+    caller/callee pairs, so a function's time is split between its callers
+    in proportion to the time each caller spent in it.
+    """
+    children: dict[FunctionKey, dict[FunctionKey, float]] = {}
+    for callee, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, {})[callee] = caller_stats[3]
+    roots = [key for key, value in stats.stats.items() if not value[4]]
+
+    stacks: dict[str, float] = {}
+
+    def walk(key: FunctionKey, path: list[FunctionKey], seconds: float):
+        _, _, own, cumulative, _ = stats.stats[key]
+        ratio = seconds / cumulative if cumulative else 0.0
+        path = path + [key]
+        stack = ";".join(function_label(k) for k in path)
+        stacks[stack] = stacks.get(stack, 0.0) + own * ratio
+        if len(path) >= max_depth:
+            return
+        for child, child_seconds in children.get(key, {}).items():
+            if child not in path and child_seconds * ratio > 0:
+                walk(child, path, child_seconds * ratio)
+
+    for root in roots:
+        walk(root, [], stats.stats[root][3])
+    return stacks
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m chadGPT.profiling",
+        description="Inspect pipeline profiles stored in the database",
+    )
+    parser.add_argument("--db", default="sqlite:///data/chadGPT.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="list stored profiles")
+    list_parser.add_argument("--user")
+    show_parser = commands.add_parser("show", help="print the top functions of a profile")
+    show_parser.add_argument("id", type=int)
+    show_parser.add_argument("--limit", type=int, default=30)
+    show_parser.add_argument("--sort", default="cumulative")
+    diff_parser = commands.add_parser("diff", help="compare two profiles")
+    diff_parser.add_argument("before", type=int)
+    diff_parser.add_argument("after", type=int)
+    diff_parser.add_argument("--limit", type=int, default=30)
+    flame_parser = commands.add_parser(
+        "flamegraph", help="print folded stacks (pipe into flamegraph.pl or load in speedscope)"
+    )
+    flame_parser.add_argument("id", type=int)
+    args = parser.parse_args(argv)
+
+    db = SQLiteDatabase(args.db)
+
+    def get_stats(profile_id: int) -> pstats.Stats:
+        records = db.read(id=profile_id, category='profile')
+        if not records:
+            parser.error(f"no profile with id {profile_id}")
+        return load_stats(records[0].action['stats'])
+
+    if args.command == "list":
+        filters = {'category': 'profile'}
+        if args.user:
+            filters['user'] = args.user
+        for record in db.read(**filters):
+            action = record.action
+            print(
+                f"{record.id}\t{record.timestamp.isoformat()}\t{record.user}\t" +
+                f"{action['run']}\t{action['duration']:.3f}s\t{action.get('run_id') or ''}"
+            )
+    elif args.command == "show":
+        get_stats(args.id).sort_stats(args.sort).print_stats(args.limit)
+    elif args.command == "diff":
+        rows = diff_stats(get_stats(args.before), get_stats(args.after))
+        print(f"{'before':>10} {'after':>10} {'change':>10}  function")
+        for key, before, after in rows[:args.limit]:
+            print(f"{before:10.4f} {after:10.4f} {after - before:+10.4f}  {function_label(key)}")
+    elif args.command == "flamegraph":
+        for stack, seconds in folded_stacks(get_stats(args.id)).items():
+            microseconds = round(seconds * 1e6)
+            if microseconds > 0:
+                print(f"{stack} {microseconds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,132 @@
 from abc import ABC, abstractmethod
-from typing import Any
+from concurrent.futures import (
+    FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+from datetime import datetime
+from typing import Any, Literal
+import contextvars
+import logging
+import time
+
+from pydantic import BaseModel
 
 from chadGPT.data_models import Task, Job
+from chadGPT.profiling import Profiler
+
+
+logger = logging.getLogger(__name__)
+
+
+def cron_field_matches(field: str, value: int, low: int, high: int) -> bool:
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-'))
+        else:
+            start = end = int(part)
+            if step:
+                end = high
+        if start <= value <= end and (value - start) % int(step or 1) == 0:
+            return True
+    return False
+
+
+def cron_matches(schedule: str, when: datetime) -> bool:
+    """
+    Whether a cron schedule (minute hour day month weekday) fires at when.
+    """
+    minute, hour, day, month, weekday = schedule.split()
+    cron_weekday = when.isoweekday() % 7  # cron: 0 (or 7) is Sunday
+    day_matches = cron_field_matches(day, when.day, 1, 31)
+    weekday_matches = (
+        cron_field_matches(weekday, cron_weekday, 0, 7)
+        or (cron_weekday == 0 and cron_field_matches(weekday, 7, 0, 7))
+    )
+    if day != '*' and weekday != '*':
+        # cron fires when either the day of month or the weekday matches
+        day_matches = day_matches or weekday_matches
+    else:
+        day_matches = day_matches and weekday_matches
+    return (
+        cron_field_matches(minute, when.minute, 0, 59)
+        and cron_field_matches(hour, when.hour, 0, 23)
+        and cron_field_matches(month, when.month, 1, 12)
+        and day_matches
+    )
+
+
+class JobRunReport(BaseModel):
+    task_seconds: dict[str, float]
+    critical_path: list[str]
+    critical_path_seconds: float
+    wall_seconds: float
+
+
+def task_names(job: Job) -> list[str]:
+    names = [task.name or f"task_{i}" for i, task in enumerate(job.tasks)]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Task names must be unique: {names}")
+    return names
+
+
+def topological_order(job: Job) -> list[int]:
+    """
+    Task indices ordered so every task comes after its dependencies.
+    """
+    names = task_names(job)
+    index = {name: i for i, name in enumerate(names)}
+    for task in job.tasks:
+        for dependency in task.depends_on:
+            if dependency not in index:
+                raise ValueError(f"Unknown task dependency: {dependency}")
+
+    order: list[int] = []
+    state: dict[int, str] = {}
+
+    def visit(i: int):
+        if state.get(i) == 'done':
+            return
+        if state.get(i) == 'visiting':
+            raise ValueError(f"Dependency cycle at task {names[i]}")
+        state[i] = 'visiting'
+        for dependency in job.tasks[i].depends_on:
+            visit(index[dependency])
+        state[i] = 'done'
+        order.append(i)
+
+    for i in range(len(job.tasks)):
+        visit(i)
+    return order
+
+
+def as_args(output: Any) -> tuple:
+    # task outputs should be tuples; None passes nothing along the edge
+    if output is None:
+        return ()
+    return output if isinstance(output, tuple) else (output,)
+
 
 class Scheduler(ABC):
-    def __init__(self, job: Job):
+    def __init__(
+        self,
+        job: Job,
+        max_workers: int | None = None,
+        executor: Literal['thread', 'process'] = 'thread',
+        profiler: Profiler | None = None,
+    ):
         self.job = job
-    
+        self.max_workers = max_workers
+        self.executor = executor
+        self.profiler = profiler
+        self.last_report: JobRunReport | None = None
+
     @abstractmethod
     def schedule(self):
         # schedule the "run" function of this object based on the self.job.schedule
         pass
-    
+
     @staticmethod
     def run_task(task: Task, previous_task_output: tuple[Any] | None = None):
         task_args = task.args or ()
@@ -24,10 +139,112 @@ class Scheduler(ABC):
 
         return output
 
+    @staticmethod
+    def timed_run_task(task: Task, previous_task_output: tuple[Any]) -> tuple[Any, float]:
+        start = time.perf_counter()
+        output = Scheduler.run_task(task, previous_task_output)
+        return output, time.perf_counter() - start
+
     def run(self):
+        if self.profiler is None:
+            return self.run_job()
+        # jobs are named "<user>:<kind>" by the orchestrators
+        name = self.job.name or 'job'
+        user = name.partition(':')[0] if ':' in name else 'scheduler'
+        with self.profiler.profile(name, user):
+            return self.run_job()
+
+    def run_job(self):
+        if any(task.depends_on for task in self.job.tasks):
+            return self.run_dag()
+
         output = None
         for task in self.job.tasks:
             output = self.run_task(task, output)
-        
+
         return output
 
+    def make_executor(self) -> Executor:
+        if self.executor == 'process':
+            # tasks (and their funcs) must be picklable
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run_dag(self):
+        """
+        Run the job's tasks as a DAG, starting every task as soon as all of
+        its dependencies are done. A task receives its own args followed by
+        the outputs of its dependencies (in depends_on order). Returns the
+        output of the final task, or a dict of outputs by name if the DAG has
+        several final tasks. The timings are kept in self.last_report.
+        """
+        tasks = self.job.tasks
+        names = task_names(self.job)
+        order = topological_order(self.job)
+        index = {name: i for i, name in enumerate(names)}
+        dependencies = [[index[d] for d in task.depends_on] for task in tasks]
+
+        outputs: dict[int, Any] = {}
+        seconds: dict[int, float] = {}
+        running: dict[Any, int] = {}
+        start = time.perf_counter()
+
+        with self.make_executor() as executor:
+            def submit_ready():
+                for i in order:
+                    if i in outputs or i in running.values():
+                        continue
+                    if all(d in outputs for d in dependencies[i]):
+                        edge_args = tuple(
+                            arg for d in dependencies[i] for arg in as_args(outputs[d])
+                        )
+                        if self.executor == 'thread':
+                            # tasks see the caller's context (e.g. the work queue lease)
+                            future = executor.submit(
+                                contextvars.copy_context().run,
+                                self.timed_run_task, tasks[i], edge_args
+                            )
+                        else:
+                            future = executor.submit(self.timed_run_task, tasks[i], edge_args)
+                        running[future] = i
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    outputs[i], seconds[i] = future.result()
+                submit_ready()
+
+        wall_seconds = time.perf_counter() - start
+
+        # critical path: the chain of dependencies with the longest total time
+        finish: dict[int, float] = {}
+        previous: dict[int, int | None] = {}
+        for i in order:
+            slowest = max(dependencies[i], key=lambda d: finish[d], default=None)
+            previous[i] = slowest
+            finish[i] = seconds[i] + (finish[slowest] if slowest is not None else 0.0)
+        path = []
+        step = max(finish, key=finish.get, default=None)
+        while step is not None:
+            path.append(names[step])
+            step = previous[step]
+
+        self.last_report = JobRunReport(
+            task_seconds={names[i]: seconds[i] for i in order},
+            critical_path=path[::-1],
+            critical_path_seconds=max(finish.values(), default=0.0),
+            wall_seconds=wall_seconds,
+        )
+        logger.info(
+            f"Job finished in {wall_seconds:.3f}s; critical path " +
+            f"{' -> '.join(self.last_report.critical_path)} " +
+            f"({self.last_report.critical_path_seconds:.3f}s)"
+        )
+
+        used = {d for deps in dependencies for d in deps}
+        final = [i for i in order if i not in used]
+        if len(final) == 1:
+            return outputs[final[0]]
+        return {names[i]: outputs[i] for i in final}
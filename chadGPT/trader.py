@@ -1,10 +1,18 @@
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
+from typing import Callable
+import logging
+
+import numpy as np
 
 from chadGPT.data_models import (
     TradeOrder, Rule, Position, Portfolio, RelativePortfolio,
-    Stock, StockBar
+    Stock, StockBar, Fill
 )
+from chadGPT.db import get_current_utc_time
+
+
+logger = logging.getLogger(__name__)
 
 # generic trade model
 class BaseBroker(ABC):
@@ -29,12 +37,15 @@ class BaseMarketResearch(ABC):
 
 def make_trades_from_portfolio(
     current_portfolio: Portfolio,
-    desired_portfolio: RelativePortfolio
+    desired_portfolio: RelativePortfolio,
+    prices: dict[str, float] | None = None
 ) -> list[TradeOrder]:
     """
     Compare current portfolio to desired portfolio and generate TradeOrders
-    to rebalance positions.
+    to rebalance positions. Prices (per share) are needed to size buys of
+    symbols that are not held yet.
     """
+    prices = prices or {}
     trades: list[TradeOrder] = []
 
     # Build lookup for current positions
@@ -74,7 +85,8 @@ def make_trades_from_portfolio(
     for symbol, desired in desired_positions.items():
         if symbol not in current_positions:
             # Buy new position
-            amount = (desired.percent_of_portfolio * total_value) / desired_portfolio.cash if desired_portfolio.cash > 0 else 0
+            price = prices.get(symbol)
+            amount = (desired.percent_of_portfolio * total_value) / price if price else 0
             trades.append(TradeOrder(
                 type='buy',
                 symbol=symbol,
@@ -85,6 +97,244 @@ def make_trades_from_portfolio(
 
     return trades
 
+def find_exit_triggers(
+    entry_prices: np.ndarray,
+    stop_loss_pct: np.ndarray,
+    take_profit_pct: np.ndarray,
+    opens: np.ndarray,
+    lows: np.ndarray,
+    highs: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the first bar where each position hits its stop-loss or take-profit.
+
+    entry_prices, stop_loss_pct and take_profit_pct have shape (n,) with nan
+    for a missing rule; opens, lows and highs have shape (n, t), one row of
+    bars per position (nan padded). Rows can come from any number of
+    portfolios.
+
+    Returns (bar_index, exit_price, is_stop_loss), each of shape (n,), with
+    bar_index -1 where nothing triggered. A stop-loss wins when both levels
+    are hit within the same bar, and a bar that gaps through a level exits
+    at its open.
+    """
+    stop_prices = entry_prices * (1 - stop_loss_pct)
+    take_prices = entry_prices * (1 + take_profit_pct)
+    with np.errstate(invalid='ignore'):
+        stop_hit = lows <= stop_prices[:, None]
+        take_hit = highs >= take_prices[:, None]
+    hit = stop_hit | take_hit
+
+    triggered = hit.any(axis=1)
+    first = hit.argmax(axis=1)
+    rows = np.arange(len(entry_prices))
+    is_stop_loss = triggered & stop_hit[rows, first]
+    first_open = opens[rows, first]
+    exit_prices = np.where(
+        is_stop_loss,
+        np.fmin(first_open, stop_prices),
+        np.fmax(first_open, take_prices),
+    )
+    return (
+        np.where(triggered, first, -1),
+        np.where(triggered, exit_prices, np.nan),
+        is_stop_loss,
+    )
+
+
+def stack_bars(bars: list[StockBar]) -> tuple[dict[str, int], np.ndarray, np.ndarray]:
+    """
+    Arrange bars into per-symbol rows ordered by time (nan padded).
+    Returns (symbol -> row, times (object array), ohlc array of shape (4, s, t)).
+    """
+    by_symbol: dict[str, list[StockBar]] = {}
+    for bar in sorted(bars, key=lambda b: b.time):
+        by_symbol.setdefault(bar.symbol, []).append(bar)
+    rows = {symbol: i for i, symbol in enumerate(by_symbol)}
+    width = max((len(b) for b in by_symbol.values()), default=0)
+    ohlc = np.full((4, len(rows), width), np.nan)
+    times = np.full((len(rows), width), None, dtype=object)
+    for symbol, symbol_bars in by_symbol.items():
+        i, n = rows[symbol], len(symbol_bars)
+        ohlc[0, i, :n] = [b.open for b in symbol_bars]
+        ohlc[1, i, :n] = [b.high for b in symbol_bars]
+        ohlc[2, i, :n] = [b.low for b in symbol_bars]
+        ohlc[3, i, :n] = [b.close for b in symbol_bars]
+        times[i, :n] = [b.time for b in symbol_bars]
+    return rows, times, ohlc
+
+
+class SimulatedBroker(BaseBroker):
+    """
+    In-memory broker that keeps real positions and cash. Orders fill
+    immediately at the market's current price (or at the next bar's open if
+    there is no price yet), moved against the trader by slippage_pct. Buys
+    are capped by the cash available and sells by the shares held (no
+    leverage, no shorting). Stop-loss/take-profit rules are checked against
+    their entry (average cost) price whenever bars are processed.
+    """
+    def __init__(
+        self,
+        market: BaseMarketResearch,
+        cash: float = 100_000.0,
+        clock: Callable[[], datetime] = get_current_utc_time,
+        slippage_pct: float = 0.0,
+    ):
+        self.market = market
+        self.cash = cash
+        self.clock = clock
+        self.slippage_pct = slippage_pct
+        self.shares: dict[str, float] = {}
+        self.rules: dict[str, Rule] = {}
+        self.entry_prices: dict[str, float] = {}
+        self.pending: list[TradeOrder] = []
+        self.fills: list[Fill] = []
+        self.client_order_ids: set[str] = set()
+
+    def get_price(self, symbol: str) -> float | None:
+        stock = self.market.get_current_value(symbol)
+        return stock.price if stock is not None else None
+
+    def create_order(self, trade: TradeOrder):
+        if trade.client_order_id is not None:
+            if trade.client_order_id in self.client_order_ids:
+                logger.info(f"Ignoring duplicate order {trade.client_order_id}")
+                return None
+            self.client_order_ids.add(trade.client_order_id)
+
+        price = self.get_price(trade.symbol)
+        if not price:
+            logger.debug(f"No price for {trade.symbol}; filling at the next bar")
+            self.pending.append(trade)
+            return None
+        return self.fill(trade, price, self.clock())
+
+    def fill(
+        self, trade: TradeOrder, price: float, time: datetime,
+        reason: str = 'order'
+    ) -> Fill | None:
+        held = self.shares.get(trade.symbol, 0.0)
+        if trade.type == 'buy':
+            price *= 1 + self.slippage_pct
+            shares = min(trade.amount, self.cash / price)
+            if shares <= 0:
+                return None
+            self.cash -= shares * price
+            self.shares[trade.symbol] = held + shares
+            self.entry_prices[trade.symbol] = (
+                held * self.entry_prices.get(trade.symbol, price) + shares * price
+            ) / (held + shares)
+            self.rules[trade.symbol] = trade.rules
+        else:
+            price *= 1 - self.slippage_pct
+            shares = min(trade.amount, held)
+            if shares <= 0:
+                return None
+            self.cash += shares * price
+            self.shares[trade.symbol] = held - shares
+            if self.shares[trade.symbol] <= 1e-9:
+                del self.shares[trade.symbol]
+                self.rules.pop(trade.symbol, None)
+                self.entry_prices.pop(trade.symbol, None)
+
+        fill = Fill(
+            type=trade.type, symbol=trade.symbol, shares=shares,
+            price=price, time=time, reason=reason
+        )
+        self.fills.append(fill)
+        return fill
+
+    def process_bars(self, bars: list[StockBar]) -> list[Fill]:
+        """
+        Fill pending orders and apply stop-loss/take-profit rules over a batch
+        of bars that come after everything processed so far.
+        """
+        return process_bar_batch([self], bars)
+
+    def get_portfolio(self) -> Portfolio:
+        positions = []
+        for symbol, shares in self.shares.items():
+            price = self.get_price(symbol) or 0.0
+            positions.append(Position(
+                symbol=symbol,
+                shares=shares,
+                rules=self.rules[symbol],
+                value=shares * price
+            ))
+        return Portfolio(
+            positions=positions,
+            cash=self.cash,
+            total_value=self.cash + sum(pos.value for pos in positions),
+            timestamp=self.clock()
+        )
+
+
+def process_bar_batch(
+    brokers: list[SimulatedBroker], bars: list[StockBar]
+) -> list[Fill]:
+    """
+    Process one batch of bars for many simulated brokers at once: pending
+    orders fill at the first bar's open, then the stop-loss/take-profit
+    rules of every position in every broker are evaluated in a single
+    vectorized pass.
+    """
+    rows, times, (opens, highs, lows, _) = stack_bars(bars)
+    fills: list[Fill] = []
+
+    for broker in brokers:
+        pending, broker.pending = broker.pending, []
+        for trade in pending:
+            row = rows.get(trade.symbol)
+            if row is None:
+                broker.pending.append(trade)
+                continue
+            fill = broker.fill(trade, opens[row, 0], times[row, 0])
+            if fill is not None:
+                fills.append(fill)
+
+    owners: list[tuple[SimulatedBroker, str]] = []
+    symbol_rows, entry_prices, stop_loss_pct, take_profit_pct = [], [], [], []
+    for broker in brokers:
+        for symbol, shares in broker.shares.items():
+            row = rows.get(symbol)
+            rules = broker.rules[symbol]
+            if row is None or (rules.stop_loss_pct is None and rules.take_profit_pct is None):
+                continue
+            owners.append((broker, symbol))
+            symbol_rows.append(row)
+            entry_prices.append(broker.entry_prices[symbol])
+            stop_loss_pct.append(np.nan if rules.stop_loss_pct is None else rules.stop_loss_pct)
+            take_profit_pct.append(np.nan if rules.take_profit_pct is None else rules.take_profit_pct)
+    if not owners:
+        return fills
+
+    symbol_rows = np.array(symbol_rows)
+    bar_index, exit_prices, is_stop_loss = find_exit_triggers(
+        np.array(entry_prices),
+        np.array(stop_loss_pct),
+        np.array(take_profit_pct),
+        opens[symbol_rows],
+        lows[symbol_rows],
+        highs[symbol_rows],
+    )
+
+    for i in np.flatnonzero(bar_index >= 0):
+        broker, symbol = owners[i]
+        fill = broker.fill(
+            TradeOrder(
+                type='sell', symbol=symbol, amount=broker.shares[symbol],
+                trade_time=None, rules=broker.rules[symbol]
+            ),
+            price=float(exit_prices[i]),
+            time=times[symbol_rows[i], bar_index[i]],
+            reason='stop_loss' if is_stop_loss[i] else 'take_profit'
+        )
+        if fill is not None:
+            fills.append(fill)
+
+    return fills
+
+
 # testing implementation
 
 class FakeBroker(BaseBroker):
@@ -0,0 +1,357 @@
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Optional
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from sqlmodel import Field, SQLModel
+
+from chadGPT.data_models import Job
+from chadGPT.db import as_utc, get_current_utc_time
+from chadGPT.profiling import Profiler
+from chadGPT.scheduler import Scheduler, cron_matches
+
+# general workflow
+# 1. every scheduler process calls enqueue_due_jobs each minute; the job key
+#    (job name + scheduled minute) is unique, so each due job is queued once
+# 2. workers on any node claim items under a lease and heartbeat while running
+# 3. items whose lease expired (crashed worker) can be claimed again
+# delivery is at-least-once, execution is exactly-once: a worker that lost its
+# lease may still be running the job when another worker claims it, so jobs
+# call check_lease() right before side effects (e.g. submitting orders) to
+# stop a stale run, and key their side effects by current_job_key() so the
+# next attempt at the item resumes the work instead of repeating it
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkItemTable(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    job_key: str = Field(unique=True)
+    job_name: str = Field(index=True)
+    scheduled_time: datetime
+    status: str = Field(default='pending', index=True) # pending, running, done, failed
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[datetime] = None
+    attempts: int = 0 # also the fencing token of the current lease
+    finished: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class BaseWorkQueue(ABC):
+    @abstractmethod
+    def enqueue(self, job_name: str, scheduled_time: datetime) -> bool:
+        """
+        Queue a job run; returns False if that run was already queued.
+        """
+        pass
+
+    @abstractmethod
+    def claim(self, worker_id: str, lease_seconds: float) -> WorkItemTable | None:
+        """
+        Lease the oldest runnable item (pending, or running with an expired
+        lease) to worker_id.
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, item: WorkItemTable, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Extend the lease; returns False if worker_id no longer holds it.
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, item: WorkItemTable, worker_id: str, error: str | None = None) -> bool:
+        """
+        Mark the item done (or failed); returns False if the lease was lost.
+        """
+        pass
+
+    @abstractmethod
+    def holds(self, item: WorkItemTable, worker_id: str) -> bool:
+        """
+        Whether worker_id still holds an unexpired lease on the item (the
+        attempts count is the fencing token).
+        """
+        pass
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    def __init__(self, queue: BaseWorkQueue, item: WorkItemTable, worker_id: str):
+        self.queue = queue
+        self.item = item
+        self.worker_id = worker_id
+        self.lost = threading.Event() # set by the heartbeat when it fails
+
+    def check(self) -> None:
+        if self.lost.is_set() or not self.queue.holds(self.item, self.worker_id):
+            self.lost.set()
+            raise LeaseLost(f"{self.worker_id} no longer holds {self.item.job_key}")
+
+
+_current_lease: ContextVar[Lease | None] = ContextVar('current_lease', default=None)
+
+
+def current_job_key() -> str | None:
+    """
+    Key of the work item the job runs for; the same for every attempt at the
+    item, so jobs use it as the idempotency key of their side effects. None
+    outside of a Worker.
+    """
+    lease = _current_lease.get()
+    return lease.item.job_key if lease is not None else None
+
+
+def check_lease() -> None:
+    """
+    Raise LeaseLost if the job runs from a work queue item whose lease this
+    worker lost. Does nothing outside of a Worker.
+    """
+    lease = _current_lease.get()
+    if lease is not None:
+        lease.check()
+
+
+class SQLiteWorkQueue(BaseWorkQueue):
+    """
+    Work queue in a shared SQL database (any SQLAlchemy URL; SQLite for
+    tests and single machines). Claims, heartbeats and completions are
+    compare-and-set updates, so only one worker holds an item at a time and
+    a worker whose lease expired can no longer complete it.
+    """
+    def __init__(self, db_url: str, max_attempts: int = 3):
+        from sqlmodel import create_engine
+        self.engine = create_engine(db_url)
+        self.max_attempts = max_attempts
+        SQLModel.metadata.create_all(self.engine)
+
+    def enqueue(self, job_name: str, scheduled_time: datetime) -> bool:
+        from sqlalchemy.exc import IntegrityError
+        from sqlmodel import Session
+        # the same slot gives the same key whether it came naive or aware
+        scheduled_time = as_utc(scheduled_time)
+        item = WorkItemTable(
+            job_key=f"{job_name}@{scheduled_time.isoformat()}",
+            job_name=job_name,
+            scheduled_time=scheduled_time,
+        )
+        with Session(self.engine) as session:
+            session.add(item)
+            try:
+                session.commit()
+            except IntegrityError:
+                return False
+        return True
+
+    def claim(self, worker_id: str, lease_seconds: float) -> WorkItemTable | None:
+        from sqlmodel import Session, and_, or_, select, update
+        while True:
+            now = get_current_utc_time()
+            runnable = and_(
+                or_(
+                    WorkItemTable.status == 'pending',
+                    and_(
+                        WorkItemTable.status == 'running',
+                        WorkItemTable.lease_expires < now
+                    ),
+                ),
+                WorkItemTable.scheduled_time <= now,
+            )
+            with Session(self.engine) as session:
+                candidate = session.exec(
+                    select(WorkItemTable).where(runnable)
+                    .order_by(WorkItemTable.scheduled_time, WorkItemTable.id)
+                    .limit(1)
+                ).first()
+                if candidate is None:
+                    return None
+
+                if candidate.attempts >= self.max_attempts:
+                    session.execute(
+                        update(WorkItemTable)
+                        .where(WorkItemTable.id == candidate.id, runnable)
+                        .values(status='failed', error='too many attempts', finished=now)
+                    )
+                    session.commit()
+                    continue
+
+                result = session.execute(
+                    update(WorkItemTable)
+                    .where(
+                        WorkItemTable.id == candidate.id,
+                        WorkItemTable.attempts == candidate.attempts,
+                        runnable,
+                    )
+                    .values(
+                        status='running',
+                        lease_owner=worker_id,
+                        lease_expires=now + timedelta(seconds=lease_seconds),
+                        attempts=candidate.attempts + 1,
+                    )
+                )
+                session.commit()
+                if result.rowcount == 1:
+                    session.refresh(candidate)
+                    session.expunge(candidate)
+                    return candidate
+            # another worker won the race; try the next item
+
+    def _update_leased(self, item: WorkItemTable, worker_id: str, **values) -> bool:
+        from sqlmodel import Session, update
+        with Session(self.engine) as session:
+            result = session.execute(
+                update(WorkItemTable)
+                .where(
+                    WorkItemTable.id == item.id,
+                    WorkItemTable.status == 'running',
+                    WorkItemTable.lease_owner == worker_id,
+                    WorkItemTable.attempts == item.attempts,
+                )
+                .values(**values)
+            )
+            session.commit()
+            return result.rowcount == 1
+
+    def holds(self, item: WorkItemTable, worker_id: str) -> bool:
+        from sqlmodel import Session, select
+        with Session(self.engine) as session:
+            held = session.exec(
+                select(WorkItemTable.id).where(
+                    WorkItemTable.id == item.id,
+                    WorkItemTable.status == 'running',
+                    WorkItemTable.lease_owner == worker_id,
+                    WorkItemTable.attempts == item.attempts,
+                    WorkItemTable.lease_expires > get_current_utc_time(),
+                )
+            ).first()
+            return held is not None
+
+    def heartbeat(self, item: WorkItemTable, worker_id: str, lease_seconds: float) -> bool:
+        now = get_current_utc_time()
+        return self._update_leased(
+            item, worker_id, lease_expires=now + timedelta(seconds=lease_seconds)
+        )
+
+    def complete(self, item: WorkItemTable, worker_id: str, error: str | None = None) -> bool:
+        return self._update_leased(
+            item, worker_id,
+            status='failed' if error else 'done',
+            error=error,
+            finished=get_current_utc_time(),
+            lease_expires=None,
+        )
+
+
+class QueueScheduler(Scheduler):
+    """
+    Scheduler that queues its job in a shared work queue when it is due
+    instead of running it, so redundant scheduler processes queue it once.
+    """
+    def __init__(self, job: Job, queue: BaseWorkQueue, **kwargs):
+        super().__init__(job, **kwargs)
+        if job.name is None:
+            raise ValueError("Jobs run through a work queue need a name")
+        self.queue = queue
+
+    def schedule(self, now: datetime | None = None) -> bool:
+        now = as_utc(now or get_current_utc_time()).replace(second=0, microsecond=0)
+        if not cron_matches(self.job.schedule, now):
+            return False
+        return self.queue.enqueue(self.job.name, now)
+
+
+def enqueue_due_jobs(
+    queue: BaseWorkQueue, jobs: list[Job], now: datetime | None = None
+) -> list[str]:
+    """
+    Queue every job that is due this minute; returns the names queued.
+    """
+    return [
+        job.name for job in jobs
+        if QueueScheduler(job, queue).schedule(now)
+    ]
+
+
+class Worker:
+    """
+    Claims work items and runs the matching job while heartbeating its lease.
+    Delivery is at-least-once: if the lease expires mid-run, another worker
+    may run the item again while this run continues. Jobs get exactly-once
+    effects by calling check_lease() before each side effect and keying
+    their effects by current_job_key(); only the holder of the current
+    fencing token can complete the item.
+    """
+    def __init__(
+        self,
+        queue: BaseWorkQueue,
+        jobs: list[Job],
+        worker_id: str | None = None,
+        lease_seconds: float = 60.0,
+        profiler: Profiler | None = None,
+    ):
+        self.queue = queue
+        self.schedulers = {
+            job.name: QueueScheduler(job, queue, profiler=profiler) for job in jobs
+        }
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+
+    def run_once(self) -> bool:
+        """
+        Run one claimed item; returns False if there was nothing to run.
+        """
+        item = self.queue.claim(self.worker_id, self.lease_seconds)
+        if item is None:
+            return False
+
+        scheduler = self.schedulers.get(item.job_name)
+        if scheduler is None:
+            logger.error(f"No job named {item.job_name}")
+            self.queue.complete(item, self.worker_id, error="unknown job")
+            return True
+
+        done = threading.Event()
+        lease = Lease(self.queue, item, self.worker_id)
+
+        def heartbeat():
+            while not done.wait(self.lease_seconds / 3):
+                if not self.queue.heartbeat(item, self.worker_id, self.lease_seconds):
+                    logger.warning(f"Lost the lease on {item.job_key}")
+                    lease.lost.set()
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        token = _current_lease.set(lease)
+        error = None
+        try:
+            scheduler.run()
+        except LeaseLost:
+            logger.warning(f"Stopped {item.job_key}: lease lost")
+            error = "lease lost"
+        except Exception as e:
+            logger.exception(f"Job {item.job_key} failed")
+            error = repr(e)
+        finally:
+            _current_lease.reset(token)
+            done.set()
+            heartbeat_thread.join()
+
+        if not self.queue.complete(item, self.worker_id, error=error):
+            logger.warning(f"Could not complete {item.job_key}: lease lost")
+        return True
+
+    def run(self, stop: threading.Event, poll_seconds: float = 1.0) -> None:
+        while not stop.is_set():
+            if not self.run_once():
+                stop.wait(poll_seconds)
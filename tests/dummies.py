@@ -0,0 +1,47 @@
+"""
+Dummy LLM, broker and market shared by the tests and the benchmarks.
+"""
+from datetime import datetime, timezone
+
+from chadGPT.brain import BaseLLM
+from chadGPT.data_models import Portfolio, Position, Rule
+from chadGPT.trader import BaseBroker, BaseMarketResearch
+
+
+class DummyLLM(BaseLLM):
+    def __init__(self):
+        self.last_request = None
+
+    def submit_query(self, query: str) -> str:
+        # Always return a valid JSON for the expected format
+        if "StrategyResponse" in query:
+            return '{"strategy_report": "Test strategy", "stock_symbols_to_watch": ["AAPL", "GOOGL"]}'
+        elif "RelativePortfolio" in query:
+            return '{"positions": [{"symbol": "AAPL", "percent_of_portfolio": 0.5, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}, {"symbol": "GOOGL", "percent_of_portfolio": 0.5, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}], "percent_cash": 0.0}'
+        return '{}'
+
+class DummyBroker(BaseBroker):
+    def __init__(self):
+        self.orders = []
+        self._portfolio = Portfolio(
+            positions=[
+                Position(symbol="AAPL", shares=10, value=1500.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
+                Position(symbol="GOOGL", shares=5, value=2000.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
+            ],
+            cash=1000.0,
+            total_value=4500.0,
+            timestamp=datetime.now(timezone.utc)
+        )
+
+    def create_order(self, trade):
+        self.orders.append(trade)
+
+    def get_portfolio(self):
+        return self._portfolio
+
+class DummyMarket(BaseMarketResearch):
+    def get_current_value(self, symbol: str):
+        return None
+
+    def get_historic_value(self, symbol: str, start: datetime, end: datetime, aggregation: str):
+        return []
@@ -0,0 +1,124 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from chadGPT.archive import ActionArchive, RetentionPolicy
+from chadGPT.db import BlobTable, SQLiteDatabase
+
+NOW = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+# ---- Fixtures ----
+
+@pytest.fixture
+def db(tmp_path):
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'hot.db'}")
+    for day in range(30, 0, -1):
+        for user in ("alice", "bob"):
+            db.write(
+                user=user, category='strategy',
+                action={'query': f"{user} day {day} " * 200, 'day': day},
+                timestamp=NOW - timedelta(days=day)
+            )
+            db.write(
+                user=user, category='checkpoint',
+                action={'run_id': f"{user}-{day}", 'stage': 'complete', 'data': None},
+                timestamp=NOW - timedelta(days=day)
+            )
+    yield db
+    db.engine.dispose()
+
+def blob_count(db: SQLiteDatabase) -> int:
+    from sqlmodel import Session, select
+    with Session(db.engine) as session:
+        return len(session.exec(select(BlobTable)).all())
+
+# ---- Tests ----
+
+def test_compact_keeps_latest_or_recent_records(db, tmp_path):
+    archive = ActionArchive(db, str(tmp_path / "archive"), [
+        RetentionPolicy(category='strategy', keep_latest=5),
+        RetentionPolicy(category='checkpoint', keep_days=7),
+    ])
+    assert blob_count(db) == 60
+    assert archive.compact(now=NOW) == 2 * 25 + 2 * 23
+
+    hot_strategies = db.read(user="alice", category='strategy')
+    assert [r.action['day'] for r in hot_strategies] == [5, 4, 3, 2, 1]
+    assert len(db.read(user="alice", category='checkpoint')) == 7
+    # blobs of archived records are collected, the others are kept
+    assert blob_count(db) == 10
+    assert hot_strategies[0].action['query'].startswith("alice day 5")
+
+    day_dirs = os.listdir(tmp_path / "archive" / "strategy")
+    assert len(day_dirs) == 25
+    # compacting again has nothing left to archive
+    assert archive.compact(now=NOW) == 0
+
+def test_read_spans_hot_table_and_archive(db, tmp_path):
+    archive = ActionArchive(db, str(tmp_path / "archive"), [
+        RetentionPolicy(category='strategy', keep_latest=3, keep_days=10),
+    ])
+    archive.compact(now=NOW)
+    assert len(db.read(user="bob", category='strategy')) == 10 # days 10 to 1
+
+    records = archive.read(user="bob", category='strategy')
+    assert [r.action['day'] for r in records] == list(range(30, 0, -1))
+    assert records[0].action['query'].startswith("bob day 30")
+    assert [r.id for r in records] == sorted(r.id for r in records)
+
+    window = archive.read(
+        category='strategy', start=NOW - timedelta(days=12), end=NOW - timedelta(days=8)
+    )
+    assert sorted((r.user, r.action['day']) for r in window) == [
+        (user, day) for user in ("alice", "bob") for day in (9, 10, 11, 12)
+    ]
+    assert all(r.timestamp.tzinfo is not None for r in window)
+
+def test_rows_archived_before_a_crash_are_read_once(db, tmp_path):
+    archive = ActionArchive(db, str(tmp_path / "archive"), [
+        RetentionPolicy(category='checkpoint', keep_latest=1),
+    ])
+    # archive files are written but the rows are not deleted yet
+    ids = archive.expired_ids(archive.policies[0], NOW)
+    archive.write_partitions('checkpoint', [r for r in db.read(category='checkpoint') if r.id in ids])
+    assert len(archive.read(category='checkpoint')) == 60
+    assert archive.compact(now=NOW) == 58
+    assert len(archive.read(category='checkpoint')) == 60
+
+def test_rows_archived_again_after_a_crash_are_read_once(db, tmp_path):
+    archive = ActionArchive(db, str(tmp_path / "archive"), [
+        RetentionPolicy(category='strategy', keep_latest=1),
+    ])
+    # a crash between writing the files of a smaller batch and deleting its rows
+    ids = archive.expired_ids(archive.policies[0], NOW)
+    archive.write_partitions('strategy', [r for r in db.read(category='strategy') if r.id in ids[:7]])
+    # the next compact archives those rows again, in files named by other id ranges
+    archive.batch_size = 4
+    assert archive.compact(now=NOW) == 58
+    files = [f for _, _, names in os.walk(tmp_path / "archive") for f in names]
+    assert len(files) > 29
+
+    archived = archive.read_archive(category='strategy')
+    assert sorted(r.id for r in archived) == ids
+    records = archive.read(category='strategy')
+    assert len(records) == 60
+    assert len({r.id for r in records}) == 60
+
+def test_expired_ids_normalize_now_to_utc(db, tmp_path):
+    archive = ActionArchive(db, str(tmp_path / "archive"), [
+        RetentionPolicy(category='checkpoint', keep_days=7),
+    ])
+    policy = archive.policies[0]
+    expected = archive.expired_ids(policy, NOW)
+    assert len(expected) == 2 * 23
+    # naive times are taken to be UTC, other time zones are converted
+    assert archive.expired_ids(policy, NOW.replace(tzinfo=None)) == expected
+    assert archive.expired_ids(policy, NOW.astimezone(timezone(timedelta(hours=-5)))) == expected
+    assert archive.compact(now=NOW.replace(tzinfo=None)) == 2 * 23
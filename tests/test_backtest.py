@@ -0,0 +1,143 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import math
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chadGPT.backtest import Backtest, HistoricalMarket, SimulatedClock
+from chadGPT.brain import BaseLLM, CachedLLM
+from chadGPT.data_models import Portfolio, Position, Preferences, StockBar
+from chadGPT.trader import BaseBroker
+
+# ---- Fixtures ----
+
+class DummyLLM(BaseLLM):
+    def __init__(self):
+        self.calls = 0
+
+    def submit_query(self, query: str) -> str:
+        self.calls += 1
+        if "StrategyResponse" in query:
+            return '{"strategy_report": "Test strategy", "stock_symbols_to_watch": ["AAPL", "GOOGL"]}'
+        return '{"positions": [{"symbol": "AAPL", "percent_of_portfolio": 0.5, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}, {"symbol": "GOOGL", "percent_of_portfolio": 0.4, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}], "percent_cash": 0.1}'
+
+class LedgerBroker(BaseBroker):
+    # fills every order in full at the current price and keeps the ledger
+    def __init__(self, market, clock, cash: float = 100_000.0):
+        self.market = market
+        self.clock = clock
+        self.cash = cash
+        self.positions: dict[str, Position] = {}
+        self.fill_times = []
+
+    def create_order(self, trade):
+        price = self.market.get_current_value(trade.symbol).price
+        sign = 1 if trade.type == 'buy' else -1
+        held = self.positions.get(trade.symbol)
+        shares = (held.shares if held else 0.0) + sign * trade.amount
+        self.positions[trade.symbol] = Position(
+            symbol=trade.symbol, shares=shares, value=0.0, rules=trade.rules
+        )
+        self.cash -= sign * trade.amount * price
+        self.fill_times.append(self.clock())
+
+    def get_portfolio(self):
+        positions = [
+            pos.model_copy(update={
+                'value': pos.shares * self.market.get_current_value(pos.symbol).price
+            })
+            for pos in self.positions.values()
+        ]
+        return Portfolio(
+            positions=positions, cash=self.cash,
+            total_value=self.cash + sum(pos.value for pos in positions),
+            timestamp=self.clock()
+        )
+
+def make_bars(days: int) -> list[StockBar]:
+    start = datetime(2024, 1, 1, 21, tzinfo=timezone.utc)
+    bars = []
+    for day in range(days):
+        for symbol, base in [("AAPL", 100.0), ("GOOGL", 200.0)]:
+            price = base * (1 + 0.1 * math.sin(day / 10))
+            bars.append(StockBar(
+                symbol=symbol, time=start + timedelta(days=day),
+                open=price, high=price * 1.01, low=price * 0.99, close=price,
+                volume=1000, trade_count=10, volume_weighted_avg_price=price
+            ))
+    return bars
+
+# ---- Tests ----
+
+def test_historical_market_has_no_look_ahead():
+    bars = make_bars(10)
+    clock = SimulatedClock(bars[0].time)
+    market = HistoricalMarket(bars, clock)
+    clock.set(bars[0].time + timedelta(days=3, hours=1))
+
+    assert market.get_current_value("AAPL").time == bars[0].time + timedelta(days=3)
+    history = market.get_historic_value(
+        "AAPL", start=bars[0].time, end=bars[0].time + timedelta(days=30),
+        aggregation='daily'
+    )
+    assert len(history) == 4
+    assert market.get_current_value("MSFT") is None
+
+def test_simulated_clock_cannot_go_back():
+    clock = SimulatedClock(datetime(2024, 1, 2))
+    with pytest.raises(ValueError):
+        clock.set(datetime(2024, 1, 1))
+
+def test_backtest_runs_on_simulated_time():
+    bars = make_bars(60)
+    llm = DummyLLM()
+    backtest = Backtest(
+        bars, research_brain=llm, broker_factory=LedgerBroker, user_preferences=Preferences()
+    )
+    result = backtest.run()
+
+    assert len(result.equity_curve) == 60
+    assert result.portfolio_updates == 60
+    assert result.strategy_updates == 9  # 2024-01-01 to 2024-02-29 spans 9 iso weeks
+    assert llm.calls == 69
+    assert result.trades
+    assert result.equity_curve[0].total_value == pytest.approx(100_000.0)
+    assert result.equity_curve[-1].total_value != pytest.approx(100_000.0)
+    # everything is stamped with simulated time
+    assert all(time.year == 2024 for time in backtest.broker.fill_times)
+    records = backtest.giga.db.read(user="backtest_user", category='strategy')
+    assert records[-1].timestamp.replace(tzinfo=timezone.utc) <= bars[-1].time
+
+def test_backtest_replays_cached_llm(tmp_path):
+    bars = make_bars(20)
+    cache_path = str(tmp_path / "llm_cache.json")
+    first = Backtest(
+        bars, research_brain=CachedLLM(DummyLLM(), cache_path), broker_factory=LedgerBroker
+    ).run()
+
+    # replay only: any query that was not recorded raises KeyError
+    second = Backtest(
+        bars, research_brain=CachedLLM(cache_path=cache_path), broker_factory=LedgerBroker
+    ).run()
+    assert second.equity_curve == first.equity_curve
+    # client_order_id is unique per run
+    assert [t.model_dump(exclude={'client_order_id'}) for t in second.trades] == [
+        t.model_dump(exclude={'client_order_id'}) for t in first.trades
+    ]
+
+def test_backtest_fills_on_simulated_broker():
+    bars = make_bars(30)
+    result = Backtest(bars, research_brain=DummyLLM(), slippage_pct=0.001).run()
+
+    assert result.fills and result.trades
+    assert all(fill.time.year == 2024 for fill in result.fills)
+    # slippage costs money on the first day's buys
+    assert result.equity_curve[0].total_value < 100_000.0
+    # and makes them fill above the close of their bar
+    closes = {(bar.symbol, bar.time): bar.close for bar in bars}
+    buy = next(fill for fill in result.fills if fill.type == 'buy')
+    assert buy.price > closes[(buy.symbol, buy.time)]
@@ -0,0 +1,51 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import time
+
+from benchmarks.run import BenchmarkResult, Case, compare, main, measure
+
+# ---- Tests ----
+
+def test_benchmarks_save_and_compare(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    args = ["--quick", "--only", "make_trades", "--repeat", "1", "--min-time", "0.01"]
+    assert main(args + ["--save", str(baseline)]) == 0
+    saved = json.loads(baseline.read_text())
+    assert set(saved) == {
+        "make_trades_from_portfolio[positions=10]",
+        "make_trades_from_portfolio[positions=100]",
+    }
+    assert main(args + ["--compare", str(baseline), "--tolerance", "10"]) == 0
+
+def test_compare_flags_regressions(capsys):
+    result = BenchmarkResult(name="case", best=2.0, median=2.0, number=1, repeat=1)
+    baseline = {"case": {"best": 1.0}}
+    assert compare([result], baseline, tolerance=0.5) == ["case"]
+    assert compare([result], baseline, tolerance=1.5) == []
+    assert "REGRESSION" in capsys.readouterr().out
+
+def test_measure_resets_state_before_each_repeat():
+    rows = []
+    resets = []
+    case = Case(
+        func=lambda: (rows.append(1), time.sleep(0.002)),
+        reset=lambda: (resets.append(len(rows)), rows.clear())
+    )
+    result = measure("append", case, repeat=3, min_time=0.001)
+    # one call already takes longer than min_time, so each repeat makes one
+    # call (autorange would make enough calls for 0.2s)
+    assert result.repeat == 3 and result.number == 1
+    # calibration call, then one full repeat of number calls each time
+    assert resets == [0, 1, result.number, result.number]
+
+def test_measure_calibrates_calls_to_min_time():
+    calls = []
+    case = Case(func=lambda: (calls.append(1), time.sleep(0.002)))
+    result = measure("sleep", case, repeat=2, min_time=0.01)
+    # a call takes at least 2ms, so at most 5 calls fill 10ms
+    assert 1 <= result.number <= 5
+    assert len(calls) == 1 + 2 * result.number
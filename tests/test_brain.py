@@ -0,0 +1,191 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import random
+import time
+
+import pytest
+
+from chadGPT.brain import BaseLLM, RoutedLLM, assemble_context, estimate_tokens
+from chadGPT.data_models import (
+    ContextItem, LLMRequest, Position, Rule, StrategyResponse
+)
+
+# ---- Fixtures ----
+
+class FakeBackend(BaseLLM):
+    """
+    Backend whose latency is drawn from a distribution (seconds).
+    """
+    def __init__(self, latency, answer: str, fail: bool = False, seed: int = 0):
+        self.latency = latency
+        self.answer = answer
+        self.fail = fail
+        self.calls = 0
+        self.rng = random.Random(seed)
+
+    def submit_query(self, query: str) -> str:
+        self.calls += 1
+        time.sleep(self.latency(self.rng))
+        if self.fail:
+            raise ConnectionError("backend down")
+        return self.answer
+
+STRATEGY_JSON = '{"strategy_report": "Test strategy", "stock_symbols_to_watch": ["AAPL"]}'
+
+def strategy_request() -> LLMRequest:
+    return LLMRequest(
+        prompt="Pretty Please", background="Testing", context="context",
+        expected_format=StrategyResponse
+    )
+
+def make_position(symbol: str) -> Position:
+    return Position(
+        symbol=symbol, shares=10, value=1000.0,
+        rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)
+    )
+
+# ---- Tests ----
+
+def test_assemble_context_without_budget_keeps_everything():
+    context = [
+        ContextItem(content="low " * 100, priority=0),
+        ContextItem(content=make_position("AAPL"), priority=2),
+    ]
+    text = assemble_context(context)
+    assert "low " * 100 in text
+    assert "Position:" in text
+
+def test_assemble_context_prunes_lowest_priority_first():
+    context = [
+        ContextItem(content="important", priority=3),
+        ContextItem(content="x" * 4000, priority=0),
+        ContextItem(content=make_position("AAPL"), priority=2),
+    ]
+    text = assemble_context(context, token_budget=200)
+    assert estimate_tokens(text) <= 200 + 4  # braces
+    assert "important" in text
+    assert "AAPL" in text
+    assert "[truncated]" in text
+
+def test_assemble_context_uses_summary():
+    context = [
+        ContextItem(content="y" * 4000, priority=0, summary="short summary"),
+        ContextItem(content="keep me", priority=1),
+    ]
+    text = assemble_context(context, token_budget=50)
+    assert "short summary" in text
+    assert "y" * 100 not in text
+    assert "keep me" in text
+
+def test_make_query_respects_token_budget():
+    request = LLMRequest(
+        prompt="Pretty Please",
+        background="Testing",
+        context=[
+            ContextItem(content=make_position(str(i)), priority=0)
+            for i in range(200)
+        ],
+        expected_format=StrategyResponse,
+        token_budget=1000
+    )
+    unbounded = BaseLLM.make_query(request.model_copy(update={'token_budget': None}))
+    query = BaseLLM.make_query(request)
+    assert estimate_tokens(unbounded) > 1000
+    assert estimate_tokens(query) <= 1000 + 10
+    assert "<prompt> Pretty Please </prompt>" in query
+    assert "StrategyResponse" in query
+
+def shared_prefix_length(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a, b]))
+
+def test_cache_friendly_layout_shares_static_prefix():
+    requests = [
+        LLMRequest(
+            prompt="Pretty Please",
+            background="Testing",
+            context=[f"CURRENT_TIME: 2025-01-0{i}", make_position(symbol)],
+            expected_format=StrategyResponse,
+            layout='cache_friendly'
+        )
+        for i, symbol in [(1, "AAPL"), (2, "GOOGL")]
+    ]
+    default_queries = [
+        BaseLLM.make_query(r.model_copy(update={'layout': 'default'}))
+        for r in requests
+    ]
+    queries = [BaseLLM.make_query(r) for r in requests]
+
+    static_length = queries[0].index("<context>")
+    assert shared_prefix_length(*queries) >= static_length
+    assert shared_prefix_length(*default_queries) < static_length
+    # same blocks, different order
+    assert sorted(queries[0]) == sorted(default_queries[0])
+
+def test_routed_llm_hedges_slow_primary():
+    primary = FakeBackend(lambda rng: 1.0, STRATEGY_JSON)
+    secondary = FakeBackend(lambda rng: rng.uniform(0.001, 0.01), STRATEGY_JSON)
+    llm = RoutedLLM([primary, secondary], initial_hedge_delay=0.05)
+
+    start = time.monotonic()
+    answer = llm.ask(strategy_request())
+    assert time.monotonic() - start < 0.5
+    assert isinstance(answer, StrategyResponse)
+    assert primary.calls == 1 and secondary.calls == 1
+
+def test_routed_llm_hedge_delay_follows_latency_percentile():
+    backend = FakeBackend(lambda rng: rng.expovariate(1000), STRATEGY_JSON)
+    llm = RoutedLLM([backend], initial_hedge_delay=10.0, min_samples=5)
+    assert llm.hedge_delay(0) == 10.0
+    for _ in range(20):
+        llm.ask(strategy_request())
+    assert llm.hedge_delay(0) < 0.1
+
+def test_routed_llm_skips_invalid_responses():
+    primary = FakeBackend(lambda rng: 0.0, "not json")
+    secondary = FakeBackend(lambda rng: 0.02, STRATEGY_JSON)
+    llm = RoutedLLM([primary, secondary], initial_hedge_delay=5.0)
+    answer = llm.ask(strategy_request())
+    assert answer.strategy_report == "Test strategy"
+
+def test_routed_llm_falls_back_when_primary_degraded():
+    primary = FakeBackend(lambda rng: 0.0, STRATEGY_JSON, fail=True)
+    fallback = FakeBackend(lambda rng: 0.0, STRATEGY_JSON)
+    llm = RoutedLLM([primary, fallback], max_consecutive_failures=2)
+    for _ in range(2):
+        llm.ask(strategy_request())
+    assert llm.is_degraded(0)
+    assert llm.route() == [1, 0]
+
+    primary_calls = primary.calls
+    llm.ask(strategy_request())
+    assert primary.calls == primary_calls
+
+def test_routed_llm_raises_when_all_backends_fail():
+    llm = RoutedLLM([FakeBackend(lambda rng: 0.0, "", fail=True)])
+    with pytest.raises(RuntimeError):
+        llm.submit_query("query")
+
+def test_routed_llm_reuses_one_thread_pool():
+    primary = FakeBackend(lambda rng: 0.2, STRATEGY_JSON)
+    secondary = FakeBackend(lambda rng: 0.0, STRATEGY_JSON)
+    llm = RoutedLLM([primary, secondary], initial_hedge_delay=0.01, max_workers=2)
+    executor = llm._executor
+    for _ in range(3):
+        assert llm.ask(strategy_request()).strategy_report == "Test strategy"
+    assert llm._executor is executor
+    assert len(executor._threads) <= 2
+    llm.close()
+
+def test_routed_llm_min_samples():
+    with pytest.raises(ValueError):
+        RoutedLLM([FakeBackend(lambda rng: 0.0, STRATEGY_JSON)], min_samples=0)
+    # a failure before any latency sample with a degraded latency set
+    llm = RoutedLLM(
+        [FakeBackend(lambda rng: 0.0, "", fail=True)], min_samples=1, degraded_latency=0.5
+    )
+    with pytest.raises(RuntimeError):
+        llm.submit_query("query")
+    assert not llm.is_degraded(0)
@@ -0,0 +1,185 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta, timezone
+import random
+
+import pytest
+
+from chadGPT.db import BaseDatabase, BlobTable, SQLiteDatabase, is_blob_ref
+
+# ---- Fixtures ----
+
+@pytest.fixture
+def db(tmp_path):
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'blobs.db'}")
+    yield db
+    db.engine.dispose()
+
+def raw_actions(db: SQLiteDatabase) -> list[dict]:
+    from sqlalchemy import text
+    from sqlmodel import Session
+    import json
+    with Session(db.engine) as session:
+        rows = session.execute(text("SELECT action FROM actiontable ORDER BY id")).all()
+    return [json.loads(row[0]) for row in rows]
+
+def blob_count(db: SQLiteDatabase) -> int:
+    from sqlmodel import Session, select
+    with Session(db.engine) as session:
+        return len(session.exec(select(BlobTable)).all())
+
+# ---- Tests ----
+
+def test_large_values_are_stored_once_as_blobs(db):
+    strategy = {'strategy_report': "buy the dip " * 200, 'stock_symbols_to_watch': ["AAPL"]}
+    query = "You are an absolute gigachad investment banker. " * 100
+    db.write(user="alice", category='strategy', action={'query': query, 'response': strategy})
+    db.write(user="alice", category='trades', action={'strategy': strategy, 'trades': [], 'run_id': "r1"})
+
+    strategy_row, trades_row = raw_actions(db)
+    assert is_blob_ref(strategy_row['query'])
+    assert is_blob_ref(strategy_row['response'])
+    assert trades_row['strategy'] == strategy_row['response']
+    assert trades_row['trades'] == [] and trades_row['run_id'] == "r1"
+    assert blob_count(db) == 2
+
+    strategy_record, trades_record = db.read(user="alice")
+    assert strategy_record.action['query'] == query
+    assert strategy_record.action.get('response') == strategy
+    assert trades_record.action.resolve() == {'strategy': strategy, 'trades': [], 'run_id': "r1"}
+    assert db.read_latest(user="alice").action['strategy'] == strategy
+
+def test_blobs_are_loaded_lazily(db):
+    db.write(user="bob", category='strategy', action={'query': "x" * 5000, 'run_id': "r1"})
+    record = db.read_latest(user="bob")
+    assert is_blob_ref(dict.__getitem__(record.action, 'query'))
+    assert record.action['run_id'] == "r1"
+    assert is_blob_ref(dict.__getitem__(record.action, 'query'))
+    assert record.action['query'] == "x" * 5000
+
+    # each access gets its own copy of a cached blob
+    db.write(user="bob", category='trades', action={'strategy': {'report': "y" * 5000}})
+    first = db.read_latest(user="bob").action['strategy']
+    first['report'] = "changed"
+    assert db.read_latest(user="bob").action['strategy'] == {'report': "y" * 5000}
+
+def test_blobs_can_be_disabled(tmp_path):
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'inline.db'}", blob_threshold=None)
+    db.write(user="carol", category='strategy', action={'query': "x" * 5000})
+    assert raw_actions(db) == [{'query': "x" * 5000}]
+    assert blob_count(db) == 0
+    db.engine.dispose()
+
+def write_history(db: SQLiteDatabase, start: datetime, days: int = 40):
+    rng = random.Random(0)
+    symbols = ["AAPL", "GOOGL", "MSFT", "TSLA"]
+    for day in range(days):
+        timestamp = start + timedelta(days=day, hours=rng.randint(0, 23))
+        for user in ("alice", "bob"):
+            trades = [
+                {'type': rng.choice(['buy', 'sell']), 'symbol': rng.choice(symbols),
+                 'amount': rng.randint(1, 100), 'trade_time': None,
+                 'rules': {'stop_loss_pct': 0.1, 'take_profit_pct': 0.2}}
+                # some days have enough trades to be stored as a blob
+                for _ in range(rng.choice([0, 2, 30]))
+            ]
+            db.write(user=user, category='trades', action={'trades': trades}, timestamp=timestamp)
+            report = rng.choice(["short", "long " * 300]) + str(day // rng.choice([3, 7]))
+            db.write(
+                user=user, category='strategy',
+                action={'query': "q", 'response': {'strategy_report': report}},
+                timestamp=timestamp
+            )
+
+def test_analytics_match_python_aggregation(db):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    write_history(db, start)
+    window = {'start': start + timedelta(days=5), 'end': start + timedelta(days=30)}
+
+    for period in ('day', 'week', 'month'):
+        assert list(db.trade_activity(period=period)) == list(
+            BaseDatabase.trade_activity(db, period=period)
+        )
+        assert list(db.trade_activity(user="bob", period=period, **window)) == list(
+            BaseDatabase.trade_activity(db, user="bob", period=period, **window)
+        )
+        assert list(db.symbol_exposure(user="alice", period=period)) == list(
+            BaseDatabase.symbol_exposure(db, user="alice", period=period)
+        )
+        assert list(db.strategy_changes(period=period, **window)) == list(
+            BaseDatabase.strategy_changes(db, period=period, **window)
+        )
+
+    exposure = list(db.symbol_exposure(period='month', symbols=["AAPL"]))
+    assert {row.symbol for row in exposure} == {"AAPL"}
+    assert [row.period for row in exposure] == ["2024-01", "2024-02"]
+    changes = list(db.strategy_changes(user="alice", period='month'))
+    assert sum(row.strategies for row in changes) == 40
+    assert 0 < sum(row.changes for row in changes) < 40
+
+def test_index_trades_backfills_existing_actions(db):
+    from sqlalchemy import text
+    from sqlmodel import Session
+    write_history(db, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    before = list(db.trade_activity())
+    with Session(db.engine) as session:
+        session.execute(text("DELETE FROM tradeindextable"))
+        session.commit()
+    assert list(db.trade_activity()) == []
+
+    indexed = db.index_trades()
+    assert indexed == sum(row.trades for row in before)
+    assert list(db.trade_activity()) == before
+    assert db.index_trades() == 0
+
+def test_read_matching_uses_run_id_index(db):
+    from sqlalchemy import text
+    from sqlmodel import Session
+    for i in range(20):
+        db.write(user="alice", category='checkpoint', action={'run_id': f"r{i % 4}", 'stage': str(i)})
+    db.write(user="bob", category='checkpoint', action={'run_id': "r1", 'stage': "other"})
+
+    records = db.read_matching({'run_id': "r1"}, user="alice", category='checkpoint')
+    assert [r.action['stage'] for r in records] == ["1", "5", "9", "13", "17"]
+    assert [r.id for r in records] == [
+        r.id for r in BaseDatabase.read_matching(db, {'run_id': "r1"}, user="alice", category='checkpoint')
+    ]
+    with Session(db.engine) as session:
+        plan = session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM actiontable " +
+            "WHERE json_extract(action, '$.run_id') = 'r1'"
+        )).all()
+    assert any("ix_actiontable_run_id" in row[-1] for row in plan)
+
+def test_weeks_spanning_new_year_are_one_iso_week(db):
+    trade = {'type': 'buy', 'symbol': "AAPL", 'amount': 1, 'trade_time': None, 'rules': None}
+    for day in ("2020-12-30", "2021-01-03", "2021-01-04", "2024-12-29", "2024-12-31", "2025-01-02"):
+        timestamp = datetime.fromisoformat(day).replace(hour=12, tzinfo=timezone.utc)
+        db.write(user="alice", category='trades', action={'trades': [trade]}, timestamp=timestamp)
+
+    activity = list(db.trade_activity(period='week'))
+    assert [(row.period, row.trades) for row in activity] == [
+        ("2020-W53", 2), ("2021-W01", 1), ("2024-W52", 1), ("2025-W01", 2)
+    ]
+    assert activity == list(BaseDatabase.trade_activity(db, period='week'))
+
+def test_index_trades_keeps_blob_references(tmp_path):
+    from sqlalchemy import text
+    from sqlmodel import Session
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'index.db'}", blob_threshold=50)
+    trades = [
+        {'type': 'buy', 'symbol': "AAPL", 'amount': i, 'trade_time': None, 'rules': None}
+        for i in range(1, 5)
+    ]
+    db.write(user="alice", category='trades', action={'trades': trades})
+    with Session(db.engine) as session:
+        session.execute(text("DELETE FROM tradeindextable"))
+        session.commit()
+
+    assert db.index_trades() == 4
+    assert is_blob_ref(raw_actions(db)[0]['trades'])
+    assert sum(row.trades for row in db.trade_activity()) == 4
+    db.engine.dispose()
@@ -0,0 +1,119 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timedelta, timezone
+import time
+
+import pytest
+
+from chadGPT.brain import BaseLLM
+from chadGPT.data_models import Portfolio, Preferences, Stock, StockBar
+from chadGPT.db import SQLiteDatabase
+from chadGPT.giga import Giga
+from chadGPT.metrics import Tracer, tracer
+from chadGPT.trader import BaseBroker, BaseMarketResearch
+
+NOW = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+
+# ---- Fixtures ----
+
+class DummyLLM(BaseLLM):
+    def submit_query(self, query: str) -> str:
+        if "StrategyResponse" in query:
+            return '{"strategy_report": "Test strategy", "stock_symbols_to_watch": ["AAPL"]}'
+        return '{"positions": [{"symbol": "AAPL", "percent_of_portfolio": 1.0, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}], "percent_cash": 0.0}'
+
+class DummyBroker(BaseBroker):
+    def __init__(self):
+        self.orders = []
+
+    def create_order(self, trade):
+        self.orders.append(trade)
+
+    def get_portfolio(self):
+        return Portfolio(positions=[], cash=1000.0, total_value=1000.0, timestamp=NOW)
+
+class DummyMarket(BaseMarketResearch):
+    def get_current_value(self, symbol: str):
+        return Stock(symbol=symbol, price=100.0, time=NOW)
+
+    def get_historic_value(self, symbol, start, end, aggregation):
+        return [
+            StockBar(
+                symbol=symbol, time=NOW - timedelta(days=i), open=100.0, high=101.0,
+                low=99.0, close=100.0, volume=100, trade_count=1,
+                volume_weighted_avg_price=100.0
+            )
+            for i in range(3)
+        ]
+
+@pytest.fixture
+def clean_tracer():
+    tracer.reset()
+    yield tracer
+    tracer.reset()
+
+# ---- Tests ----
+
+def test_span_records_duration_and_parent():
+    local = Tracer()
+    with local.span('outer'):
+        with local.span('inner', bars=3) as span:
+            time.sleep(0.01)
+            span['prompt_chars'] = 120
+    inner, outer = local.spans
+    assert inner.name == 'inner' and inner.parent == 'outer'
+    assert outer.parent is None
+    assert inner.duration >= 0.01
+    assert outer.duration >= inner.duration
+    assert inner.attributes == {'bars': 3, 'prompt_chars': 120}
+
+def test_span_records_errors():
+    local = Tracer()
+    with pytest.raises(ValueError):
+        with local.span('failing'):
+            raise ValueError("boom")
+    assert 'boom' in local.spans[0].attributes['error']
+
+def test_prometheus_export(tmp_path):
+    local = Tracer()
+    with local.span('llm.make_query') as span:
+        span['prompt_chars'] = 100
+    text = local.to_prometheus()
+    assert "# TYPE chadgpt_stage_duration_seconds histogram" in text
+    assert 'chadgpt_stage_duration_seconds_count{stage="llm.make_query"} 1' in text
+    assert 'chadgpt_prompt_chars_bucket{stage="llm.make_query",le="64"} 0' in text
+    assert 'chadgpt_prompt_chars_bucket{stage="llm.make_query",le="256"} 1' in text
+    assert 'chadgpt_prompt_chars_sum{stage="llm.make_query"} 100' in text
+
+    file_path = tmp_path / "chadgpt.prom"
+    local.write_prometheus(str(file_path))
+    assert file_path.read_text() == text
+
+def test_giga_pipeline_spans(tmp_path, clean_tracer):
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'metrics.db'}")
+    giga = Giga(
+        broker=DummyBroker(), market=DummyMarket(),
+        portfolio_update_brain=DummyLLM(), research_brain=DummyLLM(),
+        user_preferences=Preferences(), db=db, user="test_user",
+        clock=lambda: NOW
+    )
+    giga.giga_pipeline()
+    db.engine.dispose()
+
+    spans = {}
+    for span in clean_tracer.spans:
+        spans.setdefault(span.name, []).append(span)
+    for stage in (
+        'giga.giga_pipeline', 'giga.generate_strategy', 'giga.gather_research_context',
+        'giga.update_portfolio_pipeline', 'giga.get_portfolio_updates',
+        'giga.gather_portfolio_update_context', 'llm.make_query', 'llm.submit_query',
+        'market.get_historic_value', 'broker.create_order', 'db.write',
+    ):
+        assert stage in spans, stage
+    assert spans['giga.generate_strategy'][0].parent == 'giga.giga_pipeline'
+    assert all(span.attributes['prompt_chars'] > 0 for span in spans['llm.make_query'])
+    assert spans['market.get_historic_value'][0].attributes['bars'] == 3
+    assert 'stage="giga.giga_pipeline"' in clean_tracer.to_prometheus()
@@ -0,0 +1,129 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import random
+from datetime import datetime, timezone
+
+from chadGPT.data_models import Portfolio, Position, Rule, Stock
+from chadGPT.monitor import RuleMonitor
+from chadGPT.trader import BaseBroker, FakeMarketResearch
+
+# ---- Fixtures ----
+
+class RecordingBroker(BaseBroker):
+    def __init__(self, positions: list[Position]):
+        self.orders = []
+        self.positions = positions
+
+    def create_order(self, trade):
+        self.orders.append(trade)
+
+    def get_portfolio(self):
+        return Portfolio(
+            positions=self.positions, cash=0.0,
+            total_value=sum(p.value for p in self.positions),
+            timestamp=datetime.now(timezone.utc)
+        )
+
+
+def position(symbol: str, price: float, stop_loss_pct=0.1, take_profit_pct=0.2) -> Position:
+    return Position(
+        symbol=symbol, shares=10, value=10 * price,
+        rules=Rule(stop_loss_pct=stop_loss_pct, take_profit_pct=take_profit_pct)
+    )
+
+
+def tick(symbol: str, price: float) -> Stock:
+    return Stock(symbol=symbol, price=price, time=datetime.now(timezone.utc))
+
+# ---- Tests ----
+
+def test_monitor_exits_crossed_positions_only():
+    alice = RecordingBroker([position("AAPL", 100.0), position("GOOGL", 100.0)])
+    bob = RecordingBroker([position("AAPL", 120.0)])
+    monitor = RuleMonitor()
+    monitor.add_account("alice", alice)
+    monitor.add_account("bob", bob)
+
+    # bob's stop (108) is crossed, alice's (90) is not
+    orders = monitor.on_price(tick("AAPL", 105.0))
+    assert [o.symbol for o in orders] == ["AAPL"]
+    assert bob.orders and not alice.orders
+
+    # alice's take profit (120) on AAPL; bob already exited
+    monitor.on_price(tick("AAPL", 121.0))
+    assert len(alice.orders) == 1 and len(bob.orders) == 1
+    assert alice.orders[0].amount == 10
+
+    # an exited position is not triggered again
+    assert monitor.on_price(tick("AAPL", 50.0)) == []
+
+def test_monitor_sync_keeps_levels_at_cost_basis():
+    broker = RecordingBroker([position("AAPL", 100.0)])
+    monitor = RuleMonitor()
+    monitor.add_account("alice", broker)
+    broker.positions = [position("AAPL", 105.0)]
+    monitor.sync_account("alice")
+
+    # the levels stay at 90 / 120 from the entry price of 100
+    assert monitor.run([tick("AAPL", 92.0), tick("AAPL", 119.0)]) == []
+
+    # 10 more shares bought at 130: the cost basis becomes 115 (stop 103.5)
+    broker.positions = [Position(
+        symbol="AAPL", shares=20, value=20 * 130.0,
+        rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.5)
+    )]
+    monitor.sync_account("alice")
+    assert monitor.run([tick("AAPL", 104.0)]) == []
+    assert len(monitor.run([tick("AAPL", 103.0)])) == 1
+
+def test_monitor_trailing_sync_moves_levels():
+    broker = RecordingBroker([position("AAPL", 100.0)])
+    monitor = RuleMonitor(trailing=True)
+    monitor.add_account("alice", broker)
+    broker.positions = [position("AAPL", 200.0)]
+    monitor.sync_account("alice")
+
+    # the old stop at 90 is gone; the new one is at 180
+    assert monitor.run([tick("AAPL", 185.0)]) == []
+    assert len(monitor.run([tick("AAPL", 179.0)])) == 1
+
+def test_monitor_sync_forgets_closed_positions():
+    broker = RecordingBroker([position("AAPL", 100.0)])
+    monitor = RuleMonitor()
+    monitor.add_account("alice", broker)
+    broker.positions = []
+    monitor.sync_account("alice")
+    # a new position in the same symbol starts from its own price
+    broker.positions = [position("AAPL", 200.0)]
+    monitor.sync_account("alice")
+    assert len(monitor.run([tick("AAPL", 179.0)])) == 1
+
+def test_monitor_poll_uses_market():
+    monitor = RuleMonitor()
+    monitor.add_account("alice", RecordingBroker([position("AAPL", 50.0)]))
+    # FakeMarketResearch always prices at 100, above the 60 take profit
+    assert len(monitor.poll(FakeMarketResearch())) == 1
+
+def test_monitor_many_accounts_matches_brute_force():
+    rng = random.Random(0)
+    monitor = RuleMonitor()
+    brokers = {}
+    for i in range(2000):
+        brokers[f"user{i}"] = RecordingBroker([
+            position("AAPL", rng.uniform(80, 120), rng.uniform(0.01, 0.2), rng.uniform(0.01, 0.2))
+        ])
+        monitor.add_account(f"user{i}", brokers[f"user{i}"])
+
+    prices = [100 * (1 + rng.gauss(0, 0.05)) for _ in range(200)]
+    monitor.run([tick("AAPL", p) for p in prices])
+
+    for broker in brokers.values():
+        pos = broker.positions[0]
+        reference = pos.value / pos.shares
+        stop = reference * (1 - pos.rules.stop_loss_pct)
+        take = reference * (1 + pos.rules.take_profit_pct)
+        expected = any(p <= stop or p >= take for p in prices)
+        assert bool(broker.orders) == expected
@@ -3,61 +3,22 @@ import sys
 # add the parent directory to the sys.path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from datetime import datetime, timedelta, timezone
+
 import pytest
-from datetime import datetime, timezone
 from typing import Any
 from chadGPT.giga import Giga
-from chadGPT.trader import BaseBroker, BaseMarketResearch
-from chadGPT.brain import BaseLLM
+from chadGPT.trader import FakeMarketResearch
 from chadGPT.db import SQLiteDatabase
+from tests.dummies import DummyBroker, DummyLLM, DummyMarket
 
 from chadGPT.data_models import (
-    Preferences, StrategyResponse, RelativePortfolio, Portfolio, Position, Rule,
+    Preferences, StrategyResponse, RelativePortfolio, Position, Rule,
     Task, Job, LLMRequest, RelativePosition
 )
 
 # ---- Fixtures ----
 
-class DummyLLM(BaseLLM):
-    def __init__(self):
-        self.last_request = None
-
-    def submit_query(self, query: str) -> str:
-        # Always return a valid JSON for the expected format
-        if "StrategyResponse" in query:
-            return '{"strategy_report": "Test strategy", "stock_symbols_to_watch": ["AAPL", "GOOGL"]}'
-        elif "RelativePortfolio" in query:
-            return '{"positions": [{"symbol": "AAPL", "percent_of_portfolio": 0.5, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}, {"symbol": "GOOGL", "percent_of_portfolio": 0.5, "rules": {"stop_loss_pct": 0.1, "take_profit_pct": 0.2}}], "percent_cash": 0.0}'
-        return '{}'
-
-class DummyBroker(BaseBroker):
-    def __init__(self):
-        self.orders = []
-        self._portfolio = Portfolio(
-            positions=[
-                Position(symbol="AAPL", shares=10, value=1500.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
-                Position(symbol="GOOGL", shares=5, value=2000.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
-            ],
-            cash=1000.0,
-            total_value=4500.0,
-            timestamp=datetime.now(timezone.utc)
-        )
-
-    def create_order(self, trade):
-        self.orders.append(trade)
-
-    def get_portfolio(self):
-        return self._portfolio
-
-class DummyMarket(BaseMarketResearch):
-    def get_current_value(self, symbol: str):
-        return None
-
-    def get_historic_value(self, symbol: str, start: datetime, end: datetime, aggregation: str):
-        return []
-
-
-
 @pytest.fixture(scope="module")
 def dummy_llm():
     return DummyLLM()
@@ -122,4 +83,164 @@ def test_create_jobs(giga):
     jobs = giga.create_jobs()
     assert isinstance(jobs, list)
     assert all(isinstance(job, Job) for job in jobs)
-    assert any(job.tasks for job in jobs)
\ No newline at end of file
+    assert any(job.tasks for job in jobs)
+
+
+def test_update_portfolio_pipeline_skips_unchanged():
+    class CountingLLM(DummyLLM):
+        calls = 0
+
+        def submit_query(self, query: str) -> str:
+            self.calls += 1
+            return super().submit_query(query)
+
+    class PricedMarket(FakeMarketResearch):
+        price = 100.0
+
+        def get_current_value(self, symbol: str):
+            stock = super().get_current_value(symbol)
+            stock.price = self.price
+            return stock
+
+    # portfolio already matches the DummyLLM target (50/50, no cash)
+    broker = DummyBroker()
+    broker._portfolio = broker._portfolio.model_copy(update={
+        'positions': [
+            Position(symbol="AAPL", shares=10, value=2250.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
+            Position(symbol="GOOGL", shares=5, value=2250.0, rules=Rule(stop_loss_pct=0.1, take_profit_pct=0.2)),
+        ],
+        'cash': 0.0,
+    })
+    llm = CountingLLM()
+    market = PricedMarket()
+    giga = Giga(
+        broker=broker,
+        market=market,
+        portfolio_update_brain=llm,
+        research_brain=llm,
+        user_preferences=Preferences(skip_unchanged_portfolio_updates=True),
+        db=SQLiteDatabase("sqlite://"),
+        user="skip_user"
+    )
+    strategy = StrategyResponse(strategy_report="Test", stock_symbols_to_watch=["AAPL", "GOOGL"])
+
+    giga.update_portfolio_pipeline(strategy=strategy)
+    assert llm.calls == 1
+
+    # nothing changed: no LLM call, no trades
+    assert giga.update_portfolio_pipeline(strategy=strategy) == []
+    assert llm.calls == 1
+
+    # prices moved more than the threshold
+    market.price = 105.0
+    giga.update_portfolio_pipeline(strategy=strategy)
+    assert llm.calls == 2
+
+    # strategy changed
+    new_strategy = strategy.model_copy(update={'strategy_report': "New"})
+    giga.update_portfolio_pipeline(strategy=new_strategy)
+    assert llm.calls == 3
+
+class CountingLLM(DummyLLM):
+    calls = 0
+
+    def submit_query(self, query: str) -> str:
+        self.calls += 1
+        return super().submit_query(query)
+
+class CrashingBroker(DummyBroker):
+    crash = True
+
+    def create_order(self, trade):
+        if self.crash and self.orders:
+            raise ConnectionError("crashed mid-way through the orders")
+        super().create_order(trade)
+
+def make_crashing_giga(user: str, **kwargs) -> tuple[Giga, CountingLLM, CrashingBroker]:
+    llm = CountingLLM()
+    broker = CrashingBroker()
+    giga = Giga(
+        broker=broker,
+        market=DummyMarket(),
+        portfolio_update_brain=llm,
+        research_brain=llm,
+        db=SQLiteDatabase("sqlite://"),
+        user=user,
+        **kwargs
+    )
+    return giga, llm, broker
+
+def test_update_portfolio_pipeline_resumes_after_crash():
+    giga, llm, broker = make_crashing_giga("crash_user")
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    assert llm.calls == 1
+    assert len(broker.orders) == 1
+
+    broker.crash = False
+    trades = giga.update_portfolio_pipeline()
+    # no second LLM call, and only the remaining order went out
+    assert llm.calls == 1
+    assert len(trades) == 2
+    assert [o.client_order_id for o in broker.orders] == [t.client_order_id for t in trades]
+    assert len({t.client_order_id for t in trades}) == 2
+
+    # the next run starts fresh
+    giga.update_portfolio_pipeline()
+    assert llm.calls == 2
+
+def test_update_portfolio_pipeline_abandons_run_of_other_strategy():
+    giga, llm, broker = make_crashing_giga("crash_user")
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    crashed_run = giga.get_unfinished_run()
+    assert crashed_run is not None
+
+    broker.crash = False
+    strategy = StrategyResponse(strategy_report="Only MSFT", stock_symbols_to_watch=["MSFT"])
+    trades = giga.update_portfolio_pipeline(strategy=strategy)
+    # the crashed run's plan is not reused: the LLM is asked again for the new strategy
+    assert llm.calls == 2
+    assert "abandoned" in giga.get_checkpoints(crashed_run)
+    assert not any(t.client_order_id.startswith(crashed_run) for t in trades)
+    assert [o.client_order_id for o in broker.orders[1:]] == [t.client_order_id for t in trades]
+    assert giga.get_unfinished_run() is None
+
+def test_update_portfolio_pipeline_abandons_stale_runs():
+    now = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+    giga, llm, broker = make_crashing_giga(
+        "crash_user", clock=lambda: now,
+        user_preferences=Preferences(max_resume_attempts=1)
+    )
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    first_run = giga.get_unfinished_run()
+    # the one allowed resume fails again
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    assert llm.calls == 1
+    # a run that keeps failing does not block later calls
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    assert llm.calls == 2
+    assert "abandoned" in giga.get_checkpoints(first_run)
+    second_run = giga.get_unfinished_run()
+    assert second_run not in (None, first_run)
+
+    # nor does a run that crashed too long ago
+    now += timedelta(hours=2)
+    broker.crash = False
+    giga.update_portfolio_pipeline()
+    assert llm.calls == 3
+    assert "abandoned" in giga.get_checkpoints(second_run)
+
+def test_update_portfolio_pipeline_without_save_to_db_writes_nothing():
+    giga, llm, broker = make_crashing_giga("crash_user")
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline(save_to_db=False)
+    assert giga.db.read() == []
+
+    broker.crash = False
+    giga.update_portfolio_pipeline(save_to_db=False)
+    assert llm.calls == 2
+    assert giga.db.read() == []
@@ -0,0 +1,175 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from datetime import datetime, timezone
+import time
+
+import pytest
+
+from chadGPT.brain import BaseLLM
+from chadGPT.data_models import Job, Portfolio, Preferences, Task
+from chadGPT.db import SQLiteDatabase
+from chadGPT.giga import Giga
+from chadGPT.profiling import (
+    Profiler, ProfilingConfig, diff_stats, folded_stacks, load_stats, main
+)
+from chadGPT.scheduler import Scheduler
+from chadGPT.trader import BaseBroker, BaseMarketResearch
+
+NOW = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+
+# ---- Fixtures ----
+
+class DummyLLM(BaseLLM):
+    def submit_query(self, query: str) -> str:
+        if "StrategyResponse" in query:
+            return '{"strategy_report": "Test strategy", "stock_symbols_to_watch": []}'
+        return '{"positions": [], "percent_cash": 1.0}'
+
+class DummyBroker(BaseBroker):
+    def create_order(self, trade):
+        pass
+
+    def get_portfolio(self):
+        return Portfolio(positions=[], cash=1000.0, total_value=1000.0, timestamp=NOW)
+
+class DummyMarket(BaseMarketResearch):
+    def get_current_value(self, symbol: str):
+        return None
+
+    def get_historic_value(self, symbol, start, end, aggregation):
+        return []
+
+class DummyScheduler(Scheduler):
+    def schedule(self):
+        pass
+
+def slow_step(seconds: float = 0.02):
+    time.sleep(seconds)
+
+def busy_loop(n: int):
+    return sum(i * i for i in range(n))
+
+@pytest.fixture
+def db(tmp_path):
+    db = SQLiteDatabase(f"sqlite:///{tmp_path / 'profiles.db'}")
+    yield db
+    db.engine.dispose()
+
+def make_giga(db, user: str, profiler: Profiler) -> Giga:
+    return Giga(
+        broker=DummyBroker(), market=DummyMarket(),
+        portfolio_update_brain=DummyLLM(), research_brain=DummyLLM(),
+        user_preferences=Preferences(), db=db, user=user,
+        clock=lambda: NOW, profiler=profiler
+    )
+
+# ---- Tests ----
+
+def test_profiles_selected_users_only(db):
+    profiler = Profiler(db, ProfilingConfig(users=["alice"]))
+    make_giga(db, "alice", profiler).giga_pipeline()
+    make_giga(db, "bob", profiler).giga_pipeline()
+
+    profiles = db.read(category='profile')
+    # nested generate_strategy / update_portfolio_pipeline calls are part of
+    # the outer giga_pipeline profile
+    assert [(p.user, p.action['run']) for p in profiles] == [("alice", "giga_pipeline")]
+    stats = load_stats(profiles[0].action['stats'])
+    functions = {name for _, _, name in stats.stats}
+    assert "make_trades_from_portfolio" in functions
+    assert "format_data_model" in functions
+    # the profile joins to the records of the portfolio update run it covers
+    trades = db.read_latest(user="alice", category='trades')
+    assert profiles[0].action['run_id'] == trades.action['run_id'] is not None
+
+def test_profile_records_positional_run_id(db):
+    profiler = Profiler(db, ProfilingConfig(users=["alice"]))
+    make_giga(db, "alice", profiler).update_portfolio_pipeline(None, True, "run-1")
+    assert [p.action['run_id'] for p in db.read(category='profile')] == ["run-1"]
+
+def test_latency_threshold_keeps_slow_runs(db):
+    profiler = Profiler(db, ProfilingConfig(latency_threshold=0.01, latency_sample_rate=1.0))
+    fast = Job(name="alice:fast", schedule="* * * * *", tasks=[Task(func=lambda: None)])
+    slow = Job(name="bob:slow", schedule="* * * * *", tasks=[Task(func=slow_step)])
+    DummyScheduler(fast, profiler=profiler).run()
+    DummyScheduler(slow, profiler=profiler).run()
+
+    profiles = db.read(category='profile')
+    assert [(p.user, p.action['run']) for p in profiles] == [("bob", "bob:slow")]
+    assert profiles[0].action['duration'] >= 0.01
+
+def test_latency_threshold_profiles_sampled_runs_only(db, monkeypatch):
+    import cProfile
+    created = []
+
+    class CountingProfile(cProfile.Profile):
+        def __init__(self):
+            super().__init__()
+            created.append(self)
+
+    monkeypatch.setattr(cProfile, 'Profile', CountingProfile)
+    profiler = Profiler(
+        db, ProfilingConfig(latency_threshold=0.0, latency_sample_rate=0.0)
+    )
+    slow = Job(name="bob:slow", schedule="* * * * *", tasks=[Task(func=slow_step)])
+    DummyScheduler(slow, profiler=profiler).run()
+    # no profiler ran, so unsampled runs pay no profiling overhead
+    assert created == []
+    assert db.read(category='profile') == []
+
+def test_one_run_is_profiled_at_a_time(db):
+    import threading
+    profiler = Profiler(db, ProfilingConfig(users=["alice", "bob"]))
+    started, release = threading.Event(), threading.Event()
+
+    def first_run():
+        with profiler.profile("first", "alice"):
+            started.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=first_run)
+    thread.start()
+    started.wait(5)
+    # a concurrent run in another thread is not profiled (and does not fail)
+    with profiler.profile("second", "bob"):
+        busy_loop(1_000)
+    release.set()
+    thread.join()
+    assert [p.action['run'] for p in db.read(category='profile')] == ["first"]
+
+def test_sample_rate(db):
+    profiler = Profiler(db, ProfilingConfig(sample_rate=1.0))
+    job = Job(name="carol:strategy", schedule="* * * * *", tasks=[Task(func=lambda: None)])
+    DummyScheduler(job, profiler=profiler).run()
+    assert len(db.read(category='profile')) == 1
+
+    profiler.config = ProfilingConfig(sample_rate=0.0)
+    DummyScheduler(job, profiler=profiler).run()
+    assert len(db.read(category='profile')) == 1
+
+def test_diff_and_flamegraph(db, capsys):
+    profiler = Profiler(db, ProfilingConfig(users=["alice"]))
+    for n in (1_000, 200_000):
+        job = Job(name="alice:loop", schedule="* * * * *", tasks=[Task(func=busy_loop, args=(n,))])
+        DummyScheduler(job, profiler=profiler).run()
+    before, after = (load_stats(p.action['stats']) for p in db.read(category='profile'))
+
+    rows = {key[2]: (old, new) for key, old, new in diff_stats(before, after)}
+    old, new = rows['busy_loop']
+    assert new - old > 0
+    stacks = folded_stacks(after)
+    loop_stacks = [stack for stack in stacks if 'busy_loop' in stack.split(';')[-1]]
+    assert loop_stacks and 'run_job' in loop_stacks[0]
+
+    db_url = str(db.engine.url)
+    main(["--db", db_url, "list"])
+    listed = capsys.readouterr().out.splitlines()
+    assert len(listed) == 2 and "alice:loop" in listed[0]
+    main(["--db", db_url, "flamegraph", listed[1].split()[0]])
+    folded = capsys.readouterr().out.splitlines()
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in folded)
+    main(["--db", db_url, "diff", listed[0].split()[0], listed[1].split()[0]])
+    assert "busy_loop" in capsys.readouterr().out
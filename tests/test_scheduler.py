@@ -0,0 +1,78 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+
+import pytest
+
+from chadGPT.data_models import Job, Task
+from chadGPT.scheduler import Scheduler
+
+# ---- Fixtures ----
+
+class ManualScheduler(Scheduler):
+    def schedule(self):
+        pass
+
+
+def slow(value, seconds: float = 0.1):
+    def func(*args):
+        time.sleep(seconds)
+        return (value, *args)
+    return func
+
+
+def add(*args):
+    return (sum(args),)
+
+# ---- Tests ----
+
+def test_sequential_job_is_unchanged():
+    job = Job(schedule="* * * * *", tasks=[
+        Task(func=lambda: (1, 2)),
+        Task(func=add, args=(3,)),
+    ])
+    assert ManualScheduler(job).run() == (6,)
+
+def test_dag_runs_independent_tasks_in_parallel():
+    job = Job(schedule="* * * * *", tasks=[
+        Task(name="portfolio", func=slow(1)),
+        Task(name="market_data", func=slow(2)),
+        Task(name="previous_strategy", func=slow(3, seconds=0.2)),
+        Task(
+            name="llm", func=add, args=(10,),
+            depends_on=["portfolio", "market_data", "previous_strategy"]
+        ),
+    ])
+    scheduler = ManualScheduler(job, max_workers=4)
+    assert scheduler.run() == (16,)
+
+    report = scheduler.last_report
+    assert report.wall_seconds < 0.35  # sequential would take 0.4s
+    assert report.critical_path == ["previous_strategy", "llm"]
+    assert report.critical_path_seconds == pytest.approx(0.2, abs=0.05)
+    assert set(report.task_seconds) == {"portfolio", "market_data", "previous_strategy", "llm"}
+
+def test_dag_returns_all_final_outputs():
+    job = Job(schedule="* * * * *", tasks=[
+        Task(name="a", func=lambda: (1,)),
+        Task(name="b", func=add, depends_on=["a"]),
+        Task(name="c", func=add, args=(1,), depends_on=["a"]),
+    ])
+    assert ManualScheduler(job).run() == {"b": (1,), "c": (2,)}
+
+def test_dag_rejects_cycles_and_unknown_dependencies():
+    cycle = Job(schedule="* * * * *", tasks=[
+        Task(name="a", func=add, depends_on=["b"]),
+        Task(name="b", func=add, depends_on=["a"]),
+    ])
+    with pytest.raises(ValueError):
+        ManualScheduler(cycle).run()
+
+    unknown = Job(schedule="* * * * *", tasks=[
+        Task(name="a", func=add, depends_on=["missing"]),
+    ])
+    with pytest.raises(ValueError):
+        ManualScheduler(unknown).run()
@@ -0,0 +1,157 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from chadGPT.data_models import Rule, Stock, StockBar, TradeOrder
+from chadGPT.trader import (
+    BaseMarketResearch, SimulatedBroker, find_exit_triggers, process_bar_batch
+)
+
+START = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+
+# ---- Fixtures ----
+
+class StaticMarket(BaseMarketResearch):
+    def __init__(self, prices: dict[str, float]):
+        self.prices = prices
+
+    def get_current_value(self, symbol: str):
+        if symbol not in self.prices:
+            return None
+        return Stock(symbol=symbol, price=self.prices[symbol], time=START)
+
+    def get_historic_value(self, symbol, start, end, aggregation):
+        return []
+
+
+def make_bar(symbol: str, minute: int, open: float, high: float, low: float, close: float) -> StockBar:
+    return StockBar(
+        symbol=symbol, time=START + timedelta(minutes=minute),
+        open=open, high=high, low=low, close=close,
+        volume=100, trade_count=1, volume_weighted_avg_price=close
+    )
+
+
+def buy(symbol: str, amount: float, stop_loss_pct=0.1, take_profit_pct=0.2) -> TradeOrder:
+    return TradeOrder(
+        type='buy', symbol=symbol, amount=amount, trade_time=None,
+        rules=Rule(stop_loss_pct=stop_loss_pct, take_profit_pct=take_profit_pct)
+    )
+
+# ---- Tests ----
+
+def test_simulated_broker_applies_slippage_and_keeps_cash():
+    broker = SimulatedBroker(
+        StaticMarket({"AAPL": 100.0}), cash=1000.0, clock=lambda: START,
+        slippage_pct=0.01
+    )
+    fill = broker.create_order(buy("AAPL", 5))
+    assert fill.price == pytest.approx(101.0)
+    assert broker.cash == pytest.approx(1000.0 - 505.0)
+
+    # buys are capped by the available cash
+    broker.create_order(buy("AAPL", 100))
+    assert broker.cash == pytest.approx(0.0)
+
+    portfolio = broker.get_portfolio()
+    assert portfolio.positions[0].symbol == "AAPL"
+    assert portfolio.total_value == pytest.approx(broker.shares["AAPL"] * 100.0)
+
+def test_simulated_broker_fills_pending_orders_at_next_open():
+    broker = SimulatedBroker(StaticMarket({}), cash=1000.0, clock=lambda: START)
+    assert broker.create_order(buy("AAPL", 2)) is None
+    fills = broker.process_bars([make_bar("AAPL", 1, 50.0, 51.0, 49.0, 50.5)])
+    assert fills[0].price == 50.0
+    assert broker.shares["AAPL"] == 2
+
+def test_simulated_broker_stop_loss_and_take_profit():
+    broker = SimulatedBroker(
+        StaticMarket({"AAPL": 100.0, "GOOGL": 100.0}), cash=1000.0,
+        clock=lambda: START
+    )
+    broker.create_order(buy("AAPL", 1))
+    broker.create_order(buy("GOOGL", 1))
+    fills = broker.process_bars([
+        make_bar("AAPL", 1, 99.0, 100.0, 95.0, 96.0),
+        make_bar("AAPL", 2, 96.0, 97.0, 89.0, 90.0),    # stop at 90
+        make_bar("GOOGL", 1, 100.0, 119.0, 99.0, 118.0),
+        make_bar("GOOGL", 2, 125.0, 126.0, 124.0, 125.0),  # gaps over 120
+    ])
+    by_symbol = {fill.symbol: fill for fill in fills}
+    assert by_symbol["AAPL"].reason == 'stop_loss'
+    assert by_symbol["AAPL"].price == pytest.approx(90.0)
+    assert by_symbol["AAPL"].time == START + timedelta(minutes=2)
+    assert by_symbol["GOOGL"].reason == 'take_profit'
+    assert by_symbol["GOOGL"].price == pytest.approx(125.0)
+    assert broker.shares == {}
+    assert broker.cash == pytest.approx(1000.0 - 200.0 + 90.0 + 125.0)
+
+def test_find_exit_triggers_matches_bar_by_bar_loop():
+    rng = np.random.default_rng(0)
+    n, t = 200, 500
+    closes = 100 * np.cumprod(1 + rng.normal(0, 0.01, (n, t)), axis=1)
+    opens = np.roll(closes, 1, axis=1)
+    opens[:, 0] = 100
+    highs = np.maximum(opens, closes) * 1.002
+    lows = np.minimum(opens, closes) * 0.998
+    entry = np.full(n, 100.0)
+    stop_loss = rng.uniform(0.02, 0.2, n)
+    take_profit = rng.uniform(0.02, 0.2, n)
+    stop_loss[:10] = np.nan  # no stop-loss rule
+
+    index, exit_prices, is_stop = find_exit_triggers(
+        entry, stop_loss, take_profit, opens, lows, highs
+    )
+
+    for i in range(n):
+        expected = -1
+        for j in range(t):
+            stop = not np.isnan(stop_loss[i]) and lows[i, j] <= entry[i] * (1 - stop_loss[i])
+            take = highs[i, j] >= entry[i] * (1 + take_profit[i])
+            if stop or take:
+                expected = j
+                assert is_stop[i] == stop
+                break
+        assert index[i] == expected
+
+def test_process_bar_batch_many_portfolios():
+    symbols = [f"S{i}" for i in range(20)]
+    market = StaticMarket({symbol: 100.0 for symbol in symbols})
+    brokers = [
+        SimulatedBroker(market, cash=10_000.0, clock=lambda: START)
+        for _ in range(300)
+    ]
+    rng = random.Random(0)
+    for broker in brokers:
+        for symbol in rng.sample(symbols, 10):
+            broker.create_order(buy(symbol, 5, rng.uniform(0.01, 0.05), rng.uniform(0.01, 0.05)))
+
+    bars = []
+    for symbol in symbols:
+        price = 100.0
+        for minute in range(390):
+            new_price = price * (1 + rng.gauss(0, 0.002))
+            bars.append(make_bar(
+                symbol, minute, price, max(price, new_price) * 1.001,
+                min(price, new_price) * 0.999, new_price
+            ))
+            price = new_price
+
+    fills = process_bar_batch(brokers, bars)
+    assert fills
+    assert all(fill.reason in ('stop_loss', 'take_profit') for fill in fills)
+    assert sum(len(b.shares) for b in brokers) == 300 * 10 - len(fills)
+
+def test_simulated_broker_ignores_duplicate_client_order_ids():
+    broker = SimulatedBroker(StaticMarket({"AAPL": 100.0}), cash=1000.0, clock=lambda: START)
+    order = buy("AAPL", 1).model_copy(update={'client_order_id': "run-0"})
+    assert broker.create_order(order) is not None
+    assert broker.create_order(order) is None
+    assert broker.shares["AAPL"] == 1
@@ -0,0 +1,163 @@
+import os
+import sys
+# add the parent directory to the sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chadGPT.data_models import Job, Task
+from chadGPT.scheduler import cron_matches
+from chadGPT.work_queue import SQLiteWorkQueue, Worker, enqueue_due_jobs
+
+# ---- Fixtures ----
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SQLiteWorkQueue(f"sqlite:///{tmp_path / 'queue.db'}")
+    yield queue
+    queue.engine.dispose()
+
+# ---- Tests ----
+
+def test_cron_matches():
+    monday_5am = datetime(2024, 1, 1, 5, 0, tzinfo=timezone.utc)
+    sunday_5am = datetime(2024, 1, 7, 5, 0, tzinfo=timezone.utc)
+    assert cron_matches('0 5 * * *', monday_5am)
+    assert not cron_matches('0 5 * * *', monday_5am + timedelta(minutes=1))
+    assert cron_matches('0 5 * * 0', sunday_5am)
+    assert not cron_matches('0 5 * * 0', monday_5am)
+    assert cron_matches('*/15 * * * 1-5', monday_5am + timedelta(minutes=45))
+    assert cron_matches('0 0 1 * *', datetime(2024, 2, 1, tzinfo=timezone.utc))
+
+def test_redundant_schedulers_enqueue_once(queue):
+    jobs = [
+        Job(name="alice:portfolio_update", schedule="0 * * * *", tasks=[]),
+        Job(name="alice:strategy", schedule="0 5 * * 0", tasks=[]),
+    ]
+    now = datetime(2024, 1, 1, 5, 0, 30, tzinfo=timezone.utc)
+    assert enqueue_due_jobs(queue, jobs, now) == ["alice:portfolio_update"]
+    # a second scheduler process ticking the same minute
+    assert enqueue_due_jobs(queue, jobs, now) == []
+
+def test_expired_lease_is_recovered(queue):
+    queue.enqueue("job", datetime(2024, 1, 1, tzinfo=timezone.utc))
+    item = queue.claim("crashed-worker", lease_seconds=0.05)
+    assert item is not None
+    assert queue.claim("other-worker", lease_seconds=60) is None
+
+    time.sleep(0.1)
+    recovered = queue.claim("other-worker", lease_seconds=60)
+    assert recovered is not None and recovered.id == item.id
+    # the first worker lost its lease and can no longer complete the item
+    assert not queue.heartbeat(item, "crashed-worker", 60)
+    assert not queue.complete(item, "crashed-worker")
+    assert queue.complete(recovered, "other-worker")
+    assert queue.claim("other-worker", lease_seconds=60) is None
+
+def test_workers_run_each_item_exactly_once(queue):
+    runs = Counter()
+    lock = threading.Lock()
+
+    def record(name):
+        with lock:
+            runs[name] += 1
+
+    jobs = [
+        Job(name=f"user{i}:portfolio_update", schedule="* * * * *",
+            tasks=[Task(func=record, args=(f"user{i}",))])
+        for i in range(40)
+    ]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for minute in range(3):
+        enqueue_due_jobs(queue, jobs, start + timedelta(minutes=minute))
+
+    workers = [Worker(queue, jobs, worker_id=f"worker{i}") for i in range(4)]
+    threads = [
+        threading.Thread(target=lambda w=w: [None for _ in iter(w.run_once, False)])
+        for w in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert runs == Counter({f"user{i}": 3 for i in range(40)})
+
+def test_job_stops_when_lease_is_lost(queue):
+    from sqlmodel import Session, update
+    from chadGPT.work_queue import WorkItemTable, check_lease
+    side_effects = []
+
+    def job():
+        # another worker takes over the item (e.g. after a long GC pause)
+        with Session(queue.engine) as session:
+            session.execute(update(WorkItemTable).values(lease_owner="other-worker"))
+            session.commit()
+        check_lease()
+        side_effects.append("order")
+
+    jobs = [Job(name="alice:portfolio_update", schedule="* * * * *", tasks=[Task(func=job)])]
+    queue.enqueue("alice:portfolio_update", datetime(2024, 1, 1, tzinfo=timezone.utc))
+    assert Worker(queue, jobs, worker_id="worker").run_once()
+    assert side_effects == []
+    # outside of a worker the check does nothing
+    check_lease()
+
+def test_naive_and_aware_times_share_a_job_key(queue):
+    aware = datetime(2024, 1, 1, 5, 0, tzinfo=timezone.utc)
+    assert queue.enqueue("job", aware)
+    assert not queue.enqueue("job", aware.replace(tzinfo=None))
+    assert not queue.enqueue("job", aware.astimezone(timezone(timedelta(hours=2))))
+
+def test_retried_item_continues_the_same_pipeline_run(queue):
+    from chadGPT.db import SQLiteDatabase
+    from chadGPT.giga import Giga
+    from chadGPT.work_queue import Lease, _current_lease
+    from tests.dummies import DummyBroker, DummyLLM, DummyMarket
+
+    class CrashingBroker(DummyBroker):
+        crash = True
+
+        def create_order(self, trade):
+            if self.crash and self.orders:
+                raise ConnectionError("worker died mid-way through the orders")
+            super().create_order(trade)
+
+    broker = CrashingBroker()
+    giga = Giga(
+        broker=broker, market=DummyMarket(), portfolio_update_brain=DummyLLM(),
+        research_brain=DummyLLM(), db=SQLiteDatabase("sqlite://"), user="alice"
+    )
+    jobs = [Job(
+        name="alice:portfolio_update", schedule="* * * * *",
+        tasks=[Task(func=giga.update_portfolio_pipeline)]
+    )]
+    queue.enqueue("alice:portfolio_update", datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    # the first worker dies after one order, without completing the item
+    item = queue.claim("crashed-worker", lease_seconds=0.05)
+    token = _current_lease.set(Lease(queue, item, "crashed-worker"))
+    with pytest.raises(ConnectionError):
+        giga.update_portfolio_pipeline()
+    _current_lease.reset(token)
+    assert len(broker.orders) == 1
+
+    time.sleep(0.1)
+    broker.crash = False
+    assert Worker(queue, jobs, worker_id="other-worker").run_once()
+    # the retry resumed the run: every planned order went out exactly once
+    ids = [order.client_order_id for order in broker.orders]
+    assert len(ids) == 2 and len(set(ids)) == 2
+    assert len(giga.db.read(category='portfolio_update')) == 1
+    assert len(giga.db.read(category='trades')) == 1
+    assert queue.claim("other-worker", lease_seconds=60) is None
+    # a stray rerun of the finished item has no effect either
+    token = _current_lease.set(Lease(queue, item, "crashed-worker"))
+    giga.update_portfolio_pipeline()
+    _current_lease.reset(token)
+    assert len(broker.orders) == 2